@@ -0,0 +1,340 @@
+"""
+Admission control for work-creating endpoints (uploads and analysis submissions).
+
+Checked in order, before the request body is read:
+  1. Load shedding: when the analysis queue is too deep or its oldest queued
+     job too old, new analyses get a fast 503 with Retry-After instead of
+     queuing behind work that will not finish in time.
+  2. Rate limiting: a token bucket per client and endpoint class
+     (429 + Retry-After). Clients are identified by X-API-Key, else by IP.
+  3. Concurrency caps: a client may have at most
+     MAX_INFLIGHT_ANALYSES_PER_CLIENT queued/processing analyses, and each
+     worker accepts at most MAX_CONCURRENT_UPLOADS uploads at once.
+
+Token buckets live in a pluggable backend: in-process memory (per worker) or
+Redis (shared by every worker and host). Load shedding looks at the live work
+queue, not at every pending row in the database, so a lost job or analyses
+that no worker was given (bulk ingest without Celery) never block the API:
+  - without Celery, the analyses this process handed to its BackgroundTasks
+    (LocalQueue): depth counts them until they finish, age is the oldest
+    one not yet started
+  - with Celery, the broker queue length (Redis), and the age of the oldest
+    analysis still "queued", ignoring rows queued longer than
+    INFLIGHT_TIMEOUT (lost messages)
+Per-client in-flight counts come from the analyses table, so they are correct
+across processes and Celery.
+"""
+import asyncio
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app import metrics, models
+from app.config import settings
+
+PENDING_STATUSES = ("queued", "processing")
+# Jobs queued longer than this are treated as lost and stop counting against limits
+INFLIGHT_TIMEOUT = timedelta(minutes=30)
+# Celery queue analysis tasks are routed to (app.celery_worker)
+CELERY_QUEUE = "main-queue"
+QUEUE_STATS_TTL_SECONDS = 1.0
+SHED_RETRY_AFTER_SECONDS = 10
+
+# (method, path prefix) -> endpoint class
+POLICIES = {
+    ("POST", "/api/upload/"): "upload",
+    ("POST", "/api/analysis/"): "analysis",
+}
+
+
+def limits_for(endpoint_class: str) -> Tuple[float, int]:
+    """(tokens per second, burst) for an endpoint class"""
+    if endpoint_class == "upload":
+        return settings.UPLOAD_RATE_PER_MINUTE / 60.0, settings.UPLOAD_BURST
+    return settings.ANALYSIS_RATE_PER_MINUTE / 60.0, settings.ANALYSIS_BURST
+
+
+def client_key(request) -> str:
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+# ---------------------------------------------------------------------------
+# Token bucket backends
+# ---------------------------------------------------------------------------
+
+class MemoryBackend:
+    """Token buckets in this process; limits apply per worker"""
+
+    MAX_BUCKETS = 100000
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """Take one token; returns 0 if granted, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune(now, rate, burst)
+            return wait
+
+    def _prune(self, now: float, rate: float, burst: int):
+        # Buckets idle long enough to be full again carry no state
+        idle = burst / rate
+        for key in [k for k, (_, updated) in self._buckets.items() if now - updated > idle]:
+            del self._buckets[key]
+
+
+class RedisBackend:
+    """Token buckets shared by all workers; one atomic script call per check"""
+
+    # Uses the server clock so hosts with skewed clocks share one timeline
+    SCRIPT = """
+    local now_parts = redis.call('TIME')
+    local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 't'))
+    local updated = tonumber(redis.call('HGET', KEYS[1], 'u'))
+    if tokens == nil then
+        tokens = burst
+        updated = now
+    end
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        import redis
+
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        try:
+            return float(self._script(keys=[f"agriscan:rl:{key}"], args=[rate, burst]))
+        except Exception as e:
+            # Fail open: an unavailable limiter must not take the API down with it
+            metrics.incr("admission", "backend_errors")
+            print(f"Rate limit backend error: {e}")
+            return 0.0
+
+
+def create_backend():
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        return RedisBackend(settings.RATE_LIMIT_REDIS_URL)
+    return MemoryBackend()
+
+
+# ---------------------------------------------------------------------------
+# Queue state
+# ---------------------------------------------------------------------------
+
+class LocalQueue:
+    """Analyses handed to this process's BackgroundTasks, from dispatch until they finish"""
+
+    def __init__(self):
+        self._queued: Dict[str, float] = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def enqueued(self, analysis_id: str):
+        with self._lock:
+            self._queued[analysis_id] = time.monotonic()
+
+    def started(self, analysis_id: str):
+        with self._lock:
+            if self._queued.pop(analysis_id, None) is not None:
+                self._running.add(analysis_id)
+
+    def finished(self, analysis_id: str):
+        with self._lock:
+            self._queued.pop(analysis_id, None)
+            self._running.discard(analysis_id)
+
+    def stats(self) -> Tuple[int, float]:
+        """(queued + running, seconds the oldest queued analysis has waited)"""
+        with self._lock:
+            oldest = min(self._queued.values(), default=None)
+            depth = len(self._queued) + len(self._running)
+        return depth, time.monotonic() - oldest if oldest is not None else 0.0
+
+
+local_queue = LocalQueue()
+
+
+def broker_depth() -> Optional[int]:
+    """Messages waiting in the Celery queue, or None if it can't be read (non-Redis broker)"""
+    if not settings.CELERY_BROKER_URL.startswith(("redis://", "rediss://")):
+        return None
+    try:
+        import redis
+
+        client = redis.Redis.from_url(settings.CELERY_BROKER_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+        return int(client.llen(CELERY_QUEUE))
+    except Exception as e:
+        metrics.incr("admission", "broker_errors")
+        print(f"Broker queue depth unavailable: {e}")
+        return None
+
+
+class QueueStats:
+    """Depth and oldest-job age of the analysis queue, refreshed at most once per TTL"""
+
+    def __init__(self, ttl: float = QUEUE_STATS_TTL_SECONDS):
+        self.ttl = ttl
+        self._value = (0, 0.0)
+        self._fetched = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Tuple[int, float]:
+        with self._lock:
+            if time.monotonic() - self._fetched < self.ttl:
+                return self._value
+        value = self._query()
+        with self._lock:
+            self._value, self._fetched = value, time.monotonic()
+        metrics.set_gauge("admission", "queue_depth", value[0])
+        metrics.set_gauge("admission", "queue_age_seconds", round(value[1], 1))
+        return value
+
+    @staticmethod
+    def _over_limit(depth: int, age: float) -> bool:
+        return depth >= settings.MAX_QUEUE_DEPTH or age >= settings.MAX_QUEUE_AGE_SECONDS
+
+    def overloaded(self) -> bool:
+        return self._over_limit(*self.get())
+
+    def try_admit(self) -> bool:
+        """
+        Reserve a queue slot. Admitted jobs are counted locally until the next
+        refresh, so a burst arriving inside one TTL cannot overshoot the cap.
+        """
+        with self._lock:
+            depth, age = self._value
+            if self._over_limit(depth, age):
+                return False
+            self._value = (depth + 1, age)
+            return True
+
+    def _query(self) -> Tuple[int, float]:
+        from app.database import SessionLocal
+
+        if not settings.USE_CELERY:
+            return local_queue.stats()
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            queued, oldest = db.query(func.count(models.Analysis.id), func.min(models.Analysis.created_at)).filter(
+                models.Analysis.status == "queued",
+                models.Analysis.created_at > now - INFLIGHT_TIMEOUT
+            ).one()
+        finally:
+            db.close()
+        depth = broker_depth()
+        return queued if depth is None else depth, (now - oldest).total_seconds() if oldest else 0.0
+
+
+def inflight_analyses(key: str) -> int:
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        return db.query(func.count(models.Analysis.id)).filter(
+            models.Analysis.client_key == key,
+            models.Analysis.status.in_(PENDING_STATUSES),
+            models.Analysis.created_at > datetime.utcnow() - INFLIGHT_TIMEOUT
+        ).scalar()
+    finally:
+        db.close()
+
+
+# ---------------------------------------------------------------------------
+# Middleware
+# ---------------------------------------------------------------------------
+
+def _reject(status_code: int, reason: str, retry_after: float) -> JSONResponse:
+    metrics.incr("admission", reason)
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": reason.replace("_", " ")},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class AdmissionMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, backend=None, queue_stats: Optional[QueueStats] = None):
+        super().__init__(app)
+        self.backend = backend or create_backend()
+        self.queue_stats = queue_stats or QueueStats()
+        self._uploads = 0
+        self._uploads_lock = asyncio.Lock()
+
+    def _endpoint_class(self, request) -> Optional[str]:
+        for (method, prefix), endpoint_class in POLICIES.items():
+            if request.method == method and request.url.path.startswith(prefix):
+                return endpoint_class
+        return None
+
+    async def dispatch(self, request, call_next):
+        endpoint_class = self._endpoint_class(request) if settings.ADMISSION_ENABLED else None
+        if endpoint_class is None:
+            return await call_next(request)
+
+        key = client_key(request)
+        request.state.client_key = key
+
+        if endpoint_class == "analysis" and await run_in_threadpool(self.queue_stats.overloaded):
+            return _reject(503, "overloaded", SHED_RETRY_AFTER_SECONDS)
+
+        rate, burst = limits_for(endpoint_class)
+        wait = await run_in_threadpool(self.backend.take, f"{endpoint_class}:{key}", rate, burst)
+        if wait > 0:
+            return _reject(429, "rate_limited", wait)
+
+        if endpoint_class == "analysis":
+            if await run_in_threadpool(inflight_analyses, key) >= settings.MAX_INFLIGHT_ANALYSES_PER_CLIENT:
+                return _reject(429, "too_many_inflight_analyses", SHED_RETRY_AFTER_SECONDS)
+            if not self.queue_stats.try_admit():
+                return _reject(503, "overloaded", SHED_RETRY_AFTER_SECONDS)
+            metrics.incr("admission", "admitted")
+            return await call_next(request)
+
+        async with self._uploads_lock:
+            if self._uploads >= settings.MAX_CONCURRENT_UPLOADS:
+                return _reject(503, "too_many_uploads", 1)
+            self._uploads += 1
+        try:
+            metrics.incr("admission", "admitted")
+            return await call_next(request)
+        finally:
+            async with self._uploads_lock:
+                self._uploads -= 1
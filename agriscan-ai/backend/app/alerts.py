@@ -0,0 +1,490 @@
+"""
+Rule-based alerts on analysis results.
+
+Users define AlertRule rows: a condition over one analysis type, for one field
+or every field, and a sink to notify. Conditions (AlertRule.condition):
+
+  threshold  {"type": "threshold", "metric": "overall_health_score", "op": "<", "value": 60}
+             metric is a dotted path into results_json ("risk_level",
+             "nitrogen.percentage", "predicted_yield_tons_per_hectare").
+  change     {"type": "change", "metric": "overall_health_score", "op": "<=", "value": -10,
+              "zone": "field", "per_day": false}
+             compares the delta change detection recorded against the field's
+             previous analysis (metric and zone names as in
+             app.change_detection); per_day divides by the days in between.
+  pest       {"type": "pest", "pest_type": "Aphid", "zone": "Zone A", "min_count": 1,
+              "min_confidence": 0.8}
+             pest_type and zone are optional (any).
+
+Rules are compiled into predicates once and indexed by (field_id, analysis
+type), with field_id None for rules on every field. A completed analysis is
+checked against exactly two index buckets, so the cost of an event does not
+grow with the number of rules on other fields or types. The index reloads
+when a cheap signature query (rule count, latest update) changes, which also
+picks up rules created through other workers.
+
+A match is stored as an Alert. Dedupe: a rule fires at most once per analysis
+(unique index), so rerunning completion hooks is harmless. Throttling: after
+a rule notifies for a field, further matches within its throttle window are
+stored as "suppressed" without notifying. Sinks are pluggable (register_sink):
+"queue" leaves the alert queued for clients polling GET /api/alerts;
+"webhook" POSTs it to the rule's target from the dispatcher's pool of
+ALERT_DELIVERY_THREADS threads, so a slow target holds up one thread, not
+every alert. A failed attempt leaves the alert pending with a next_attempt_at
+instead of sleeping; the dispatcher's sweep (at startup, then every
+ALERT_SWEEP_SECONDS) resubmits due pending alerts, including those a previous
+process left behind, until ALERT_MAX_ATTEMPTS is reached. Each attempt first
+leases the row, so sweeps in several workers never deliver an alert twice.
+"""
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import metrics, models
+from app.config import settings
+
+if TYPE_CHECKING:
+    from app.detections import Detections
+
+OPERATORS = {
+    "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+    "==": operator.eq, "!=": operator.ne,
+}
+CONDITION_TYPES = ("threshold", "change", "pest")
+ANALYSIS_TYPES = ("pest_detection", "nutrient_mapping", "yield_prediction")
+# Alert statuses that count as a notification for throttling
+NOTIFIED = ("pending", "queued", "delivered", "acknowledged")
+# Attempt n is retried RETRY_BACKOFF_SECONDS * n later (at the next sweep after that)
+RETRY_BACKOFF_SECONDS = 30
+# An attempt holds its alert this long; a process dying mid-delivery only delays the retry
+LEASE_SECONDS = 300
+SWEEP_BATCH = 500
+
+
+# ---------------------------------------------------------------------------
+# Evaluation context
+# ---------------------------------------------------------------------------
+
+class Context:
+    """One completed analysis, with derived views computed on first use and shared by every rule"""
+
+    def __init__(self, db: Session, analysis: models.Analysis, change: Optional[models.FieldChange]):
+        self.db = db
+        self.analysis = analysis
+        self.results = analysis.results_json or {}
+        self.change = change
+        self._detections: Optional["Detections"] = None
+        self._days: Optional[float] = None
+
+    @property
+    def detections(self) -> "Detections":
+        if self._detections is None:
+            # numpy stays off the import path until a pest rule is checked
+            from app.detections import Detections
+
+            self._detections = Detections.coerce(self.results.get("pests", []))
+        return self._detections
+
+    @property
+    def days_since_previous(self) -> Optional[float]:
+        if self._days is None and self.change is not None and self.change.previous_analysis_id:
+            previous = self.db.query(models.Analysis.created_at).filter(
+                models.Analysis.id == self.change.previous_analysis_id).scalar()
+            if previous is not None and self.analysis.created_at is not None:
+                self._days = max((self.analysis.created_at - previous).total_seconds() / 86400, 1 / 24)
+        return self._days
+
+
+def _lookup(results: Dict, path: Tuple[str, ...]):
+    value = results
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+# ---------------------------------------------------------------------------
+# Compiling rules
+# ---------------------------------------------------------------------------
+
+@dataclass
+class CompiledRule:
+    id: str
+    name: str
+    field_id: Optional[str]
+    analysis_type: str
+    sink: str
+    target: Optional[str]
+    throttle_seconds: int
+    check: Callable[[Context], Optional[str]]  # message when the rule fires, else None
+
+
+def _compile_threshold(condition: Dict) -> Callable[[Context], Optional[str]]:
+    metric = condition["metric"]
+    path = tuple(metric.split("."))
+    op_name, limit = condition.get("op", ">="), condition["value"]
+    compare = OPERATORS[op_name]
+
+    def check(context: Context) -> Optional[str]:
+        value = _lookup(context.results, path)
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        try:
+            fired = compare(value, limit)
+        except TypeError:
+            return None
+        return f"{metric} is {value} ({op_name} {limit})" if fired else None
+    return check
+
+
+def _compile_change(condition: Dict) -> Callable[[Context], Optional[str]]:
+    metric, zone = condition["metric"], condition.get("zone", "field")
+    op_name, limit = condition.get("op", "<="), float(condition["value"])
+    compare = OPERATORS[op_name]
+    per_day = bool(condition.get("per_day", False))
+
+    def check(context: Context) -> Optional[str]:
+        if context.change is None:
+            return None
+        delta = ((context.change.zone_deltas or {}).get(metric) or {}).get(zone)
+        if delta is None:
+            return None
+        unit = "since the previous analysis"
+        if per_day:
+            days = context.days_since_previous
+            if days is None:
+                return None
+            delta, unit = delta / days, "per day"
+        if not compare(delta, limit):
+            return None
+        where = "" if zone == "field" else f" in {zone}"
+        return f"{metric}{where} changed by {round(delta, 3):+} {unit} ({op_name} {limit})"
+    return check
+
+
+def _compile_pest(condition: Dict) -> Callable[[Context], Optional[str]]:
+    pest_type, zone = condition.get("pest_type"), condition.get("zone")
+    min_count = int(condition.get("min_count", 1))
+    min_confidence = float(condition.get("min_confidence", 0.0))
+
+    def check(context: Context) -> Optional[str]:
+        detections = context.detections
+        if len(detections) < min_count:
+            return None
+        data = detections.data
+        mask = data["confidence"] >= min_confidence
+        if pest_type is not None:
+            if pest_type not in detections.classes:
+                return None
+            mask &= data["class_id"] == detections.classes.index(pest_type)
+        if zone is not None:
+            if zone not in detections.zones:
+                return None
+            mask &= data["zone_id"] == detections.zones.index(zone)
+        count = int(mask.sum())
+        if count < min_count:
+            return None
+        return f"{count} {pest_type or 'pest'} detection(s) in {zone or 'the field'}"
+    return check
+
+
+COMPILERS = {"threshold": _compile_threshold, "change": _compile_change, "pest": _compile_pest}
+
+
+def compile_rule(rule: models.AlertRule) -> CompiledRule:
+    """Raises ValueError for an invalid analysis type, condition or sink"""
+    if rule.analysis_type not in ANALYSIS_TYPES:
+        raise ValueError(f"Unknown analysis type {rule.analysis_type!r}; expected one of {', '.join(ANALYSIS_TYPES)}")
+    condition = rule.condition or {}
+    kind = condition.get("type")
+    if kind not in COMPILERS:
+        raise ValueError(f"Unknown condition type {kind!r}; expected one of {', '.join(CONDITION_TYPES)}")
+    if "op" in condition and condition["op"] not in OPERATORS:
+        raise ValueError(f"Unknown operator {condition['op']!r}")
+    sink = rule.sink or "queue"
+    if sink not in SINKS:
+        raise ValueError(f"Unknown sink {sink!r}")
+    if sink == "webhook" and not rule.target:
+        raise ValueError("Webhook rules need a target URL")
+    try:
+        check = COMPILERS[kind](condition)
+    except KeyError as e:
+        raise ValueError(f"{kind} condition is missing {e}")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid {kind} condition: {e}")
+    throttle = rule.throttle_seconds if rule.throttle_seconds is not None else settings.ALERT_THROTTLE_SECONDS
+    return CompiledRule(rule.id, rule.name or kind, rule.field_id, rule.analysis_type, sink, rule.target,
+                        throttle, check)
+
+
+class RuleIndex:
+    """Enabled rules by (field_id or None, analysis_type), reloaded when the rule table changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules: Dict[Tuple[Optional[str], str], List[CompiledRule]] = {}
+        self._signature = None
+
+    def refresh(self, db: Session):
+        signature = tuple(db.query(func.count(models.AlertRule.id), func.max(models.AlertRule.updated_at)).one())
+        if signature == self._signature:
+            return
+        rules: Dict[Tuple[Optional[str], str], List[CompiledRule]] = {}
+        for rule in db.query(models.AlertRule).filter(models.AlertRule.enabled.is_(True)):
+            try:
+                compiled = compile_rule(rule)
+            except ValueError as e:
+                print(f"Skipping alert rule {rule.id}: {e}")
+                continue
+            rules.setdefault((compiled.field_id, compiled.analysis_type), []).append(compiled)
+        with self._lock:
+            self._rules, self._signature = rules, signature
+        metrics.set_gauge("alerts", "rules", sum(len(bucket) for bucket in rules.values()))
+
+    def candidates(self, field_id: Optional[str], analysis_type: str) -> List[CompiledRule]:
+        with self._lock:
+            rules = self._rules.get((None, analysis_type), [])
+            if field_id is not None:
+                rules = rules + self._rules.get((field_id, analysis_type), [])
+        return rules
+
+
+index = RuleIndex()
+
+
+# ---------------------------------------------------------------------------
+# Sinks
+# ---------------------------------------------------------------------------
+
+class QueueSink:
+    """Leaves the alert queued; clients poll GET /api/alerts?status=queued and acknowledge"""
+    background = False
+
+    def deliver(self, alert: models.Alert, rule: CompiledRule) -> str:
+        return "queued"
+
+
+class WebhookSink:
+    """POSTs the alert as JSON to the rule's target URL"""
+    background = True
+
+    def deliver(self, alert: models.Alert, rule: CompiledRule) -> str:
+        import requests
+        response = requests.post(rule.target, json=payload(alert), timeout=settings.ALERT_WEBHOOK_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        return "delivered"
+
+
+SINKS = {"queue": QueueSink(), "webhook": WebhookSink()}
+
+
+def register_sink(name: str, sink):
+    """sink.deliver(alert, rule) returns the alert's new status or raises; background=True delivers off the task"""
+    SINKS[name] = sink
+
+
+def payload(alert: models.Alert) -> Dict:
+    return {
+        "id": alert.id,
+        "rule_id": alert.rule_id,
+        "field_id": alert.field_id,
+        "analysis_id": alert.analysis_id,
+        "message": alert.message,
+        "details": alert.payload,
+        "created_at": alert.created_at.isoformat() if alert.created_at else None,
+    }
+
+
+class Dispatcher:
+    """Thread pool delivering alerts for sinks that talk to the network, plus the pending-alert sweep"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._sweeper: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._in_flight: Set[str] = set()
+
+    def start(self):
+        """Start the sweep; the first pass picks up alerts left pending by a previous process"""
+        with self._lock:
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._stopped.clear()
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="alert-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def submit(self, alert_id: str):
+        with self._lock:
+            if alert_id in self._in_flight:
+                return
+            self._in_flight.add(alert_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=settings.ALERT_DELIVERY_THREADS,
+                                                    thread_name_prefix="alert-delivery")
+            self._executor.submit(self._run, alert_id)
+
+    def _run(self, alert_id: str):
+        from app.database import SessionLocal
+
+        db = SessionLocal()
+        try:
+            _attempt(db, alert_id)
+        except Exception as e:
+            db.rollback()
+            print(f"Alert delivery failed for {alert_id}: {e}")
+        finally:
+            db.close()
+            with self._lock:
+                self._in_flight.discard(alert_id)
+
+    def _sweep_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Alert sweep failed: {e}")
+            self._stopped.wait(settings.ALERT_SWEEP_SECONDS)
+
+    def sweep(self) -> int:
+        """Submit pending alerts whose next attempt is due; returns how many"""
+        from app.database import SessionLocal
+
+        db = SessionLocal()
+        try:
+            due = [alert_id for (alert_id,) in db.query(models.Alert.id).filter(
+                models.Alert.status == "pending", _due(datetime.utcnow()),
+            ).order_by(models.Alert.created_at).limit(SWEEP_BATCH)]
+        finally:
+            db.close()
+        for alert_id in due:
+            self.submit(alert_id)
+        metrics.incr("alerts", "swept", len(due))
+        return len(due)
+
+
+dispatcher = Dispatcher()
+
+
+def _due(now: datetime):
+    return or_(models.Alert.next_attempt_at.is_(None), models.Alert.next_attempt_at <= now)
+
+
+def _attempt(db: Session, alert_id: str):
+    """Lease a due pending alert, then try delivering it once"""
+    now = datetime.utcnow()
+    leased = db.query(models.Alert).filter(
+        models.Alert.id == alert_id, models.Alert.status == "pending", _due(now),
+    ).update({models.Alert.next_attempt_at: now + timedelta(seconds=LEASE_SECONDS)}, synchronize_session=False)
+    db.commit()
+    if leased:
+        _deliver(db, db.get(models.Alert, alert_id))
+
+
+def _fail(alert: models.Alert, error: str):
+    alert.status = "failed"
+    alert.next_attempt_at = None
+    alert.payload = dict(alert.payload or {}, error=error)
+    metrics.incr("alerts", "failed")
+
+
+def _deliver(db: Session, alert: models.Alert):
+    """One attempt; a failure before ALERT_MAX_ATTEMPTS leaves the alert pending for a later sweep"""
+    alert.attempts = (alert.attempts or 0) + 1
+    rule = db.get(models.AlertRule, alert.rule_id)
+    try:
+        if rule is None:
+            raise ValueError("rule no longer exists")
+        compiled = compile_rule(rule)
+    except ValueError as e:
+        _fail(alert, str(e))
+        db.commit()
+        return
+    try:
+        alert.status = SINKS[compiled.sink].deliver(alert, compiled)
+        alert.delivered_at = datetime.utcnow()
+        alert.next_attempt_at = None
+        metrics.incr("alerts", alert.status)
+    except Exception as e:
+        if alert.attempts >= settings.ALERT_MAX_ATTEMPTS:
+            _fail(alert, str(e))
+        else:
+            alert.next_attempt_at = datetime.utcnow() + timedelta(seconds=RETRY_BACKOFF_SECONDS * alert.attempts)
+            metrics.incr("alerts", "retries")
+    db.commit()
+
+
+# ---------------------------------------------------------------------------
+# Evaluation
+# ---------------------------------------------------------------------------
+
+def _throttled(db: Session, rule: CompiledRule, field_id: Optional[str], now: datetime) -> bool:
+    if rule.throttle_seconds <= 0:
+        return False
+    return db.query(models.Alert.id).filter(
+        models.Alert.rule_id == rule.id,
+        models.Alert.field_id == field_id,
+        models.Alert.created_at >= now - timedelta(seconds=rule.throttle_seconds),
+        models.Alert.status.in_(NOTIFIED),
+    ).first() is not None
+
+
+def evaluate(db: Session, analysis: models.Analysis, change: Optional[models.FieldChange] = None) -> List[models.Alert]:
+    """Check a completed analysis against its field's rules; returns the alerts stored"""
+    if not settings.ALERTS_ENABLED or analysis.status != "completed":
+        return []
+    index.refresh(db)
+    rules = index.candidates(analysis.field_id, analysis.analysis_type)
+    metrics.incr("alerts", "rules_checked", len(rules))
+    if not rules:
+        return []
+
+    context = Context(db, analysis, change)
+    now = datetime.utcnow()
+    stored = []
+    for rule in rules:
+        message = rule.check(context)
+        if message is None:
+            continue
+        if db.query(models.Alert.id).filter(models.Alert.rule_id == rule.id,
+                                            models.Alert.analysis_id == analysis.id).first() is not None:
+            metrics.incr("alerts", "duplicates")
+            continue
+        throttled = _throttled(db, rule, analysis.field_id, now)
+        alert = models.Alert(
+            rule_id=rule.id, field_id=analysis.field_id, analysis_id=analysis.id, created_at=now,
+            message=f"{rule.name}: {message}",
+            payload={"analysis_type": analysis.analysis_type, "rule": rule.name},
+            status="suppressed" if throttled else "pending",
+        )
+        db.add(alert)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another worker stored this rule's alert for the analysis first
+            db.rollback()
+            metrics.incr("alerts", "duplicates")
+            continue
+        metrics.incr("alerts", "suppressed" if throttled else "fired")
+        stored.append(alert)
+        if throttled:
+            continue
+        if SINKS[rule.sink].background:
+            dispatcher.submit(alert.id)
+        else:
+            _attempt(db, alert.id)
+    return stored
@@ -1,11 +1,12 @@
-from celery import Celery
 from app.config import settings
 
-# Only initialize Celery if USE_CELERY is enabled
+# Only initialize Celery if USE_CELERY is enabled; the import itself is slow,
+# so it is skipped entirely otherwise
 celery_app = None
 
 if settings.USE_CELERY:
     try:
+        from celery import Celery
         celery_app = Celery(
             "worker",
             broker=settings.CELERY_BROKER_URL,
@@ -0,0 +1,295 @@
+"""
+Temporal change detection between successive flights of the same field.
+
+For every completed analysis we reduce the result to a compact state:
+  - zone_values: {metric: {zone: value}} aggregates from the result JSON
+  - grid:        a GRID_SIZE x GRID_SIZE raster (vegetation index for nutrient
+                 mapping, detection density for pest detection)
+
+Analyses are ordered by capture time (the upload's EXIF time, else when the
+analysis was created), and each is compared with the latest one captured on an
+earlier day, so images of the same flight are never differenced against each
+other and a late-finishing older flight does not become the baseline. The
+latest state per (field, analysis type) is cached in FieldState, so usually
+only the new result is reduced; the delta is stored as a FieldChange row and
+the cache is upserted when the analysis is the newest. "What changed" for a
+field is then a single indexed query.
+
+Grids are co-registered before differencing: the integer shift between
+flights is estimated by phase correlation of the imagery's vegetation grids,
+so detection density maps are aligned by the images they came from.
+
+numpy, app.detections and app.raster_cache are imported where they are used,
+so importing this module (app.main does, through app.tasks) stays cheap.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from PIL import Image
+from sqlalchemy.orm import Session, object_session
+
+from app import models, tiles
+
+if TYPE_CHECKING:
+    import numpy as np
+    from app.detections import Detections
+
+GRID_SIZE = 64
+# Cells whose change exceeds this (in index units / normalized density) count as changed
+CHANGE_THRESHOLD = 0.1
+WORST_CELLS = 5
+
+# Direction in which each metric gets worse
+WORSE_WHEN_HIGHER = {
+    "detections", "affected_area_percentage",
+    "nitrogen_deficiency", "phosphorus_deficiency", "potassium_deficiency",
+    "pest_density",
+}
+WORSE_WHEN_LOWER = {"overall_health_score", "predicted_yield", "vegetation_index"}
+
+
+# ---------------------------------------------------------------------------
+# Reducing a result to state
+# ---------------------------------------------------------------------------
+
+def _image_for(analysis: models.Analysis) -> Optional[Image.Image]:
+    from app import raster_cache
+    if not analysis.original_image_url:
+        return None
+    upload_id = Path(analysis.original_image_url).stem
+    try:
+        # Every analysis of an upload reuses one small decoded copy
+        pixels = raster_cache.load(upload_id, max_side=GRID_SIZE * 4)
+    except Exception as e:
+        print(f"Change detection could not decode {upload_id}: {e}")
+        return None
+    return raster_cache.to_image(pixels) if pixels is not None else None
+
+
+def _source_size(analysis: models.Analysis, image: Image.Image) -> Tuple[int, int]:
+    """Full-resolution size of the analysed image (detections are in its pixels)"""
+    db = object_session(analysis)
+    upload = db.get(models.Upload, Path(analysis.original_image_url).stem) if db is not None else None
+    if upload is not None and upload.width and upload.height:
+        return upload.width, upload.height
+    return image.size
+
+
+def vegetation_grid(image: Image.Image) -> "np.ndarray":
+    import numpy as np
+    small = image.resize((GRID_SIZE, GRID_SIZE), Image.BOX)
+    index, valid = tiles.vegetation_index(small)
+    return np.where(valid, index, 0).astype(np.float32)
+
+
+def density_grid(detections: "Detections", size: Tuple[int, int]) -> "np.ndarray":
+    """Confidence-weighted share of each cell covered by detections, in [0, 1]"""
+    import numpy as np
+    width, height = size
+    grid = detections.paint((GRID_SIZE, GRID_SIZE), GRID_SIZE / max(width, 1), GRID_SIZE / max(height, 1))
+    return np.clip(grid, 0, 1)
+
+
+def extract_state(analysis: models.Analysis) -> Tuple[Dict, Optional["np.ndarray"], Optional["np.ndarray"]]:
+    """Returns (zone_values, metric grid, registration grid from the image)"""
+    import numpy as np
+    from app.detections import Detections
+    results = analysis.results_json or {}
+    zone_values: Dict[str, Dict[str, float]] = {}
+    grid = None
+    image = _image_for(analysis) if analysis.analysis_type != "yield_prediction" else None
+    registration = vegetation_grid(image) if image is not None else None
+
+    if analysis.analysis_type == "pest_detection":
+        detections = Detections.coerce(results.get("pests", []))
+        zone_values["detections"] = detections.counts_by_zone()
+        zone_values["affected_area_percentage"] = {"field": results.get("affected_area_percentage", 0)}
+        if len(detections):
+            # No image: assume the detections span the frame
+            size = _source_size(analysis, image) if image is not None else detections.extent()
+            grid = density_grid(detections, size)
+        else:
+            grid = np.zeros((GRID_SIZE, GRID_SIZE), dtype=np.float32)
+
+    elif analysis.analysis_type == "nutrient_mapping":
+        for nutrient in ("nitrogen", "phosphorus", "potassium"):
+            if nutrient in results:
+                zone_values[f"{nutrient}_deficiency"] = {"field": results[nutrient].get("percentage", 0)}
+        if "overall_health_score" in results:
+            zone_values["overall_health_score"] = {"field": results["overall_health_score"]}
+        grid = registration
+
+    elif analysis.analysis_type == "yield_prediction":
+        if "predicted_yield_tons_per_hectare" in results:
+            zone_values["predicted_yield"] = {"field": results["predicted_yield_tons_per_hectare"]}
+
+    return zone_values, grid, registration
+
+
+# ---------------------------------------------------------------------------
+# Comparing states
+# ---------------------------------------------------------------------------
+
+def estimate_shift(reference: "np.ndarray", moving: "np.ndarray") -> Tuple[int, int]:
+    """Integer (dy, dx) that best aligns moving onto reference (phase correlation)"""
+    import numpy as np
+    f_ref = np.fft.fft2(reference - reference.mean())
+    f_mov = np.fft.fft2(moving - moving.mean())
+    cross_power = f_ref * np.conj(f_mov)
+    cross_power /= np.abs(cross_power) + 1e-9
+    correlation = np.abs(np.fft.ifft2(cross_power))
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    rows, cols = reference.shape
+    # Wrap to signed shifts
+    return int(dy if dy <= rows // 2 else dy - rows), int(dx if dx <= cols // 2 else dx - cols)
+
+
+def compare_grids(previous: "np.ndarray", current: "np.ndarray", metric: str, shift: Tuple[int, int]) -> Dict:
+    import numpy as np
+    dy, dx = shift
+    aligned = np.roll(current, (dy, dx), axis=(0, 1))
+    # Ignore the wrapped-around border introduced by the shift
+    valid = np.ones_like(aligned, dtype=bool)
+    if dy > 0:
+        valid[:dy, :] = False
+    elif dy < 0:
+        valid[dy:, :] = False
+    if dx > 0:
+        valid[:, :dx] = False
+    elif dx < 0:
+        valid[:, dx:] = False
+
+    delta = np.where(valid, aligned - previous, 0)
+    # Positive "worsening" regardless of metric direction
+    worsening = delta if metric in WORSE_WHEN_HIGHER else -delta
+    flat = np.argsort(worsening, axis=None)[::-1][:WORST_CELLS]
+    rows, cols = np.unravel_index(flat, worsening.shape)
+
+    valid_cells = max(int(valid.sum()), 1)
+    return {
+        "metric": metric,
+        "shift": [dy, dx],
+        "mean_delta": round(float(delta[valid].mean()) if valid.any() else 0.0, 4),
+        "worsened_fraction": round(float((worsening > CHANGE_THRESHOLD).sum()) / valid_cells, 4),
+        "improved_fraction": round(float((worsening < -CHANGE_THRESHOLD).sum()) / valid_cells, 4),
+        "worst_cells": [
+            # Cell centers in field-relative [0, 1] coordinates
+            {"x": round((c + 0.5) / GRID_SIZE, 3), "y": round((r + 0.5) / GRID_SIZE, 3),
+             "delta": round(float(delta[r, c]), 4)}
+            for r, c in zip(rows, cols) if worsening[r, c] > 0
+        ],
+    }
+
+
+def compare_zones(previous: Dict, current: Dict) -> Dict:
+    deltas = {}
+    for metric in set(previous) | set(current):
+        before, after = previous.get(metric, {}), current.get(metric, {})
+        deltas[metric] = {
+            zone: round(after.get(zone, 0) - before.get(zone, 0), 4)
+            for zone in set(before) | set(after)
+        }
+    return deltas
+
+
+def _grid_metric(analysis_type: str) -> str:
+    return "pest_density" if analysis_type == "pest_detection" else "vegetation_index"
+
+
+def _decode_grid(data: Optional[bytes]) -> Optional["np.ndarray"]:
+    import numpy as np
+    if not data:
+        return None
+    return np.frombuffer(data, dtype=np.float16).reshape(GRID_SIZE, GRID_SIZE).astype(np.float32)
+
+
+def _encode_grid(grid: Optional["np.ndarray"]) -> Optional[bytes]:
+    import numpy as np
+    return grid.astype(np.float16).tobytes() if grid is not None else None
+
+
+def _capture_times(db: Session, analyses: List) -> Dict[str, datetime]:
+    """Capture time per analysis id: the upload's EXIF time, else when the analysis was created"""
+    upload_ids = {a.id: Path(a.original_image_url).stem for a in analyses if a.original_image_url}
+    captured = dict(db.query(models.Upload.id, models.Upload.captured_at).filter(
+        models.Upload.id.in_(set(upload_ids.values()))
+    ))
+    return {a.id: captured.get(upload_ids.get(a.id)) or a.created_at or datetime.utcnow() for a in analyses}
+
+
+def _upsert_state(db: Session, values: Dict):
+    """Insert or replace a FieldState row; concurrent first inserts for a field must not collide"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        db.merge(models.FieldState(**values))
+        return
+    statement = insert(models.FieldState).values(**values)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=["field_id", "analysis_type"],
+        set_={name: statement.excluded[name] for name in values if name not in ("field_id", "analysis_type")}
+    ))
+
+
+def record_analysis(db: Session, analysis: models.Analysis) -> Optional[models.FieldChange]:
+    """Compare a completed analysis with the field's previous flight, store the delta, update the cache"""
+    if not analysis.field_id or analysis.status != "completed":
+        return None
+
+    zone_values, grid, registration = extract_state(analysis)
+    history = db.query(models.Analysis.id, models.Analysis.original_image_url, models.Analysis.created_at).filter(
+        models.Analysis.field_id == analysis.field_id,
+        models.Analysis.analysis_type == analysis.analysis_type,
+        models.Analysis.status == "completed",
+        models.Analysis.id != analysis.id
+    ).all()
+    captured = _capture_times(db, history + [analysis])
+    earlier = [row.id for row in history if captured[row.id].date() < captured[analysis.id].date()]
+    previous_id = max(earlier, key=captured.get, default=None)
+    state = db.query(models.FieldState).filter(
+        models.FieldState.field_id == analysis.field_id,
+        models.FieldState.analysis_type == analysis.analysis_type
+    ).first()
+
+    change = None
+    if previous_id is not None:
+        if state is not None and state.analysis_id == previous_id:
+            previous_values = state.zone_values or {}
+            previous_grid = _decode_grid(state.grid)
+            previous_registration = _decode_grid(state.registration_grid)
+        else:
+            # Flights finished out of order: the cache holds a later one
+            previous_values, previous_grid, previous_registration = extract_state(db.get(models.Analysis, previous_id))
+        grid_summary = None
+        if previous_grid is not None and grid is not None:
+            shift = (0, 0)
+            if previous_registration is not None and registration is not None:
+                shift = estimate_shift(previous_registration, registration)
+            grid_summary = compare_grids(previous_grid, grid, _grid_metric(analysis.analysis_type), shift)
+        change = models.FieldChange(
+            field_id=analysis.field_id,
+            analysis_type=analysis.analysis_type,
+            analysis_id=analysis.id,
+            previous_analysis_id=previous_id,
+            zone_deltas=compare_zones(previous_values, zone_values),
+            grid_summary=grid_summary
+        )
+        db.add(change)
+
+    cached_at = captured.get(state.analysis_id) if state is not None else None
+    if cached_at is None or cached_at <= captured[analysis.id]:
+        _upsert_state(db, {
+            "field_id": analysis.field_id,
+            "analysis_type": analysis.analysis_type,
+            "analysis_id": analysis.id,
+            "zone_values": zone_values,
+            "grid": _encode_grid(grid),
+            "registration_grid": _encode_grid(registration),
+            "updated_at": datetime.utcnow(),
+        })
+    db.commit()
+    return change
@@ -24,6 +24,90 @@ class Settings(BaseSettings):
     UPLOAD_DIR: str = os.getenv("UPLOAD_DIR", "./uploads")
     MAX_UPLOAD_SIZE: int = int(os.getenv("MAX_UPLOAD_SIZE", "524288000"))  # 500MB
     
+    # Storage for uploads and tile pyramids: "local" (UPLOAD_DIR) or "s3" (any S3-compatible store)
+    STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "local")
+    S3_BUCKET: str = os.getenv("S3_BUCKET", "agriscan")
+    S3_ENDPOINT_URL: str = os.getenv("S3_ENDPOINT_URL", "")  # e.g. http://minio:9000
+    S3_REGION: str = os.getenv("S3_REGION", "")
+    S3_ACCESS_KEY_ID: str = os.getenv("S3_ACCESS_KEY_ID", "")  # empty = default AWS credential chain
+    S3_SECRET_ACCESS_KEY: str = os.getenv("S3_SECRET_ACCESS_KEY", "")
+    PRESIGNED_URL_TTL_SECONDS: int = int(os.getenv("PRESIGNED_URL_TTL_SECONDS", "3600"))
+    STORAGE_CACHE_DIR: str = os.getenv("STORAGE_CACHE_DIR", "./cache/storage")
+    STORAGE_CACHE_MAX_BYTES: int = int(os.getenv("STORAGE_CACHE_MAX_BYTES", "10737418240"))  # 10GB per worker
+    
+    # Decoded pixels of uploads as memory-mapped .npy files, shared by every worker on a host
+    RASTER_CACHE_DIR: str = os.getenv("RASTER_CACHE_DIR", "")  # empty = <UPLOAD_DIR>/.rasters (or next to the storage cache)
+    RASTER_CACHE_MAX_BYTES: int = int(os.getenv("RASTER_CACHE_MAX_BYTES", "4294967296"))  # 4GB
+    
+    # Header-only upload validation; larger decoded sizes take the tiled processing path
+    MAX_IMAGE_PIXELS: int = int(os.getenv("MAX_IMAGE_PIXELS", "1000000000"))  # 1 gigapixel
+    IN_MEMORY_MAX_BYTES: int = int(os.getenv("IN_MEMORY_MAX_BYTES", "536870912"))  # 512MB decoded
+    
+    # Startup: import model modules in a background thread once the app is up
+    WARMUP_ON_STARTUP: bool = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+    
+    # Inference: "mock" or "onnxruntime"; models are read from MODEL_DIR
+    INFERENCE_BACKEND: str = os.getenv("INFERENCE_BACKEND", "mock")
+    MODEL_DIR: str = os.getenv("MODEL_DIR", "./models")
+    MODEL_PRECISION: str = os.getenv("MODEL_PRECISION", "fp32")  # fp32, fp16, int8
+    ORT_INTRA_OP_THREADS: int = int(os.getenv("ORT_INTRA_OP_THREADS", "0"))  # 0 = runtime default
+    ORT_INTER_OP_THREADS: int = int(os.getenv("ORT_INTER_OP_THREADS", "0"))
+    
+    # Pre-serialized responses of completed/failed analyses
+    PAYLOAD_CACHE_MAX_BYTES: int = int(os.getenv("PAYLOAD_CACHE_MAX_BYTES", "134217728"))  # 128MB
+    
+    # Admission control for uploads and analysis submissions
+    ADMISSION_ENABLED: bool = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory (per worker) or redis
+    RATE_LIMIT_REDIS_URL: str = os.getenv("RATE_LIMIT_REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+    UPLOAD_RATE_PER_MINUTE: float = float(os.getenv("UPLOAD_RATE_PER_MINUTE", "60"))
+    UPLOAD_BURST: int = int(os.getenv("UPLOAD_BURST", "20"))
+    ANALYSIS_RATE_PER_MINUTE: float = float(os.getenv("ANALYSIS_RATE_PER_MINUTE", "120"))
+    ANALYSIS_BURST: int = int(os.getenv("ANALYSIS_BURST", "30"))
+    MAX_CONCURRENT_UPLOADS: int = int(os.getenv("MAX_CONCURRENT_UPLOADS", "32"))  # per worker
+    MAX_INFLIGHT_ANALYSES_PER_CLIENT: int = int(os.getenv("MAX_INFLIGHT_ANALYSES_PER_CLIENT", "50"))
+    # Without Celery, queued analyses run in this process and each holds a DB connection (depth is per worker)
+    MAX_QUEUE_DEPTH: int = int(os.getenv("MAX_QUEUE_DEPTH", "1000" if os.getenv("USE_CELERY", "false").lower() == "true" else "10"))
+    MAX_QUEUE_AGE_SECONDS: float = float(os.getenv("MAX_QUEUE_AGE_SECONDS", "300"))
+    
+    # Production serving (serve.py): workers forked from a master that preloads models
+    SERVE_HOST: str = os.getenv("SERVE_HOST", "0.0.0.0")
+    SERVE_PORT: int = int(os.getenv("SERVE_PORT", "8000"))
+    SERVE_WORKERS: int = int(os.getenv("SERVE_WORKERS", "0"))  # 0 = one per CPU
+    SERVE_THREADS_PER_WORKER: int = int(os.getenv("SERVE_THREADS_PER_WORKER", "1"))  # BLAS/ONNX Runtime threads
+    SERVE_THREADPOOL_SIZE: int = int(os.getenv("SERVE_THREADPOOL_SIZE", "40"))  # sync endpoints per worker
+    
+    # Compact tiled rasters written after upload (app.rasters): cog (needs tifffile), webp or off
+    TRANSCODE_FORMAT: str = os.getenv("TRANSCODE_FORMAT", "cog")
+    TRANSCODE_TILE_SIZE: int = int(os.getenv("TRANSCODE_TILE_SIZE", "256"))
+    TRANSCODE_COMPRESSION_LEVEL: int = int(os.getenv("TRANSCODE_COMPRESSION_LEVEL", "6"))  # deflate 1-9
+    KEEP_ORIGINAL_DAYS: int = int(os.getenv("KEEP_ORIGINAL_DAYS", "-1"))  # -1 = forever, 0 = delete once transcoded
+    
+    # Variable-rate prescription maps (app.prescriptions)
+    PRESCRIPTION_ZONES: int = int(os.getenv("PRESCRIPTION_ZONES", "4"))  # management zones per field
+    PRESCRIPTION_CELL_METERS: float = float(os.getenv("PRESCRIPTION_CELL_METERS", "10"))  # grid cell (~boom width)
+    PRESCRIPTION_MAX_SIDE: int = int(os.getenv("PRESCRIPTION_MAX_SIDE", "2048"))  # imagery level used for zoning
+    
+    # Alert rules on analysis results (app.alerts)
+    ALERTS_ENABLED: bool = os.getenv("ALERTS_ENABLED", "true").lower() == "true"
+    ALERT_THROTTLE_SECONDS: int = int(os.getenv("ALERT_THROTTLE_SECONDS", "3600"))  # per rule and field; rules may override
+    ALERT_WEBHOOK_TIMEOUT_SECONDS: float = float(os.getenv("ALERT_WEBHOOK_TIMEOUT_SECONDS", "5"))
+    ALERT_MAX_ATTEMPTS: int = int(os.getenv("ALERT_MAX_ATTEMPTS", "3"))
+    ALERT_DELIVERY_THREADS: int = int(os.getenv("ALERT_DELIVERY_THREADS", "4"))  # concurrent webhook deliveries
+    ALERT_SWEEP_SECONDS: float = float(os.getenv("ALERT_SWEEP_SECONDS", "15"))  # resubmits pending and retried alerts
+    
+    # Edge-to-central replication (app.replication): edges push SQLite changes to the central API
+    REPLICATION_ROLE: str = os.getenv("REPLICATION_ROLE", "off")  # off, edge or central
+    REPLICATION_EDGE_ID: str = os.getenv("REPLICATION_EDGE_ID", "")  # empty = hostname
+    REPLICATION_CENTRAL_URL: str = os.getenv("REPLICATION_CENTRAL_URL", "http://localhost:8000")
+    REPLICATION_TOKEN: str = os.getenv("REPLICATION_TOKEN", "")  # shared secret; central refuses batches without one
+    REPLICATION_MAX_BATCH_BYTES: int = int(os.getenv("REPLICATION_MAX_BATCH_BYTES", str(256 * 1024 * 1024)))  # decompressed
+    REPLICATION_BATCH_SIZE: int = int(os.getenv("REPLICATION_BATCH_SIZE", "500"))  # change log entries per batch
+    REPLICATION_INTERVAL_SECONDS: float = float(os.getenv("REPLICATION_INTERVAL_SECONDS", "60"))
+    
+    # Map tiles
+    TILE_CACHE_MAX_BYTES: int = int(os.getenv("TILE_CACHE_MAX_BYTES", "67108864"))  # 64MB of hot tiles
+    
     class Config:
         case_sensitive = True
 
@@ -0,0 +1,173 @@
+"""
+Array-backed pest detections.
+
+Detector output is held as one NumPy structured array (class id, float32
+confidence, int32 x/y/width/height, zone id) plus small label tables for pest
+types and zones, instead of a dict (with a nested bbox dict and its own label
+strings) per detection. Filtering, per-class/zone counts, risk level and
+box painting are vectorized. Results are persisted in the columnar form
+(to_columnar(), parallel lists); the per-detection JSON shape
+({"pest_type", "confidence", "bbox": {...}, "zone"}) is only built when a
+response asks for it (app.serialization.results_for).
+"""
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+DTYPE = np.dtype([
+    ("class_id", np.uint16),
+    ("confidence", np.float32),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("width", np.int32),
+    ("height", np.int32),
+    ("zone_id", np.uint16),
+])
+
+
+def _labels(ids: np.ndarray, table: Sequence[str]) -> List[str]:
+    # Ids past the table (e.g. a model with more classes than we have names for) keep their number
+    return [table[i] if i < len(table) else str(i) for i in ids.tolist()]
+
+
+class Detections:
+    __slots__ = ("data", "classes", "zones")
+
+    def __init__(self, data: np.ndarray, classes: Sequence[str], zones: Sequence[str]):
+        self.data = data
+        self.classes = tuple(classes)
+        self.zones = tuple(zones)
+
+    @classmethod
+    def empty(cls, classes: Sequence[str] = (), zones: Sequence[str] = ()) -> "Detections":
+        return cls(np.zeros(0, dtype=DTYPE), classes, zones)
+
+    @classmethod
+    def from_arrays(cls, class_ids, confidences, boxes, zone_ids,
+                    classes: Sequence[str], zones: Sequence[str]) -> "Detections":
+        """boxes is (N, 4) x, y, width, height in source pixels"""
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        data = np.empty(len(boxes), dtype=DTYPE)
+        data["class_id"] = class_ids
+        data["confidence"] = confidences
+        data["x"], data["y"], data["width"], data["height"] = boxes.T
+        data["zone_id"] = zone_ids
+        return cls(data, classes, zones)
+
+    @classmethod
+    def from_records(cls, records: List[Dict]) -> "Detections":
+        """Parse stored results_json["pests"] (labels are interned as they are seen)"""
+        classes: Dict[str, int] = {}
+        zones: Dict[str, int] = {}
+        class_ids, confidences, boxes, zone_ids = [], [], [], []
+        for record in records:
+            bbox = record.get("bbox") or {}
+            class_ids.append(classes.setdefault(record.get("pest_type"), len(classes)))
+            confidences.append(record.get("confidence", 1.0))
+            boxes.append((bbox.get("x", 0), bbox.get("y", 0), bbox.get("width", 0), bbox.get("height", 0)))
+            zone_ids.append(zones.setdefault(record.get("zone", "field"), len(zones)))
+        return cls.from_arrays(class_ids, confidences, boxes, zone_ids, list(classes), list(zones))
+
+    @classmethod
+    def from_columnar(cls, columns: Dict[str, List]) -> "Detections":
+        """Parse stored columnar results_json["pests"] (as to_columnar() writes it)"""
+        classes, class_ids = np.unique(np.asarray(columns["pest_type"], dtype=str), return_inverse=True)
+        zones, zone_ids = np.unique(np.asarray(columns["zone"], dtype=str), return_inverse=True)
+        boxes = np.column_stack([columns["x"], columns["y"], columns["width"], columns["height"]])
+        return cls.from_arrays(class_ids, columns["confidence"], boxes, zone_ids, classes.tolist(), zones.tolist())
+
+    @classmethod
+    def coerce(cls, detections) -> "Detections":
+        """A Detections, stored columnar pests or a list of detection dicts"""
+        if isinstance(detections, cls):
+            return detections
+        if isinstance(detections, dict):
+            return cls.from_columnar(detections)
+        return cls.from_records(detections)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def _select(self, mask) -> "Detections":
+        return Detections(self.data[mask], self.classes, self.zones)
+
+    def filter(self, min_confidence: float) -> "Detections":
+        return self._select(self.data["confidence"] >= min_confidence)
+
+    def scaled(self, scale: float) -> "Detections":
+        """Boxes mapped to an image resized by scale"""
+        data = self.data.copy()
+        for name in ("x", "y", "width", "height"):
+            data[name] = np.round(data[name] * scale)
+        return Detections(data, self.classes, self.zones)
+
+    def _counts(self, ids: np.ndarray, table: Sequence[str]) -> Dict[str, int]:
+        counts = np.bincount(ids, minlength=len(table))
+        ids = np.flatnonzero(counts)
+        return dict(zip(_labels(ids, table), counts[ids].tolist()))
+
+    def counts_by_class(self) -> Dict[str, int]:
+        return self._counts(self.data["class_id"], self.classes)
+
+    def counts_by_zone(self) -> Dict[str, int]:
+        return self._counts(self.data["zone_id"], self.zones)
+
+    def risk_level(self) -> str:
+        from app.recommendations import pest_risk_level
+
+        return pest_risk_level(len(self))
+
+    def box_area(self) -> int:
+        return int((self.data["width"].astype(np.int64) * self.data["height"]).sum())
+
+    def extent(self) -> tuple:
+        """(width, height) of the smallest frame containing every box"""
+        if not len(self):
+            return 0, 0
+        return (int((self.data["x"] + self.data["width"]).max()),
+                int((self.data["y"] + self.data["height"]).max()))
+
+    def paint(self, shape, scale_x: float, scale_y: float) -> np.ndarray:
+        """
+        Sum of confidences of the boxes covering each cell of a (rows, cols)
+        grid, with box coordinates scaled by scale_x/scale_y. Every box covers
+        at least one cell. Uses a 2D difference array, so cost is one pass
+        over the grid regardless of box sizes.
+        """
+        rows, cols = shape
+        data = self.data
+        x0 = np.clip((data["x"] * scale_x).astype(np.int64), 0, cols)
+        y0 = np.clip((data["y"] * scale_y).astype(np.int64), 0, rows)
+        x1 = np.clip(np.maximum(x0 + 1, ((data["x"] + data["width"]) * scale_x).astype(np.int64)), 0, cols)
+        y1 = np.clip(np.maximum(y0 + 1, ((data["y"] + data["height"]) * scale_y).astype(np.int64)), 0, rows)
+        values = data["confidence"].astype(np.float64)
+        diff = np.zeros((rows + 1, cols + 1), dtype=np.float64)
+        np.add.at(diff, (y0, x0), values)
+        np.add.at(diff, (y0, x1), -values)
+        np.add.at(diff, (y1, x0), -values)
+        np.add.at(diff, (y1, x1), values)
+        grid = diff.cumsum(axis=0).cumsum(axis=1)[:rows, :cols]
+        # Cells outside every box can come out as tiny negative rounding residue
+        return np.maximum(grid, 0).astype(np.float32)
+
+    def to_records(self) -> List[Dict]:
+        """The API's row shape: one dict per detection"""
+        from app.serialization import to_records
+
+        return to_records(self.to_columnar())
+
+    # Lets serialization.dumps() encode a Detections wherever it appears in a payload
+    tolist = to_records
+
+    def to_columnar(self) -> Dict[str, List]:
+        """Parallel arrays, as serialization.to_columnar() produces"""
+        data = self.data
+        return {
+            "pest_type": _labels(data["class_id"], self.classes),
+            "confidence": np.round(data["confidence"].astype(np.float64), 2).tolist(),
+            "x": data["x"].tolist(),
+            "y": data["y"].tolist(),
+            "width": data["width"].tolist(),
+            "height": data["height"].tolist(),
+            "zone": _labels(data["zone_id"], self.zones),
+        }
@@ -0,0 +1,237 @@
+"""
+Streaming export of analyses and flattened pest detections.
+
+Rows are read with server-side cursors (yield_per) and encoded batch by batch,
+so memory stays flat regardless of row count and the first bytes go out as
+soon as the first batch is read. Formats: ndjson, csv, parquet (parquet needs
+pyarrow; one row group per batch).
+"""
+import csv
+import io
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from app import metrics, models, serialization
+from app.database import SessionLocal
+
+BATCH_SIZE = 2000
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+ANALYSIS_COLUMNS = [
+    "id", "field_id", "analysis_type", "status", "original_image_url",
+    "confidence_score", "processing_time_seconds", "created_at", "results_json",
+]
+DETECTION_COLUMNS = [
+    "analysis_id", "field_id", "created_at", "pest_type", "confidence",
+    "x", "y", "width", "height", "zone",
+]
+
+
+def _filtered(query, column_owner, field_id, start, end, analysis_type=None):
+    if field_id:
+        query = query.filter(column_owner.field_id == field_id)
+    if start:
+        query = query.filter(column_owner.created_at >= start)
+    if end:
+        query = query.filter(column_owner.created_at < end)
+    if analysis_type:
+        query = query.filter(column_owner.analysis_type == analysis_type)
+    return query
+
+
+def iter_analysis_batches(field_id: Optional[str] = None, start: Optional[datetime] = None,
+                          end: Optional[datetime] = None, analysis_type: Optional[str] = None,
+                          batch_size: int = BATCH_SIZE) -> Iterator[List[Dict]]:
+    db = SessionLocal()
+    try:
+        columns = [getattr(models.Analysis, name) for name in ANALYSIS_COLUMNS]
+        query = _filtered(db.query(*columns), models.Analysis, field_id, start, end, analysis_type)
+        query = query.order_by(models.Analysis.created_at).execution_options(stream_results=True).yield_per(batch_size)
+        batch = []
+        for row in query:
+            data = dict(zip(ANALYSIS_COLUMNS, row))
+            # Same shape as GET /api/analysis/{id}: one dict per detection
+            data["results_json"] = serialization.results_for(data["results_json"])
+            batch.append(data)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        db.close()
+
+
+def _detection_rows(results: Optional[Dict]) -> Iterator[tuple]:
+    """(pest_type, confidence, x, y, width, height, zone) per detection, from either stored layout"""
+    pests = (results or {}).get("pests") or []
+    if isinstance(pests, dict):
+        return zip(pests["pest_type"], pests["confidence"], pests["x"], pests["y"],
+                   pests["width"], pests["height"], pests["zone"])
+    return ((pest.get("pest_type"), pest.get("confidence"), *(
+        (pest.get("bbox") or {}).get(key) for key in ("x", "y", "width", "height")), pest.get("zone"))
+        for pest in pests)
+
+
+def iter_detection_batches(field_id: Optional[str] = None, start: Optional[datetime] = None,
+                           end: Optional[datetime] = None,
+                           batch_size: int = BATCH_SIZE) -> Iterator[List[Dict]]:
+    """One row per detection of every completed pest analysis"""
+    db = SessionLocal()
+    try:
+        query = db.query(
+            models.Analysis.id, models.Analysis.field_id, models.Analysis.created_at, models.Analysis.results_json
+        ).filter(
+            models.Analysis.analysis_type == "pest_detection",
+            models.Analysis.status == "completed"
+        )
+        query = _filtered(query, models.Analysis, field_id, start, end)
+        # Detections fan out ~1000x per analysis, so fetch analyses in small batches
+        query = query.order_by(models.Analysis.created_at).execution_options(stream_results=True) \
+            .yield_per(max(1, batch_size // 100))
+        batch = []
+        for analysis_id, analysis_field_id, created_at, results in query:
+            for pest_type, confidence, x, y, width, height, zone in _detection_rows(results):
+                batch.append({
+                    "analysis_id": analysis_id,
+                    "field_id": analysis_field_id,
+                    "created_at": created_at,
+                    "pest_type": pest_type,
+                    "confidence": confidence,
+                    "x": x,
+                    "y": y,
+                    "width": width,
+                    "height": height,
+                    "zone": zone,
+                })
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+    finally:
+        db.close()
+
+
+# ---------------------------------------------------------------------------
+# Encoders: batches of dicts -> byte chunks
+# ---------------------------------------------------------------------------
+
+def encode_ndjson(batches: Iterator[List[Dict]], columns: List[str]) -> Iterator[bytes]:
+    for batch in batches:
+        yield b"".join(serialization.dumps(row) + b"\n" for row in batch)
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return serialization.dumps(value).decode()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def encode_csv(batches: Iterator[List[Dict]], columns: List[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows([_csv_value(row[column]) for column in columns] for row in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose written bytes are drained after each row group"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# Parquet column types; anything not listed is a string
+PARQUET_TYPES = {
+    "confidence_score": "float64", "processing_time_seconds": "float64", "confidence": "float64",
+    "x": "int64", "y": "int64", "width": "int64", "height": "int64",
+    "created_at": "timestamp",
+}
+
+
+def _parquet_schema(columns: List[str]):
+    import pyarrow as pa
+
+    types = {"float64": pa.float64(), "int64": pa.int64(), "timestamp": pa.timestamp("us")}
+    return pa.schema([(column, types.get(PARQUET_TYPES.get(column), pa.string())) for column in columns])
+
+
+def encode_parquet(batches: Iterator[List[Dict]], columns: List[str]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Fixed schema: inferring from the first batch breaks when a column is all null there
+    schema = _parquet_schema(columns)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for batch in batches:
+            data = {column: [row[column] for row in batch] for column in columns}
+            if "results_json" in data:
+                data["results_json"] = [serialization.dumps(v).decode() if v is not None else None
+                                        for v in data["results_json"]]
+            writer.write_table(pa.table(data, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    "ndjson": encode_ndjson,
+    "csv": encode_csv,
+    "parquet": encode_parquet,
+}
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def stream(kind: str, fmt: str, **filters) -> Iterator[bytes]:
+    """Encoded byte chunks for kind ("analyses" or "detections") in fmt"""
+    if kind == "analyses":
+        batches, columns = iter_analysis_batches(**filters), ANALYSIS_COLUMNS
+    else:
+        batches, columns = iter_detection_batches(**filters), DETECTION_COLUMNS
+    sent = 0
+    for chunk in ENCODERS[fmt](batches, columns):
+        if chunk:
+            sent += len(chunk)
+            yield chunk
+    metrics.incr("export", f"{kind}_exports")
+    metrics.incr("export", "bytes", sent)
@@ -0,0 +1,243 @@
+"""
+Incremental per-field yield forecasting.
+
+Every field keeps a small state row (FieldForecast): a fixed-length feature
+vector and a short history of predictions; planting date and crop are read
+from Field at forecast time. Each completed analysis folds its result into
+that vector with an exponential moving average (observe()), so nothing is
+recomputed from past analyses.
+
+Forecasts for many fields are computed in one vectorized NumPy pass over the
+stacked feature matrix (forecast_matrix()). Nightly re-forecast:
+
+    python -m app.forecasting                 # every field
+    python -m app.forecasting --user-id <id>  # one farm
+
+numpy is imported inside the functions that use it: app.main imports this
+module, and observe() runs on every completed analysis without it.
+"""
+import argparse
+import time
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app import models
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Feature vector layout
+FEATURES = ["vegetation_index", "health_score", "pest_pressure", "model_yield", "historical_yield", "observations"]
+VEGETATION, HEALTH, PEST, MODEL_YIELD, HISTORICAL, OBSERVATIONS = range(len(FEATURES))
+DEFAULT_FEATURES = [0.5, 75.0, 5.0, 0.0, 0.0, 0.0]
+
+# Weight of a new observation in the moving average
+EWMA_ALPHA = 0.4
+HISTORY_LENGTH = 20
+
+# Growing season length (days) and typical yield (tons/ha) per crop
+CROP_SEASON_DAYS = {
+    "Wheat": 120, "Corn": 110, "Rice": 130, "Soybean": 100, "Cotton": 160,
+    "Potato": 100, "Tomato": 90, "Carrot": 75, "Lettuce": 60, "Cabbage": 90,
+}
+CROP_BASE_YIELD = {
+    "Wheat": 3.5, "Corn": 6.0, "Rice": 4.5, "Soybean": 2.8, "Cotton": 2.0,
+    "Potato": 20.0, "Tomato": 35.0, "Carrot": 30.0, "Lettuce": 25.0, "Cabbage": 40.0,
+}
+DEFAULT_SEASON_DAYS = 120
+DEFAULT_BASE_YIELD = 4.0
+
+
+def season_days(crop_type: Optional[str]) -> int:
+    return CROP_SEASON_DAYS.get(crop_type, DEFAULT_SEASON_DAYS)
+
+
+def maturity_curve(days_since_planting: "np.ndarray", season: "np.ndarray") -> "np.ndarray":
+    """Logistic maturity (0-100) with the midpoint at half the season"""
+    import numpy as np
+    progress = days_since_planting / np.maximum(season, 1)
+    return 100.0 / (1.0 + np.exp(-10.0 * (progress - 0.5)))
+
+
+def growth_schedule(planting_date: Optional[datetime], crop_type: Optional[str],
+                    now: Optional[datetime] = None, weeks: int = 4) -> Dict:
+    """days_to_harvest and the next weeks' maturity, from the real planting date"""
+    import numpy as np
+    if planting_date is None:
+        return {}
+    now = now or datetime.utcnow()
+    season = season_days(crop_type)
+    elapsed = (now - planting_date).days
+    days = elapsed + 7 * np.arange(1, weeks + 1)
+    maturity = maturity_curve(days.astype(np.float64), np.full(weeks, season))
+    return {
+        "days_to_harvest": max(0, season - elapsed),
+        "growth_stages": [
+            {"week": int(week), "maturity": int(round(value))}
+            for week, value in zip(range(1, weeks + 1), maturity)
+        ],
+    }
+
+
+def forecast_matrix(features: "np.ndarray", days_since_planting: "np.ndarray",
+                    season: "np.ndarray", base_yield: "np.ndarray") -> Dict[str, "np.ndarray"]:
+    """
+    Vectorized forecast for N fields.
+
+    Args:
+        features: (N, len(FEATURES)) feature matrix
+        days_since_planting: (N,) days, NaN when the planting date is unknown
+        season: (N,) season length in days
+        base_yield: (N,) typical crop yield in tons/ha
+
+    Returns:
+        Dict of (N,) arrays: predicted_yield, days_to_harvest, maturity
+    """
+    import numpy as np
+    vegetation = np.clip(features[:, VEGETATION], 0.0, 1.0)
+    health = np.clip(features[:, HEALTH], 0.0, 100.0) / 100.0
+    pest = np.clip(features[:, PEST], 0.0, 100.0) / 100.0
+    model_yield = features[:, MODEL_YIELD]
+    historical = features[:, HISTORICAL]
+    observations = features[:, OBSERVATIONS]
+
+    # Agronomic prior: last season (or the crop norm) scaled by current crop condition
+    reference = np.where(historical > 0, historical, base_yield)
+    prior = reference * (0.6 + 0.8 * vegetation) * np.sqrt(health) * (1.0 - 0.5 * pest)
+
+    # Trust the image model more as observations accumulate
+    model_weight = np.where(model_yield > 0, observations / (observations + 2.0), 0.0)
+    predicted = model_weight * model_yield + (1.0 - model_weight) * prior
+
+    known = ~np.isnan(days_since_planting)
+    elapsed = np.where(known, days_since_planting, season / 2)
+    return {
+        "predicted_yield": np.round(predicted, 2),
+        "days_to_harvest": np.where(known, np.maximum(season - elapsed, 0), np.nan),
+        "maturity": np.round(maturity_curve(elapsed, season), 1),
+    }
+
+
+def _state_for(db: Session, field_id: str) -> models.FieldForecast:
+    state = db.query(models.FieldForecast).filter(models.FieldForecast.field_id == field_id).first()
+    if state is None:
+        state = models.FieldForecast(
+            field_id=field_id,
+            features=list(DEFAULT_FEATURES),
+            history=[],
+        )
+        db.add(state)
+    return state
+
+
+def _blend(features: List[float], index: int, value: Optional[float]):
+    if value is None:
+        return
+    seen = features[OBSERVATIONS] > 0
+    features[index] = value if not seen else (1 - EWMA_ALPHA) * features[index] + EWMA_ALPHA * value
+
+
+def set_historical_yield(db: Session, field_id: str, historical_yield: float):
+    state = _state_for(db, field_id)
+    features = list(state.features)
+    features[HISTORICAL] = historical_yield
+    state.features = features
+    db.commit()
+
+
+def observe(db: Session, analysis: models.Analysis):
+    """Fold one completed analysis into its field's feature vector"""
+    if not analysis.field_id or not analysis.results_json:
+        return
+    results = analysis.results_json
+    state = _state_for(db, analysis.field_id)
+    features = list(state.features or DEFAULT_FEATURES)
+
+    if analysis.analysis_type == "nutrient_mapping":
+        _blend(features, HEALTH, results.get("overall_health_score"))
+        ndvi = (results.get("vegetation_indices") or {}).get("ndvi")
+        _blend(features, VEGETATION, ndvi)
+    elif analysis.analysis_type == "pest_detection":
+        _blend(features, PEST, results.get("affected_area_percentage"))
+    elif analysis.analysis_type == "yield_prediction":
+        predicted = results.get("predicted_yield_tons_per_hectare")
+        _blend(features, MODEL_YIELD, predicted)
+        history = list(state.history or [])
+        history.append({"date": datetime.utcnow().isoformat(), "predicted_yield": predicted})
+        state.history = history[-HISTORY_LENGTH:]
+
+    features[OBSERVATIONS] += 1
+    state.features = features
+    db.commit()
+
+
+def forecast_fields(db: Session, field_ids: Optional[Iterable[str]] = None,
+                    user_id: Optional[str] = None, now: Optional[datetime] = None) -> Dict[str, Dict]:
+    """Re-forecast many fields in one pass and store the results on their state rows"""
+    import numpy as np
+    now = now or datetime.utcnow()
+    query = db.query(
+        models.FieldForecast.field_id,
+        models.FieldForecast.features,
+        models.Field.planting_date,
+        models.Field.crop_type,
+    ).outerjoin(models.Field, models.Field.id == models.FieldForecast.field_id)
+    if field_ids is not None:
+        query = query.filter(models.FieldForecast.field_id.in_(list(field_ids)))
+    if user_id is not None:
+        query = query.filter(models.Field.user_id == user_id)
+    rows = query.all()
+    if not rows:
+        return {}
+
+    ids = [row.field_id for row in rows]
+    features = np.array([row.features or DEFAULT_FEATURES for row in rows], dtype=np.float64)
+    days = np.array([
+        (now - row.planting_date).days if row.planting_date else np.nan for row in rows
+    ], dtype=np.float64)
+    season = np.array([season_days(row.crop_type) for row in rows], dtype=np.float64)
+    base = np.array([CROP_BASE_YIELD.get(row.crop_type, DEFAULT_BASE_YIELD) for row in rows], dtype=np.float64)
+
+    forecast = forecast_matrix(features, days, season, base)
+
+    results = {}
+    updates = []
+    for i, field_id in enumerate(ids):
+        days_to_harvest = forecast["days_to_harvest"][i]
+        results[field_id] = {
+            "predicted_yield_tons_per_hectare": float(forecast["predicted_yield"][i]),
+            "days_to_harvest": None if np.isnan(days_to_harvest) else int(days_to_harvest),
+            "maturity": float(forecast["maturity"][i]),
+        }
+        updates.append({
+            "field_id": field_id,
+            "forecast_yield": results[field_id]["predicted_yield_tons_per_hectare"],
+            "forecast_days_to_harvest": results[field_id]["days_to_harvest"],
+            "forecast_at": now,
+        })
+    db.bulk_update_mappings(models.FieldForecast, updates)
+    db.commit()
+    return results
+
+
+def main():
+    from app.database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(prog="python -m app.forecasting", description="Re-forecast field yields")
+    parser.add_argument("--user-id", default=None, help="only fields owned by this user")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        results = forecast_fields(db, user_id=args.user_id)
+        print(f"✓ Forecast {len(results)} fields in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
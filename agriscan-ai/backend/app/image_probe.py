@@ -0,0 +1,277 @@
+"""
+Header-only image validation.
+
+Uploads are identified by their magic bytes (never the client's content type),
+and dimensions, band count, bit depth and TIFF tiling/compression are read
+from the file headers without decoding any pixels. Truncated files are caught
+by checking that the data the headers point at is actually present.
+
+The probe also decides how an image is processed downstream:
+  - in_memory: small enough to decode whole
+  - tiled:     decoded size exceeds IN_MEMORY_MAX_BYTES; tile builds and
+               analyses run one at a time (tiles.large_image_lane) and reads
+               never decode more than IN_MEMORY_MAX_BYTES (rasters.read_region,
+               raster_cache.load)
+Only images that can be read at reduced scale may be "tiled": JPEGs (decoded
+at a smaller scale) and grey/RGB TIFFs that tifffile reads without
+imagecodecs (read strip by strip or tile by tile). Other formats would have
+to be decoded whole, so probe() refuses them above IN_MEMORY_MAX_BYTES.
+"""
+import struct
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional
+
+from app.config import settings
+
+FORMATS = {
+    "jpeg": ("image/jpeg", ".jpg"),
+    "png": ("image/png", ".png"),
+    "tiff": ("image/tiff", ".tif"),
+}
+SNIFF_BYTES = 16
+# How far from the end a JPEG's EOI marker may sit (some cameras append padding)
+JPEG_TAIL_BYTES = 4096
+
+TIFF_COMPRESSION = {
+    1: "none", 2: "ccitt_rle", 3: "ccitt_g3", 4: "ccitt_g4", 5: "lzw", 6: "ojpeg", 7: "jpeg",
+    8: "deflate", 32773: "packbits", 32946: "deflate", 34887: "lerc", 50000: "zstd", 50001: "webp",
+}
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# Photometric interpretations rasters.read_tiff reads (the rest are decoded with PIL)
+TIFF_PHOTOMETRIC = {0: "miniswhite", 1: "minisblack", 2: "rgb", 3: "palette", 5: "separated", 6: "ycbcr"}
+STRIDED_PHOTOMETRIC = ("minisblack", "rgb")
+
+_pil_limit_lock = threading.Lock()
+
+
+class InvalidImage(Exception):
+    pass
+
+
+@dataclass
+class ImageInfo:
+    image_format: str
+    width: int
+    height: int
+    bands: int
+    bit_depth: int
+    tiled: bool = False
+    compression: Optional[str] = None
+    photometric: Optional[str] = None  # TIFF only; not stored
+
+    @property
+    def content_type(self) -> str:
+        return FORMATS[self.image_format][0]
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.image_format][1]
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+    @property
+    def decoded_bytes(self) -> int:
+        return self.pixels * self.bands * max(1, (self.bit_depth + 7) // 8)
+
+    @property
+    def processing_mode(self) -> str:
+        return "tiled" if self.decoded_bytes > settings.IN_MEMORY_MAX_BYTES else "in_memory"
+
+    def columns(self) -> Dict:
+        """Values for the matching models.Upload columns"""
+        columns = asdict(self)
+        del columns["photometric"]
+        return {**columns, "processing_mode": self.processing_mode}
+
+    @property
+    def reads_reduced(self) -> bool:
+        """Whether this image can be read at reduced scale without decoding it whole"""
+        if self.image_format == "jpeg":
+            return True
+        if self.image_format != "tiff" or self.photometric not in STRIDED_PHOTOMETRIC:
+            return False
+        from app import rasters
+        return rasters.can_read_tiff(self.compression)
+
+
+def sniff(head: bytes) -> Optional[str]:
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+        return "tiff"
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Format readers (headers only)
+# ---------------------------------------------------------------------------
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise InvalidImage("truncated header")
+    return data
+
+
+def _probe_jpeg(f: BinaryIO, file_size: int) -> ImageInfo:
+    f.seek(2)
+    while True:
+        marker = _read_exact(f, 2)
+        if marker[0] != 0xFF:
+            raise InvalidImage("corrupt JPEG marker stream")
+        code = marker[1]
+        if code == 0xFF:
+            f.seek(-1, 1)  # fill byte
+            continue
+        if code in (0x01, *range(0xD0, 0xD8)):
+            continue  # standalone markers
+        if code in (0xD9, 0xDA):
+            raise InvalidImage("JPEG has no frame header")
+        (length,) = struct.unpack(">H", _read_exact(f, 2))
+        # SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            precision, height, width, components = struct.unpack(">BHHB", _read_exact(f, 6))
+            break
+        f.seek(length - 2, 1)
+
+    f.seek(max(0, file_size - JPEG_TAIL_BYTES))
+    if b"\xff\xd9" not in f.read():
+        raise InvalidImage("truncated JPEG (no end-of-image marker)")
+    return ImageInfo("jpeg", width, height, components, precision, compression="jpeg")
+
+
+def _probe_png(f: BinaryIO, file_size: int) -> ImageInfo:
+    f.seek(8)
+    length, chunk = struct.unpack(">I4s", _read_exact(f, 8))
+    if chunk != b"IHDR" or length != 13:
+        raise InvalidImage("PNG does not start with IHDR")
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", _read_exact(f, 10))
+    if color_type not in PNG_CHANNELS:
+        raise InvalidImage(f"unknown PNG color type {color_type}")
+
+    f.seek(max(0, file_size - 12))
+    if b"IEND" not in f.read():
+        raise InvalidImage("truncated PNG (no IEND chunk)")
+    return ImageInfo("png", width, height, PNG_CHANNELS[color_type], bit_depth, compression="deflate")
+
+
+TIFF_TYPES = {1: "B", 2: "B", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii",
+              11: "f", 12: "d", 16: "Q", 17: "q", 18: "Q"}
+
+
+def _probe_tiff(f: BinaryIO, file_size: int) -> ImageInfo:
+    f.seek(0)
+    header = _read_exact(f, 4)
+    order = "<" if header[:2] == b"II" else ">"
+    big = header[2:4] in (b"+\x00", b"\x00+")
+    if big:
+        _read_exact(f, 4)  # offset size and padding
+        (ifd_offset,) = struct.unpack(order + "Q", _read_exact(f, 8))
+        count_format, entry_size, inline_size = "Q", 20, 8
+    else:
+        (ifd_offset,) = struct.unpack(order + "I", _read_exact(f, 4))
+        count_format, entry_size, inline_size = "H", 12, 4
+    if not 0 < ifd_offset < file_size:
+        raise InvalidImage("TIFF directory offset outside the file")
+
+    f.seek(ifd_offset)
+    (entries,) = struct.unpack(order + count_format, _read_exact(f, struct.calcsize(count_format)))
+    raw = _read_exact(f, entries * entry_size)
+
+    tags = {}
+    for i in range(entries):
+        entry = raw[i * entry_size:(i + 1) * entry_size]
+        if big:
+            tag, value_type, count = struct.unpack(order + "HHQ", entry[:12])
+            value = entry[12:]
+        else:
+            tag, value_type, count = struct.unpack(order + "HHI", entry[:8])
+            value = entry[8:]
+        if tag not in (256, 257, 258, 259, 262, 273, 277, 279, 322, 323, 324, 325) or value_type not in TIFF_TYPES:
+            continue
+        item = TIFF_TYPES[value_type]
+        size = struct.calcsize(order + item) * count
+        if size <= inline_size:
+            data = value[:size]
+        else:
+            (offset,) = struct.unpack(order + ("Q" if big else "I"), value[:inline_size])
+            if offset + size > file_size:
+                raise InvalidImage("truncated TIFF (tag data past end of file)")
+            position = f.tell()
+            f.seek(offset)
+            data = _read_exact(f, size)
+            f.seek(position)
+        tags[tag] = struct.unpack(order + item * count, data)
+
+    if 256 not in tags or 257 not in tags:
+        raise InvalidImage("TIFF has no dimensions")
+    tiled = 322 in tags
+    offsets, counts = (tags.get(324), tags.get(325)) if tiled else (tags.get(273), tags.get(279))
+    if offsets and counts:
+        if max(o + c for o, c in zip(offsets, counts)) > file_size:
+            raise InvalidImage("truncated TIFF (image data past end of file)")
+
+    bits = tags.get(258, (1,))
+    compression = tags.get(259, (1,))[0]
+    return ImageInfo(
+        "tiff", tags[256][0], tags[257][0],
+        bands=tags.get(277, (len(bits),))[0],
+        bit_depth=max(bits),
+        tiled=tiled,
+        compression=TIFF_COMPRESSION.get(compression, str(compression)),
+        photometric=TIFF_PHOTOMETRIC.get(tags.get(262, (-1,))[0]),
+    )
+
+
+READERS = {"jpeg": _probe_jpeg, "png": _probe_png, "tiff": _probe_tiff}
+
+
+def probe(path) -> ImageInfo:
+    """Identify and validate an image file from its headers; raises InvalidImage"""
+    path = Path(path)
+    file_size = path.stat().st_size
+    with open(path, "rb") as f:
+        image_format = sniff(f.read(SNIFF_BYTES))
+        if image_format is None:
+            raise InvalidImage("not a JPEG, PNG or TIFF file")
+        try:
+            info = READERS[image_format](f, file_size)
+        except struct.error:
+            raise InvalidImage(f"corrupt {image_format.upper()} header")
+
+    if info.width <= 0 or info.height <= 0 or info.bands <= 0:
+        raise InvalidImage("image has no pixels")
+    if info.pixels > settings.MAX_IMAGE_PIXELS:
+        raise InvalidImage(
+            f"{info.width}x{info.height} exceeds the {settings.MAX_IMAGE_PIXELS // 1_000_000} megapixel limit"
+        )
+    if info.processing_mode == "tiled" and not info.reads_reduced:
+        kind = info.image_format.upper() if info.image_format != "tiff" else f"{info.compression} {info.photometric} TIFF"
+        raise InvalidImage(
+            f"{info.width}x{info.height} {kind} is too large to decode whole; "
+            "upload large images as JPEG or as uncompressed or deflate-compressed TIFF"
+        )
+    return info
+
+
+def open_validated(path):
+    """
+    Image.open() for an upload that probe() has accepted. PIL's decompression
+    bomb guard stays on for every other open; only this call may go up to
+    MAX_IMAGE_PIXELS (opening reads just the header, so the window is short).
+    """
+    from PIL import Image
+
+    with _pil_limit_lock:
+        default = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = max(default or 0, settings.MAX_IMAGE_PIXELS)
+        try:
+            return Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default
@@ -0,0 +1,333 @@
+"""
+Bulk ingestion of survey flight imagery.
+
+    python -m app.ingest /media/sdcard/DCIM --field-id <field id> [--analyses pest_detection,nutrient_mapping]
+
+Walks the directory, hashes and copies images into upload storage in a
+process pool, validates their headers (app.image_probe; invalid files are
+skipped), reads EXIF GPS position and capture time, and inserts the Upload
+rows in bulk, one transaction per batch. Tile pyramids and compact rasters are
+built in the same pool once the copy is done, for the new uploads and for any
+earlier upload of the field still missing its pyramid or raster.
+
+Analyses requested with --analyses are created queued with each batch and sent
+to Celery when it is enabled; ingestion never runs them itself. Without a
+broker, run them afterwards with python -m app.tasks --field-id <field id>.
+
+Resuming is safe: files already ingested for the field (same source path and
+size) are skipped without re-reading them, and upload ids are derived from
+the field, source path and file hash so a copy interrupted before its batch
+committed is simply overwritten on the next run. Identical files under other
+paths or fields get uploads of their own rather than being dropped as
+duplicates.
+"""
+import argparse
+import hashlib
+import itertools
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from app.config import settings
+from app.database import SessionLocal, init_db
+from app import image_probe, models, rasters, storage, tiles
+
+IMAGE_EXTENSIONS = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+}
+# Upload ids are uuid5(field, source path, content hash) so re-ingesting a file is idempotent
+UPLOAD_NAMESPACE = uuid.UUID("6b1f2f9e-3c55-4d0e-9a63-0c5f3a7d2b41")
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+DATETIME_ORIGINAL = 0x9003
+DATETIME = 0x0132
+
+
+def iter_images(root: Path) -> Iterator[Path]:
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if Path(filename).suffix.lower() in IMAGE_EXTENSIONS:
+                yield Path(dirpath) / filename
+
+
+def _gps_to_degrees(value, ref) -> Optional[float]:
+    try:
+        degrees, minutes, seconds = (float(part) for part in value)
+    except (TypeError, ValueError):
+        return None
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if ref in ("S", "W") else result
+
+
+def read_exif(path: Path) -> Dict:
+    """Capture time and GPS position from EXIF (only the header is read)"""
+    metadata = {"captured_at": None, "gps_latitude": None, "gps_longitude": None}
+    try:
+        with image_probe.open_validated(path) as image:
+            exif = image.getexif()
+    except Exception:
+        return metadata
+
+    timestamp = exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL) or exif.get(DATETIME)
+    if timestamp:
+        try:
+            metadata["captured_at"] = datetime.strptime(str(timestamp).strip("\x00"), "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            pass
+
+    gps = exif.get_ifd(GPS_IFD)
+    if gps:
+        metadata["gps_latitude"] = _gps_to_degrees(gps.get(2), gps.get(1))
+        metadata["gps_longitude"] = _gps_to_degrees(gps.get(4), gps.get(3))
+    return metadata
+
+
+def hash_and_copy(source: str, field_id: str) -> Dict:
+    """Worker: copy one file into upload storage while hashing it (single read pass)"""
+    source_path = Path(source)
+    extension = source_path.suffix.lower()
+    partial = storage.staging_dir() / f".{uuid.uuid4().hex}{extension}.part"
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(source_path, "rb") as src, open(partial, "wb") as dst:
+        while True:
+            chunk = src.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            dst.write(chunk)
+            size += len(chunk)
+
+    try:
+        info = image_probe.probe(partial)
+    except image_probe.InvalidImage as e:
+        partial.unlink(missing_ok=True)
+        return {"rejected": str(e), "source_path": str(source_path)}
+
+    sha256 = digest.hexdigest()
+    source_path = source_path.resolve()
+    upload_id = str(uuid.uuid5(UPLOAD_NAMESPACE, f"{field_id}:{source_path}:{sha256}"))
+    key = f"{upload_id}{extension}"
+    storage.get_storage().put_file(key, partial, info.content_type)
+
+    return {
+        "id": upload_id,
+        "filename": source_path.name,
+        "content_type": info.content_type,
+        "size": size,
+        "sha256": sha256,
+        "storage_key": key,
+        "source_path": str(source_path),
+        **info.columns(),
+        **read_exif(source_path),
+    }
+
+
+class Progress:
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    def update(self, done: int = 0, skipped: int = 0):
+        self.done += done
+        self.skipped += skipped
+        finished = self.done + self.skipped
+        elapsed = time.perf_counter() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0
+        percent = 100 * finished / self.total if self.total else 100
+        sys.stderr.write(
+            f"\r[{finished:>6}/{self.total}] {percent:5.1f}%  "
+            f"{self.done} copied, {self.skipped} skipped, {rate:.1f} files/s"
+        )
+        sys.stderr.flush()
+
+
+def _already_ingested(db, field_id: str) -> Dict[str, int]:
+    rows = db.query(models.Upload.source_path, models.Upload.size).filter(
+        models.Upload.field_id == field_id,
+        models.Upload.source_path.isnot(None)
+    )
+    return {source_path: size for source_path, size in rows}
+
+
+def _insert_batch(db, field_id: str, batch: List[Dict]) -> List[str]:
+    """Insert one batch of Upload rows in a single transaction; returns new upload ids"""
+    ids = [row["id"] for row in batch]
+    existing = {
+        row[0] for row in db.query(models.Upload.id).filter(models.Upload.id.in_(ids))
+    }
+    new_rows = []
+    for row in batch:
+        if row["id"] in existing:
+            continue
+        existing.add(row["id"])
+        new_rows.append({**row, "field_id": field_id, "uploaded_at": datetime.utcnow()})
+    if new_rows:
+        db.bulk_insert_mappings(models.Upload, new_rows)
+    db.commit()
+    return [row["id"] for row in new_rows]
+
+
+def _commit_batch(db, field_id: str, batch: List[Dict], analysis_types: List[str],
+                  inserted: Dict[str, Optional[str]]) -> int:
+    """Insert a batch and queue its analyses; returns how many analyses were queued"""
+    new_ids = _insert_batch(db, field_id, batch)
+    modes = {row["id"]: row.get("processing_mode") for row in batch}
+    inserted.update((upload_id, modes[upload_id]) for upload_id in new_ids)
+    if analysis_types and new_ids:
+        return enqueue_analyses(db, field_id, new_ids, analysis_types)
+    return 0
+
+
+def enqueue_analyses(db, field_id: str, upload_ids: List[str], analysis_types: List[str]):
+    """Create queued Analysis rows for every upload and hand them to Celery when it is enabled"""
+    from app import tasks
+
+    uploads = db.query(models.Upload.id, models.Upload.filename, models.Upload.processing_mode).filter(
+        models.Upload.id.in_(upload_ids)
+    )
+    extensions, modes = {}, {}
+    for upload_id, filename, processing_mode in uploads:
+        extensions[upload_id] = Path(filename).suffix.lower()
+        modes[upload_id] = processing_mode
+
+    rows = []
+    for upload_id in upload_ids:
+        for analysis_type in analysis_types:
+            rows.append({
+                "id": str(uuid.uuid4()),
+                "field_id": field_id,
+                "analysis_type": analysis_type,
+                "original_image_url": f"/uploads/{upload_id}{extensions.get(upload_id, '')}",
+                "status": "queued",
+                "created_at": datetime.utcnow(),
+            })
+    db.bulk_insert_mappings(models.Analysis, rows)
+    db.commit()
+
+    # Without a broker they stay queued, for python -m app.tasks once the copy is done
+    for row in rows:
+        tasks.dispatch(row["id"], row["analysis_type"], modes.get(Path(row["original_image_url"]).stem))
+    return len(rows)
+
+
+def _unprepared(db, field_id: str) -> Dict[str, Optional[str]]:
+    """Uploads of the field without a compact raster; prepare_upload skips whatever they already have"""
+    rows = db.query(models.Upload.id, models.Upload.processing_mode).filter(
+        models.Upload.field_id == field_id,
+        models.Upload.raster_key.is_(None)
+    )
+    return dict(rows)
+
+
+def prepare_upload(upload_id: str, processing_mode: Optional[str]):
+    """
+    Worker: tile pyramid unless one was stored already, then the compact
+    raster (it reads the original, so it runs second; transcode_upload
+    returns early when there is one or the format needs none)
+    """
+    if not storage.get_storage().exists(tiles.pyramid_key(upload_id)):
+        tiles.build_pyramid(upload_id, None, processing_mode or "in_memory")
+    rasters.transcode_upload(upload_id)
+
+
+def ingest(root: Path, field_id: str, workers: int, batch_size: int, analysis_types: List[str]) -> Dict:
+    init_db()
+
+    db = SessionLocal()
+    try:
+        done = _already_ingested(db, field_id)
+        pending = []
+        skipped = 0
+        files = list(iter_images(root))
+        for path in files:
+            resolved = str(path.resolve())
+            if done.get(resolved) == path.stat().st_size:
+                skipped += 1
+            else:
+                pending.append(str(path))
+
+        progress = Progress(len(files))
+        progress.update(skipped=skipped)
+
+        queued = 0
+        rejected = 0
+        batch: List[Dict] = []
+        # upload id -> processing mode, for the pyramids and rasters built once the rows exist
+        inserted: Dict[str, Optional[str]] = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(hash_and_copy, pending, itertools.repeat(field_id), chunksize=8)
+            for row in results:
+                progress.update(done=1)
+                if "rejected" in row:
+                    rejected += 1
+                    sys.stderr.write(f"\n✗ Skipped {row['source_path']}: {row['rejected']}\n")
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    queued += _commit_batch(db, field_id, batch, analysis_types, inserted)
+                    batch = []
+            if batch:
+                queued += _commit_batch(db, field_id, batch, analysis_types, inserted)
+            # Tile pyramids and compact tiled copies (app.tiles, app.rasters), once the rows exist;
+            # includes uploads of earlier runs that were interrupted before they were prepared
+            unprepared = {**_unprepared(db, field_id), **inserted}
+            list(pool.map(prepare_upload, unprepared, unprepared.values(), chunksize=4))
+        sys.stderr.write("\n")
+
+        return {
+            "files_found": len(files),
+            "skipped": skipped,
+            "copied": len(pending) - rejected,
+            "rejected": rejected,
+            "uploads_inserted": len(inserted),
+            "analyses_queued": queued,
+            "seconds": round(time.perf_counter() - progress.started, 1),
+        }
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.ingest", description="Bulk-import survey flight imagery")
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--field-id", required=True)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per insert transaction")
+    parser.add_argument(
+        "--analyses", default="",
+        help="comma-separated analysis types to queue: pest_detection,nutrient_mapping,yield_prediction"
+    )
+    args = parser.parse_args(argv)
+
+    if not args.directory.is_dir():
+        parser.error(f"{args.directory} is not a directory")
+    analysis_types = [name.strip() for name in args.analyses.split(",") if name.strip()]
+    unknown = set(analysis_types) - {"pest_detection", "nutrient_mapping", "yield_prediction"}
+    if unknown:
+        parser.error(f"Unknown analysis types: {', '.join(sorted(unknown))}")
+
+    summary = ingest(args.directory, args.field_id, args.workers, args.batch_size, analysis_types)
+    print("✓ Ingestion complete")
+    for key, value in summary.items():
+        print(f"  {key}: {value}")
+    if summary["analyses_queued"] and not settings.USE_CELERY:
+        print(f"  Run the queued analyses with: python -m app.tasks --field-id {args.field_id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,61 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, WebSocket, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, WebSocket, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from app.database import engine, get_db, Base, init_db
-from app import models, schemas, tasks
+from app import models, schemas, tasks, tiles, metrics, forecasting, serialization, export, reports, admission, image_probe, storage, progress, subscriptions, replication, rasters, prescriptions, alerts, prefork
 from app.config import settings
 import uuid
 import asyncio
+import hashlib
+import hmac
 import json
 import os
 import shutil
-from typing import List
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional, Tuple
 from pathlib import Path
 
-# Create upload directory
 UPLOAD_DIR = Path(settings.UPLOAD_DIR)
-UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Initialize database
-print("Initializing database...")
-init_db()
-print("Database initialized successfully!")
+def _warm_up():
+    """Import the model modules (and their numpy/PIL deps) and load the models before the first request needs them"""
+    from app.ml_models import backends, pest_detection, nutrient_analysis, yield_prediction
+    for name in (pest_detection.PEST_MODEL_NAME, yield_prediction.YIELD_MODEL_NAME):
+        backends.get_backend(name)
+    print("Model warm-up complete")
 
-app = FastAPI(title="AgriScan AI API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup work lives here rather than at import time so importing app.main stays cheap
+    if settings.STORAGE_BACKEND == "local":
+        UPLOAD_DIR.mkdir(exist_ok=True)
+    # Pre-forked workers (app.prefork) inherit the master's migrations and, when it built them, its models
+    if not os.environ.get(prefork.MIGRATED_ENV):
+        print("Initializing database...")
+        init_db()
+        print("Database initialized successfully!")
+    if settings.WARMUP_ON_STARTUP and not os.environ.get(prefork.MODELS_PRELOADED_ENV):
+        threading.Thread(target=_warm_up, name="model-warmup", daemon=True).start()
+    if settings.ALERTS_ENABLED:
+        alerts.dispatcher.start()
+    yield
+    alerts.dispatcher.stop()
+
+app = FastAPI(
+    title="AgriScan AI API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=serialization.FastJSONResponse
+)
+
+# Rate limits, per-client caps and load shedding for uploads and analysis submissions.
+# Added before CORS so rejections still carry CORS headers.
+app.add_middleware(admission.AdmissionMiddleware)
 
 # CORS Configuration
 app.add_middleware(
@@ -34,10 +67,17 @@ app.add_middleware(
 )
 
 # Serve uploaded files
-try:
-    app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
-except Exception as e:
-    print(f"Warning: Could not mount uploads directory: {e}")
+if settings.STORAGE_BACKEND == "local":
+    try:
+        # check_dir=False: the directory is created in lifespan, after the mount
+        app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR), check_dir=False), name="uploads")
+    except Exception as e:
+        print(f"Warning: Could not mount uploads directory: {e}")
+else:
+    @app.get("/uploads/{key:path}")
+    def download_upload(key: str):
+        """Clients download straight from object storage via a presigned URL"""
+        return RedirectResponse(storage.get_storage().url(key), status_code=307)
 
 @app.get("/")
 def read_root():
@@ -52,38 +92,60 @@ def read_root():
 def health_check():
     return {"status": "healthy", "database": "connected"}
 
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
 @app.post("/api/upload/image")
-async def upload_image(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_image(background_tasks: BackgroundTasks, file: UploadFile = File(...), db: Session = Depends(get_db)):
     try:
-        # Validate file type
-        allowed_types = ["image/jpeg", "image/png", "image/tiff"]
-        if file.content_type not in allowed_types:
-            raise HTTPException(status_code=400, detail=f"File type {file.content_type} not allowed")
+        # Validate file type from the magic bytes; the client's content type is not trusted
+        image_format = image_probe.sniff(file.file.read(image_probe.SNIFF_BYTES))
+        file.file.seek(0)
+        if image_format is None:
+            raise HTTPException(status_code=400, detail="File is not a JPEG, PNG or TIFF image")
         
-        # Generate unique ID and save file
+        # Generate unique ID and stage the file locally
         upload_id = str(uuid.uuid4())
-        file_extension = file.filename.split(".")[-1] if "." in file.filename else "jpg"
-        saved_filename = f"{upload_id}.{file_extension}"
-        file_path = UPLOAD_DIR / saved_filename
+        saved_filename = f"{upload_id}{image_probe.FORMATS[image_format][1]}"
+        file_path = storage.staging_dir() / saved_filename
         
-        # Save file to disk
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
         
+        # Read dimensions, bands and layout from the headers without decoding pixels
+        try:
+            info = image_probe.probe(file_path)
+        except image_probe.InvalidImage as e:
+            file_path.unlink(missing_ok=True)
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+        
+        # Publish to upload storage (local directory or S3)
+        size = os.path.getsize(file_path)
+        await run_in_threadpool(storage.get_storage().put_file, saved_filename, file_path, info.content_type)
+        
         # Save to database
         upload = models.Upload(
             id=upload_id,
             filename=file.filename,
-            content_type=file.content_type,
-            size=os.path.getsize(file_path)
+            content_type=info.content_type,
+            size=size,
+            storage_key=saved_filename,
+            **info.columns()
         )
         db.add(upload)
         db.commit()
         
+        # Build the map tile pyramid once, off the request path
+        background_tasks.add_task(tiles.build_pyramid, upload_id, None, info.processing_mode)
+        # Then the tiled, compressed copy; it reads the original, so it runs after the pyramid
+        background_tasks.add_task(rasters.transcode_upload, upload_id)
+        
         return {
             "image_id": upload_id,
             "url": f"/uploads/{saved_filename}",
-            "filename": file.filename
+            "filename": file.filename,
+            "metadata": info.columns()
         }
     except HTTPException:
         raise
@@ -91,19 +153,55 @@ async def upload_image(file: UploadFile = File(...), db: Session = Depends(get_d
         print(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+def _upload_source(db: Session, image_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """(URL, processing mode) of an upload; the mode routes large images in the analysis tasks"""
+    try:
+        key = storage.find_upload_key(image_id, db)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid image_id")
+    upload = db.get(models.Upload, image_id)
+    return (f"/uploads/{key}" if key else None), (upload.processing_mode if upload else None)
+
+@app.get("/tiles/{upload_id}/info")
+def get_tile_info(upload_id: str):
+    info = tiles.get_pyramid_info(upload_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Tiles not ready")
+    return info
+
+@app.get("/tiles/{upload_id}/{z}/{x}/{y}.png")
+def get_tile(upload_id: str, z: int, x: int, y: int, request: Request, layer: str = "image"):
+    if layer not in tiles.LAYERS:
+        raise HTTPException(status_code=400, detail=f"Unknown layer {layer}")
+    data = tiles.get_tile(upload_id, layer, z, x, y)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    
+    etag = '"' + hashlib.md5(data).hexdigest() + '"'
+    # Imagery never changes once tiled; overlays are rebuilt when new analyses land
+    max_age = 86400 if layer == "image" else 300
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="image/png", headers=headers)
+
 @app.post("/api/analysis/pest-detection", response_model=schemas.AnalysisResponse)
 async def analyze_pests(
     request: schemas.PestDetectionRequest, 
     background_tasks: BackgroundTasks,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
     try:
         analysis_id = str(uuid.uuid4())
+        image_url, processing_mode = _upload_source(db, request.image_id)
         analysis = models.Analysis(
             id=analysis_id,
             field_id=request.field_id,
             analysis_type="pest_detection",
-            status="queued"
+            original_image_url=image_url,
+            status="queued",
+            client_key=admission.client_key(http_request)
         )
         db.add(analysis)
         db.commit()
@@ -111,11 +209,14 @@ async def analyze_pests(
         
         # Trigger task (Celery or background task)
         if settings.USE_CELERY:
-            tasks.process_pest_detection.delay(analysis_id)
+            tasks.process_pest_detection.delay(analysis_id, processing_mode)
         else:
-            background_tasks.add_task(tasks.process_pest_detection, analysis_id)
+            admission.local_queue.enqueued(analysis_id)
+            background_tasks.add_task(tasks.process_pest_detection, analysis_id, processing_mode)
         
         return analysis
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Pest detection error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -124,26 +225,33 @@ async def analyze_pests(
 async def analyze_nutrients(
     request: schemas.NutrientAnalysisRequest,
     background_tasks: BackgroundTasks,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
     try:
         analysis_id = str(uuid.uuid4())
+        image_url, processing_mode = _upload_source(db, request.image_id)
         analysis = models.Analysis(
             id=analysis_id,
             field_id=request.field_id,
             analysis_type="nutrient_mapping",
-            status="queued"
+            original_image_url=image_url,
+            status="queued",
+            client_key=admission.client_key(http_request)
         )
         db.add(analysis)
         db.commit()
         db.refresh(analysis)
         
         if settings.USE_CELERY:
-            tasks.process_nutrient_analysis.delay(analysis_id)
+            tasks.process_nutrient_analysis.delay(analysis_id, processing_mode)
         else:
-            background_tasks.add_task(tasks.process_nutrient_analysis, analysis_id)
+            admission.local_queue.enqueued(analysis_id)
+            background_tasks.add_task(tasks.process_nutrient_analysis, analysis_id, processing_mode)
         
         return analysis
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Nutrient analysis error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -152,36 +260,265 @@ async def analyze_nutrients(
 async def analyze_yield(
     request: schemas.YieldPredictionRequest,
     background_tasks: BackgroundTasks,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
     try:
         analysis_id = str(uuid.uuid4())
+        image_url, processing_mode = _upload_source(db, request.image_id)
         analysis = models.Analysis(
             id=analysis_id,
             field_id=request.field_id,
             analysis_type="yield_prediction",
-            status="queued"
+            original_image_url=image_url,
+            status="queued",
+            client_key=admission.client_key(http_request)
         )
         db.add(analysis)
         db.commit()
         db.refresh(analysis)
         
+        if request.historical_yield:
+            forecasting.set_historical_yield(db, request.field_id, request.historical_yield)
+        
         if settings.USE_CELERY:
-            tasks.process_yield_prediction.delay(analysis_id)
+            tasks.process_yield_prediction.delay(analysis_id, processing_mode)
         else:
-            background_tasks.add_task(tasks.process_yield_prediction, analysis_id)
+            admission.local_queue.enqueued(analysis_id)
+            background_tasks.add_task(tasks.process_yield_prediction, analysis_id, processing_mode)
         
         return analysis
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Yield prediction error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _id_list(ids: Optional[str]) -> List[str]:
+    return [i for i in (ids or "").split(",") if i]
+
+@app.get("/api/analysis")
+def get_analysis_statuses(ids: str, db: Session = Depends(get_db)):
+    """Status of many analyses (ids=a,b,...) in one IN query; unknown ids are omitted"""
+    id_list = _id_list(ids)
+    if len(id_list) > subscriptions.MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {subscriptions.MAX_IDS} ids per request")
+    return serialization.FastJSONResponse(subscriptions.fetch_statuses(db, id_list))
+
+@app.get("/api/analyses/events")
+async def analysis_events(request: Request, ids: Optional[str] = None, field_id: Optional[str] = None):
+    """Server-sent events fallback for /ws/analyses: ids=a,b,... and/or field_id=x,y"""
+    id_list, field_ids = _id_list(ids), _id_list(field_id)
+    if not id_list and not field_ids:
+        raise HTTPException(status_code=400, detail="Pass ids and/or field_id")
+    if len(id_list) > subscriptions.MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {subscriptions.MAX_IDS} ids per request")
+    return StreamingResponse(
+        subscriptions.event_stream(request, id_list, field_ids),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/analysis/{analysis_id}", response_model=schemas.AnalysisResponse)
-def get_analysis_result(analysis_id: str, db: Session = Depends(get_db)):
+def get_analysis_result(analysis_id: str, request: Request, detections: str = "rows", db: Session = Depends(get_db)):
+    """detections=columnar returns pests as parallel arrays instead of a list of objects"""
+    if detections not in serialization.DETECTION_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"Unknown detections encoding {detections}")
     analysis = db.query(models.Analysis).filter(models.Analysis.id == analysis_id).first()
     if not analysis:
         raise HTTPException(status_code=404, detail="Analysis not found")
-    return analysis
+    # Bypasses response_model validation; the schema is kept for the OpenAPI docs
+    return serialization.analysis_response(analysis, request.headers.get("accept-encoding", ""), detections)
+
+@app.delete("/api/analysis/{analysis_id}", status_code=202)
+def cancel_analysis(analysis_id: str, db: Session = Depends(get_db)):
+    """Request cancellation; a running task stops at its next tile/batch boundary"""
+    analysis = db.query(models.Analysis).filter(models.Analysis.id == analysis_id).first()
+    if not analysis:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    if not progress.request_cancel(db, analysis):
+        raise HTTPException(status_code=409, detail=f"Analysis already {analysis.status}")
+    return {"id": analysis.id, "status": analysis.status, "cancel_requested": True}
+
+@app.get("/api/analysis/{analysis_id}/prescription")
+def get_prescription(analysis_id: str, nutrient: str = "nitrogen", zones: Optional[int] = None,
+                     method: str = "kmeans", cell_size_m: Optional[float] = None, format: str = "geojson",
+                     db: Session = Depends(get_db)):
+    """Variable-rate prescription map from a nutrient analysis's imagery (format=geojson|shapefile|summary)"""
+    if format not in prescriptions.FORMATS and format != "summary":
+        raise HTTPException(status_code=400, detail=f"Unknown prescription format {format}")
+    analysis = db.query(models.Analysis).filter(models.Analysis.id == analysis_id).first()
+    if not analysis or analysis.analysis_type != "nutrient_mapping":
+        raise HTTPException(status_code=404, detail="Nutrient analysis not found")
+    try:
+        prescription = prescriptions.for_analysis(analysis, nutrient=nutrient, zones=zones, method=method,
+                                                  cell_size_m=cell_size_m)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if prescription is None:
+        raise HTTPException(status_code=404, detail="Imagery for this analysis is no longer available")
+    metrics.incr("prescriptions", "built")
+    if format == "summary":
+        return prescription.summary()
+    extension = "geojson" if format == "geojson" else "zip"
+    return Response(prescriptions.encode(prescription, format), media_type=prescriptions.FORMATS[format],
+                    headers={"Content-Disposition": f'attachment; filename="prescription-{analysis_id}-{nutrient}.{extension}"'})
+
+@app.get("/api/fields/{field_id}/changes", response_model=List[schemas.FieldChangeResponse])
+def get_field_changes(field_id: str, analysis_type: Optional[str] = None, limit: int = 10, db: Session = Depends(get_db)):
+    """Precomputed deltas between successive analyses of a field, newest first"""
+    query = db.query(models.FieldChange).filter(models.FieldChange.field_id == field_id)
+    if analysis_type:
+        query = query.filter(models.FieldChange.analysis_type == analysis_type)
+    return query.order_by(models.FieldChange.created_at.desc()).limit(limit).all()
+
+@app.get("/api/fields/{field_id}/forecast")
+def get_field_forecast(field_id: str, db: Session = Depends(get_db)):
+    state = db.query(models.FieldForecast).filter(models.FieldForecast.field_id == field_id).first()
+    if not state:
+        raise HTTPException(status_code=404, detail="No forecast for this field yet")
+    return {
+        "field_id": field_id,
+        "predicted_yield_tons_per_hectare": state.forecast_yield,
+        "days_to_harvest": state.forecast_days_to_harvest,
+        "forecast_at": state.forecast_at,
+        "features": dict(zip(forecasting.FEATURES, state.features or [])),
+        "history": state.history or []
+    }
+
+def _report_file(report: models.Report, format: str, request: Request, cache_control: str):
+    if format not in reports.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown report format {format}")
+    path = reports.artifact_path(report, format)
+    if path is None:
+        reports.schedule(report.field_id)
+        raise HTTPException(status_code=404, detail="Report not rendered")
+    # A report's artifacts never change; new inputs produce a new report id
+    etag = f'"{report.id}-{format}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=reports.FORMATS[format], headers=headers)
+
+@app.get("/api/fields/{field_id}/report")
+def get_field_report(field_id: str, request: Request, format: str = "json", db: Session = Depends(get_db)):
+    """Latest precomputed report for a field (format=json|html)"""
+    report = reports.latest_report(db, field_id)
+    if report is None:
+        reports.schedule(field_id)
+        return serialization.FastJSONResponse({"status": "pending", "field_id": field_id}, status_code=202)
+    return _report_file(report, format, request, "no-cache")
+
+@app.get("/api/report/{report_id}")
+def get_report(report_id: str, request: Request, format: str = "json", db: Session = Depends(get_db)):
+    report = db.query(models.Report).filter(models.Report.id == report_id).first()
+    if not report:
+        raise HTTPException(status_code=404, detail="Report not found")
+    return _report_file(report, format, request, "private, max-age=86400, immutable")
+
+def _export_response(kind: str, format: str, **filters):
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format {format}")
+    if format == "parquet" and not export.parquet_available():
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow")
+    filename = f"{kind}-{filters.get('field_id') or 'all'}.{format}"
+    return StreamingResponse(
+        export.stream(kind, format, **filters),
+        media_type=export.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/export/analyses")
+def export_analyses(format: str = "ndjson", field_id: Optional[str] = None, start: Optional[datetime] = None,
+                    end: Optional[datetime] = None, analysis_type: Optional[str] = None):
+    """Stream every matching analysis; start is inclusive, end exclusive"""
+    return _export_response("analyses", format, field_id=field_id, start=start, end=end,
+                            analysis_type=analysis_type)
+
+@app.get("/api/export/detections")
+def export_detections(format: str = "ndjson", field_id: Optional[str] = None, start: Optional[datetime] = None,
+                      end: Optional[datetime] = None):
+    """Stream one row per pest detection of completed pest analyses"""
+    return _export_response("detections", format, field_id=field_id, start=start, end=end)
+
+@app.post("/api/alerts/rules", response_model=schemas.AlertRuleResponse, status_code=201)
+def create_alert_rule(rule: schemas.AlertRuleCreate, db: Session = Depends(get_db)):
+    """Rule checked against every completed analysis of its type (and field); see app.alerts"""
+    row = models.AlertRule(**rule.model_dump())
+    try:
+        alerts.compile_rule(row)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db.add(row)
+    db.commit()
+    db.refresh(row)
+    return row
+
+@app.get("/api/alerts/rules", response_model=List[schemas.AlertRuleResponse])
+def list_alert_rules(field_id: Optional[str] = None, db: Session = Depends(get_db)):
+    query = db.query(models.AlertRule)
+    if field_id:
+        query = query.filter(models.AlertRule.field_id == field_id)
+    return query.order_by(models.AlertRule.created_at).all()
+
+@app.delete("/api/alerts/rules/{rule_id}", status_code=204)
+def delete_alert_rule(rule_id: str, db: Session = Depends(get_db)):
+    rule = db.get(models.AlertRule, rule_id)
+    if not rule:
+        raise HTTPException(status_code=404, detail="Alert rule not found")
+    db.query(models.Alert).filter(models.Alert.rule_id == rule_id).delete(synchronize_session=False)
+    db.delete(rule)
+    db.commit()
+    return Response(status_code=204)
+
+@app.get("/api/alerts", response_model=List[schemas.AlertResponse])
+def list_alerts(field_id: Optional[str] = None, status: Optional[str] = None, limit: int = 50,
+                db: Session = Depends(get_db)):
+    """Alerts newest first; queue-sink consumers poll status=queued and acknowledge"""
+    query = db.query(models.Alert)
+    if field_id:
+        query = query.filter(models.Alert.field_id == field_id)
+    if status:
+        query = query.filter(models.Alert.status == status)
+    return query.order_by(models.Alert.created_at.desc()).limit(min(limit, 500)).all()
+
+@app.post("/api/alerts/{alert_id}/ack", response_model=schemas.AlertResponse)
+def acknowledge_alert(alert_id: str, db: Session = Depends(get_db)):
+    alert = db.get(models.Alert, alert_id)
+    if not alert:
+        raise HTTPException(status_code=404, detail="Alert not found")
+    if alert.status in ("queued", "delivered"):
+        alert.status = "acknowledged"
+        db.commit()
+    return alert
+
+def _require_central(request: Request):
+    if settings.REPLICATION_ROLE != "central":
+        raise HTTPException(status_code=404, detail="Replication is not enabled on this server")
+    if not settings.REPLICATION_TOKEN:
+        raise HTTPException(status_code=503, detail="REPLICATION_TOKEN is not configured on this server")
+    expected = f"Bearer {settings.REPLICATION_TOKEN}"
+    if not hmac.compare_digest(request.headers.get("authorization", "").encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Invalid replication token")
+
+@app.get("/api/replication/peers/{edge_id}")
+def get_replication_peer(edge_id: str, request: Request, db: Session = Depends(get_db)):
+    """How far an edge unit's change log has been applied here (edges resume from last_seq)"""
+    _require_central(request)
+    return replication.peer_state(db, edge_id)
+
+@app.post("/api/replication/batches")
+async def apply_replication_batch(request: Request):
+    """Apply one compressed batch of edge changes (see app.replication)"""
+    _require_central(request)
+    body = await request.body()
+    try:
+        last_seq = await run_in_threadpool(replication.apply_payload, body, request.headers.get("content-encoding", ""))
+    except replication.ReplicationError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid replication batch: {e}")
+    return {"last_seq": last_seq}
 
 @app.websocket("/ws/analysis/{analysis_id}")
 async def websocket_endpoint(websocket: WebSocket, analysis_id: str):
@@ -190,22 +527,30 @@ async def websocket_endpoint(websocket: WebSocket, analysis_id: str):
     
     try:
         while True:
-            # Poll DB for status
+            # Poll DB for status; expire so each poll sees the task's latest commit
+            db.expire_all()
             analysis = db.query(models.Analysis).filter(models.Analysis.id == analysis_id).first()
             
             if analysis:
                 if analysis.status == "completed":
                     await websocket.send_json({
                         "status": "complete",
-                        "data": analysis.results_json
+                        "data": serialization.results_for(analysis.results_json)
                     })
                     break
                 elif analysis.status == "failed":
                     await websocket.send_json({"status": "error", "message": "Analysis failed"})
                     break
+                elif analysis.status == "cancelled":
+                    await websocket.send_json({"status": "cancelled", "stage": analysis.stage})
+                    break
                 else:
-                    # Still processing
-                    await websocket.send_json({"status": "processing", "progress": 50})
+                    # Still queued or processing
+                    await websocket.send_json({
+                        "status": "processing",
+                        "stage": analysis.stage or analysis.status,
+                        "progress": round((analysis.progress or 0) * 100)
+                    })
             else:
                 await websocket.send_json({"status": "error", "message": "Not found"})
                 break
@@ -220,5 +565,15 @@ async def websocket_endpoint(websocket: WebSocket, analysis_id: str):
         except:
             pass
 
+@app.websocket("/ws/analyses")
+async def analyses_websocket(websocket: WebSocket):
+    """Multiplexed status updates for any set of analyses and fields (see app.subscriptions)"""
+    await websocket.accept()
+    await subscriptions.serve_websocket(websocket)
+    try:
+        await websocket.close()
+    except:
+        pass
+
 # Import SessionLocal for WebSocket
 from app.database import SessionLocal
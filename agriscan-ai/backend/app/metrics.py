@@ -0,0 +1,30 @@
+"""
+Lightweight in-process metrics.
+Counters and gauges are grouped by subsystem and exposed as JSON on /metrics.
+"""
+import threading
+from collections import defaultdict
+from typing import Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+_gauges: Dict[str, Dict[str, float]] = defaultdict(dict)
+
+
+def incr(subsystem: str, name: str, value: float = 1):
+    with _lock:
+        _counters[subsystem][name] += value
+
+
+def set_gauge(subsystem: str, name: str, value: float):
+    with _lock:
+        _gauges[subsystem][name] = value
+
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    """Current counters and gauges, merged per subsystem"""
+    with _lock:
+        data = {subsystem: dict(values) for subsystem, values in _counters.items()}
+        for subsystem, values in _gauges.items():
+            data.setdefault(subsystem, {}).update(values)
+    return data
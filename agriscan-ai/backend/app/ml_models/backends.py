@@ -0,0 +1,146 @@
+"""
+Pluggable inference backends for the pest and yield models.
+
+Models are looked up in MODEL_DIR by name and precision:
+    <MODEL_DIR>/<name>.onnx          fp32
+    <MODEL_DIR>/<name>.fp16.onnx     fp16
+    <MODEL_DIR>/<name>.int8.onnx     int8 (see quantize_int8)
+
+INFERENCE_BACKEND selects the execution path:
+    mock         no model, callers fall back to simulated results (default)
+    onnxruntime  CPU ONNX Runtime session with per-worker thread settings
+
+get_backend() returns None when the selected backend has no model file, so the
+model modules keep working (mocked) until real weights are dropped in place.
+"""
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.config import settings
+
+PRECISIONS = ("fp32", "fp16", "int8")
+
+_backends: Dict[tuple, "InferenceBackend"] = {}
+
+
+def model_path(name: str, precision: str = None, model_dir: str = None) -> Path:
+    precision = precision or settings.MODEL_PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    suffix = ".onnx" if precision == "fp32" else f".{precision}.onnx"
+    return Path(model_dir or settings.MODEL_DIR) / f"{name}{suffix}"
+
+
+class InferenceBackend(ABC):
+    """Runs one model; subclasses wrap a specific runtime"""
+    name = "base"
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @property
+    @abstractmethod
+    def input_shape(self) -> List:
+        """Model input shape (dimensions may be symbolic names)"""
+
+    @abstractmethod
+    def run(self, inputs: np.ndarray) -> List[np.ndarray]:
+        """Model outputs for one preprocessed input batch"""
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = "onnxruntime"
+
+    def __init__(self, path: Path, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        super().__init__(path)
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        # 0 lets ONNX Runtime pick; set explicitly when several workers share a node
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(path), sess_options=options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self._input_name = model_input.name
+        self._input_shape = model_input.shape
+        # fp16 models take half-precision input
+        self._input_dtype = np.float16 if "float16" in model_input.type else np.float32
+
+    @property
+    def input_shape(self):
+        return self._input_shape
+
+    def run(self, inputs):
+        return self.session.run(None, {self._input_name: inputs.astype(self._input_dtype, copy=False)})
+
+
+BACKENDS = {
+    "onnxruntime": OnnxRuntimeBackend,
+}
+
+
+def create_backend(name: str, backend: str = None, precision: str = None,
+                   intra_op_threads: int = None, inter_op_threads: int = None,
+                   model_dir: str = None) -> Optional[InferenceBackend]:
+    """Build a backend without caching (used by the benchmark to compare variants)"""
+    backend = backend or settings.INFERENCE_BACKEND
+    if backend == "mock":
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}")
+
+    path = model_path(name, precision, model_dir)
+    if not path.exists():
+        print(f"Warning: model {path} not found, using mock {name} results")
+        return None
+    return BACKENDS[backend](
+        path,
+        intra_op_threads=settings.ORT_INTRA_OP_THREADS if intra_op_threads is None else intra_op_threads,
+        inter_op_threads=settings.ORT_INTER_OP_THREADS if inter_op_threads is None else inter_op_threads,
+    )
+
+
+def get_backend(name: str) -> Optional[InferenceBackend]:
+    """Per-process cached backend for a model, or None to use mock results"""
+    key = (name, settings.INFERENCE_BACKEND, settings.MODEL_PRECISION)
+    if key not in _backends:
+        _backends[key] = create_backend(name)
+    return _backends[key]
+
+
+def quantize_int8(name: str, model_dir: str = None) -> Path:
+    """Write <name>.int8.onnx next to the fp32 model using dynamic int8 quantization"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    source = model_path(name, "fp32", model_dir)
+    target = model_path(name, "int8", model_dir)
+    quantize_dynamic(str(source), str(target), weight_type=QuantType.QInt8)
+    return target
+
+
+def convert_fp16(name: str, model_dir: str = None) -> Path:
+    """Write <name>.fp16.onnx (requires onnx + onnxconverter-common)"""
+    import onnx
+    from onnxconverter_common import float16
+
+    source = model_path(name, "fp32", model_dir)
+    target = model_path(name, "fp16", model_dir)
+    model = float16.convert_float_to_float16(onnx.load(str(source)), keep_io_types=False)
+    onnx.save(model, str(target))
+    return target
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create quantized model variants")
+    parser.add_argument("model", help="model name, e.g. pest_yolov8")
+    parser.add_argument("--precision", choices=["fp16", "int8"], default="int8")
+    args = parser.parse_args()
+    converter = quantize_int8 if args.precision == "int8" else convert_fp16
+    print(f"✓ Wrote {converter(args.model)}")
@@ -6,9 +6,10 @@ In a production environment, this would integrate with satellite/Drone imagery a
 
 import numpy as np
 import random
-from typing import Dict
+from typing import Dict, Optional, Tuple
 from PIL import Image
 import io
+from app.recommendations import nutrient_recommendation
 
 # Crop types for nutrient analysis
 CROP_TYPES = [
@@ -24,6 +25,11 @@ CROP_TYPES = [
     "Cabbage"
 ]
 
+# Band order of multispectral uploads (as in app.tiles): R, G, B, NIR, then Red Edge
+RED_BAND = 0
+NIR_BAND = 3
+RED_EDGE_BAND = 4
+
 def analyze_nutrients(image_bytes: bytes, crop_type: str = None) -> Dict:
     """
     Mock implementation of nutrient deficiency analysis using NDVI/NDRE
@@ -50,9 +56,9 @@ def analyze_nutrients(image_bytes: bytes, crop_type: str = None) -> Dict:
     potassium_deficiency = random.randint(3, 25)
     
     # Generate recommendations based on deficiencies
-    nitrogen_recommendation = f"Apply {random.randint(80, 150)} kg/ha nitrogen fertilizer"
-    phosphorus_recommendation = f"Apply {random.randint(30, 80)} kg/ha phosphorus fertilizer" if phosphorus_deficiency > 5 else "Phosphorus levels adequate"
-    potassium_recommendation = f"Apply {random.randint(20, 60)} kg/ha potassium fertilizer" if potassium_deficiency > 5 else "Potassium levels adequate"
+    nitrogen_recommendation = nutrient_recommendation("nitrogen", nitrogen_deficiency)
+    phosphorus_recommendation = nutrient_recommendation("phosphorus", phosphorus_deficiency)
+    potassium_recommendation = nutrient_recommendation("potassium", potassium_deficiency)
     
     # Calculate overall field health score (0-100)
     health_score = 100 - (nitrogen_deficiency * 0.4 + phosphorus_deficiency * 0.3 + potassium_deficiency * 0.3)
@@ -118,6 +124,33 @@ def calculate_ndre(nir_band: np.ndarray, red_edge_band: np.ndarray) -> np.ndarra
     ndre = (nir_band - red_edge_band) / denominator
     return np.clip(ndre, -1, 1)  # Ensure values are in [-1, 1] range
 
+def index_rasters(pixels: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Per-pixel NDVI and NDRE (None without a red-edge band) of an H x W x bands
+    array. Pixels where the index is undefined are NaN. RGB imagery, and RGBA
+    whose fourth band is a constant alpha, gets the visible-band VARI proxy
+    in place of NDVI.
+    """
+    bands = pixels.shape[2] if pixels.ndim == 3 else 1
+    pixels = pixels.astype(np.float32, copy=False)
+    if bands > NIR_BAND and np.ptp(pixels[..., NIR_BAND]) > 0:
+        red, nir = pixels[..., RED_BAND], pixels[..., NIR_BAND]
+        ndvi = calculate_ndvi(nir, red)
+        ndvi[(nir + red) <= 0] = np.nan
+        ndre = None
+        if bands > RED_EDGE_BAND:
+            red_edge = pixels[..., RED_EDGE_BAND]
+            ndre = calculate_ndre(nir, red_edge)
+            ndre[(nir + red_edge) <= 0] = np.nan
+        return ndvi, ndre
+    if bands == 1:
+        pixels = np.repeat(pixels.reshape(pixels.shape[:2] + (1,)), 3, axis=2)
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    denominator = green + red - blue
+    vari = np.clip((green - red) / np.where(denominator == 0, 1e-6, denominator), -1, 1)
+    vari[(green + red + blue) <= 0] = np.nan
+    return vari, None
+
 if __name__ == "__main__":
     # Example usage
     print("Nutrient Analysis Model Module")
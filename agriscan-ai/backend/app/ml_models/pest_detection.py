@@ -1,15 +1,23 @@
 """
 Pest Detection Model using YOLOv8
-This is a mock implementation for demonstration purposes.
-In a production environment, this would integrate with a trained YOLOv8 model.
+Runs an exported YOLOv8 ONNX model when one is configured (see backends.py),
+otherwise falls back to a mock implementation for demonstration purposes.
 """
 
-import cv2
 import numpy as np
 import random
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple, Union
 from PIL import Image
-import io
+
+from app import rasters
+from app.detections import Detections
+from app.raster_cache import to_image
+from app.ml_models.backends import get_backend
+
+PEST_MODEL_NAME = "pest_yolov8"
+YOLO_INPUT_SIZE = 640
+NMS_IOU_THRESHOLD = 0.45
+ZONES = ["Zone A", "Zone B", "Zone C", "Zone D"]
 
 # Mock pest classes that a real YOLOv8 model might detect
 PEST_CLASSES = [
@@ -25,54 +33,60 @@ PEST_CLASSES = [
     "Cutworm"
 ]
 
-def detect_pests(image_bytes: bytes, confidence_threshold: float = 0.75) -> Dict:
+def detect_pests(image: Union[bytes, np.ndarray], confidence_threshold: float = 0.75) -> Dict:
     """
     Mock implementation of pest detection using YOLOv8
     
     Args:
-        image_bytes: Uploaded image as bytes
+        image: Uploaded image as bytes, or its decoded pixels (raster_cache.load)
         confidence_threshold: Minimum confidence score for detections
         
     Returns:
-        Dictionary containing detection results
+        Dictionary containing detection results; "pests" is a Detections
+        (serialization.dumps encodes it, .to_records() gives the list of dicts)
     """
-    # In a real implementation, we would:
-    # 1. Load the YOLOv8 model
-    # 2. Preprocess the image
-    # 3. Run inference
-    # 4. Post-process results
+    backend = get_backend(PEST_MODEL_NAME)
+    if backend is not None:
+        return _detect_with_model(backend, image, confidence_threshold)
     
-    # For this mock implementation, we'll simulate results
+    # No model configured: simulate results
     num_detections = random.randint(1, 20)
     
-    detections = []
-    for _ in range(num_detections):
-        pest_type = random.choice(PEST_CLASSES)
-        confidence = round(random.uniform(confidence_threshold, 0.99), 2)
-        
-        # Generate random bounding box coordinates
-        x = random.randint(50, 500)
-        y = random.randint(50, 500)
-        width = random.randint(30, 150)
-        height = random.randint(30, 150)
-        
-        zone = random.choice(["Zone A", "Zone B", "Zone C", "Zone D"])
-        
-        detections.append({
-            "pest_type": pest_type,
-            "confidence": confidence,
-            "bbox": {
-                "x": x,
-                "y": y,
-                "width": width,
-                "height": height
-            },
-            "zone": zone
-        })
+    # Random bounding boxes (x, y, width, height)
+    boxes = np.column_stack([
+        np.random.randint(50, 501, size=(num_detections, 2)),
+        np.random.randint(30, 151, size=(num_detections, 2))
+    ])
+    detections = Detections.from_arrays(
+        np.random.randint(0, len(PEST_CLASSES), num_detections),
+        np.round(np.random.uniform(confidence_threshold, 0.99, num_detections), 2),
+        boxes,
+        np.random.randint(0, len(ZONES), num_detections),
+        PEST_CLASSES, ZONES
+    )
     
     # Calculate affected area percentage
     affected_area_percentage = round(random.uniform(2.0, 25.0), 1)
     
+    return _summarize(detections, affected_area_percentage)
+
+def detect_pests_in_upload(upload_id: str, confidence_threshold: float = 0.75,
+                           processing_mode: Optional[str] = None) -> Optional[Dict]:
+    """
+    detect_pests() on a stored upload, reading only the overview level the
+    letterboxed model input needs from its tiled raster (app.rasters).
+    Boxes are returned in full-resolution pixels; None if the upload is missing.
+    """
+    region = rasters.read_region(upload_id, min_side=YOLO_INPUT_SIZE, processing_mode=processing_mode)
+    if region is None:
+        return None
+    pixels, scale = region
+    result = detect_pests(pixels, confidence_threshold)
+    if scale != 1.0:
+        result["pests"] = result["pests"].scaled(scale)
+    return result
+
+def _summarize(detections: Detections, affected_area_percentage: float) -> Dict:
     # Determine risk level based on number of detections
     if len(detections) > 15:
         risk_level = "HIGH"
@@ -88,13 +102,86 @@ def detect_pests(image_bytes: bytes, confidence_threshold: float = 0.75) -> Dict
         "total_detections": len(detections)
     }
 
-def preprocess_image(image_bytes: bytes) -> np.ndarray:
+def letterbox(image: Image.Image, size: int = YOLO_INPUT_SIZE) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """
+    Resize keeping aspect ratio and pad to a size x size NCHW float32 batch
+    
+    Returns:
+        (input tensor, scale factor, (pad_x, pad_y)) needed to map boxes back
+    """
+    image = image.convert("RGB")
+    scale = size / max(image.size)
+    resized = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR)
+    pad_x, pad_y = (size - resized.width) // 2, (size - resized.height) // 2
+    canvas = Image.new("RGB", (size, size), (114, 114, 114))
+    canvas.paste(resized, (pad_x, pad_y))
+    tensor = np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1)[np.newaxis] / 255.0
+    return tensor, scale, (pad_x, pad_y)
+
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> List[int]:
+    """Greedy NMS over (N, 4) x1y1x2y2 boxes; returns kept indices"""
+    order = scores.argsort()[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(int(best))
+        rest = order[1:]
+        xx1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        intersection = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return keep
+
+def _zone_ids(cx: np.ndarray, cy: np.ndarray, width: int, height: int) -> np.ndarray:
+    # Field split into quadrants: A | B over C | D
+    return 2 * (cy >= height / 2) + (cx >= width / 2)
+
+def _detect_with_model(backend, image: Union[bytes, np.ndarray], confidence_threshold: float) -> Dict:
+    """Run YOLOv8 ONNX inference and decode its (1, 4 + classes, anchors) output"""
+    image = to_image(image)
+    width, height = image.size
+    tensor, scale, (pad_x, pad_y) = letterbox(image)
+    
+    predictions = backend.run(tensor)[0][0].T.astype(np.float32)  # (anchors, 4 + classes)
+    class_scores = predictions[:, 4:]
+    class_ids = class_scores.argmax(axis=1)
+    confidences = class_scores[np.arange(len(class_ids)), class_ids]
+    mask = confidences >= confidence_threshold
+    predictions, class_ids, confidences = predictions[mask], class_ids[mask], confidences[mask]
+    
+    # cx, cy, w, h in letterboxed pixels -> x1, y1, x2, y2 in original pixels
+    cx = (predictions[:, 0] - pad_x) / scale
+    cy = (predictions[:, 1] - pad_y) / scale
+    w = predictions[:, 2] / scale
+    h = predictions[:, 3] / scale
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+    
+    keep = np.asarray(non_max_suppression(boxes, confidences, NMS_IOU_THRESHOLD), dtype=np.int64)
+    x1, y1, x2, y2 = boxes[keep].T
+    # Truncated to whole pixels like the stored JSON (x, y, width, height)
+    xywh = np.stack([x1.astype(np.int32), y1.astype(np.int32), (x2 - x1).astype(np.int32), (y2 - y1).astype(np.int32)], axis=1)
+    detections = Detections.from_arrays(
+        class_ids[keep], confidences[keep], xywh, _zone_ids(cx[keep], cy[keep], width, height),
+        PEST_CLASSES, ZONES
+    )
+    
+    box_area = detections.box_area()
+    affected_area_percentage = round(min(100.0, 100.0 * box_area / (width * height)), 1)
+    return _summarize(detections, affected_area_percentage)
+
+def preprocess_image(image: Union[bytes, np.ndarray]) -> np.ndarray:
     """
     Preprocess image for model input
     In a real implementation, this would resize, normalize, and convert the image
     """
-    # Convert bytes to PIL Image
-    image = Image.open(io.BytesIO(image_bytes))
+    # Convert bytes (or cached pixels) to PIL Image
+    image = to_image(image)
     
     # Convert to numpy array
     img_array = np.array(image)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, JSON, Boolean
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, JSON, Boolean, LargeBinary, Index
 from sqlalchemy.orm import relationship
 import uuid
 from datetime import datetime
@@ -49,8 +49,13 @@ class Analysis(Base):
     results_json = Column(JSON)
     confidence_score = Column(Float)
     processing_time_seconds = Column(Float)
-    status = Column(String, default="queued") # queued, processing, completed, failed
+    status = Column(String, default="queued") # queued, processing, completed, failed, cancelled
     created_at = Column(DateTime, default=datetime.utcnow)
+    client_key = Column(String, index=True)  # submitting client, for per-client admission limits
+    stage = Column(String)  # current task stage while processing (see app.progress)
+    progress = Column(Float)  # 0-1 within the task
+    cancel_requested = Column(Boolean)  # cancellation token, checked by the task at batch boundaries
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # drives app.subscriptions
     
     field = relationship("Field", back_populates="analyses")
 
@@ -62,11 +67,134 @@ class Upload(Base):
     content_type = Column(String)
     size = Column(Integer)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
+    storage_key = Column(String)  # object the upload is read from (app.storage)
+    
+    # Filled by bulk ingestion (app.ingest)
+    field_id = Column(String, ForeignKey("fields.id"), index=True)
+    sha256 = Column(String, index=True)
+    source_path = Column(String)
+    captured_at = Column(DateTime)
+    gps_latitude = Column(Float)
+    gps_longitude = Column(Float)
+    
+    # Read from the file headers at upload time (app.image_probe)
+    image_format = Column(String)
+    width = Column(Integer)
+    height = Column(Integer)
+    bands = Column(Integer)
+    bit_depth = Column(Integer)
+    tiled = Column(Boolean)
+    compression = Column(String)
+    processing_mode = Column(String)  # in_memory or tiled
+    
+    # Compact tiled copy written after upload (app.rasters)
+    raster_key = Column(String)
+    raster_bytes = Column(Integer)
 
 class Report(Base):
     __tablename__ = "reports"
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    field_id = Column(String, ForeignKey("fields.id"), index=True)
     generated_at = Column(DateTime, default=datetime.utcnow)
     summary = Column(Text)
     findings = Column(JSON)
     recommendations = Column(JSON)
+    inputs_hash = Column(String)  # fingerprint of the aggregates the report was built from
+    json_path = Column(String)    # storage keys of the rendered artifacts (app.storage)
+    html_path = Column(String)
+
+class FieldState(Base):
+    """Latest per-field, per-analysis-type aggregates, cached for change detection"""
+    __tablename__ = "field_states"
+    field_id = Column(String, ForeignKey("fields.id"), primary_key=True)
+    analysis_type = Column(String, primary_key=True)
+    analysis_id = Column(String, ForeignKey("analyses.id"))
+    zone_values = Column(JSON)  # {metric: {zone: value}}
+    grid = Column(LargeBinary)               # float16 GRID_SIZE x GRID_SIZE metric raster
+    registration_grid = Column(LargeBinary)  # float16 vegetation raster of the image, for alignment
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class FieldChange(Base):
+    """Compact delta between two successive analyses of the same field"""
+    __tablename__ = "field_changes"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    field_id = Column(String, ForeignKey("fields.id"))
+    analysis_type = Column(String)
+    analysis_id = Column(String, ForeignKey("analyses.id"))
+    previous_analysis_id = Column(String, ForeignKey("analyses.id"))
+    zone_deltas = Column(JSON)    # {metric: {zone: delta}}
+    grid_summary = Column(JSON)   # shift, mean delta, share of cells worse, worst cells
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_field_changes_field_created", "field_id", "created_at"),
+    )
+
+class FieldForecast(Base):
+    """Incrementally updated yield forecasting state for one field"""
+    __tablename__ = "field_forecasts"
+    field_id = Column(String, ForeignKey("fields.id"), primary_key=True)
+    features = Column(JSON)  # see forecasting.FEATURES
+    history = Column(JSON)   # recent model predictions [{date, predicted_yield}]
+    forecast_yield = Column(Float)
+    forecast_days_to_harvest = Column(Integer)
+    forecast_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ReplicationLog(Base):
+    """Edge side: one row per change to a replicated table, written by triggers (app.replication)"""
+    __tablename__ = "replication_log"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String)
+    row_id = Column(String)
+    op = Column(String)  # upsert or delete
+    changed_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Sequence numbers are never reused after the log is pruned
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class ReplicationPeer(Base):
+    """Central side: how far each edge unit's change log has been applied"""
+    __tablename__ = "replication_peers"
+    edge_id = Column(String, primary_key=True)
+    last_seq = Column(Integer, default=0)
+    rows_applied = Column(Integer, default=0)
+    last_batch_at = Column(DateTime)
+
+class AlertRule(Base):
+    """User-defined condition over analysis results (app.alerts)"""
+    __tablename__ = "alert_rules"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    name = Column(String)
+    field_id = Column(String, ForeignKey("fields.id"), index=True)  # NULL = every field
+    analysis_type = Column(String)
+    condition = Column(JSON)  # see app.alerts.CONDITION_TYPES
+    sink = Column(String, default="queue")  # queue or webhook
+    target = Column(String)  # webhook URL
+    throttle_seconds = Column(Integer)  # NULL = ALERT_THROTTLE_SECONDS
+    enabled = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class Alert(Base):
+    """One rule match: delivered, queued for polling, suppressed by throttling or failed"""
+    __tablename__ = "alerts"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    rule_id = Column(String, ForeignKey("alert_rules.id", ondelete="CASCADE"))
+    field_id = Column(String, ForeignKey("fields.id"))
+    analysis_id = Column(String, ForeignKey("analyses.id"))
+    message = Column(Text)
+    payload = Column(JSON)
+    status = Column(String)  # pending, queued, delivered, acknowledged, suppressed or failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime)  # pending alerts: retry (or delivery lease) time, see app.alerts
+    created_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime)
+    
+    __table_args__ = (
+        # Dedupe: a rule fires at most once per analysis, however often completion hooks rerun
+        Index("ix_alerts_rule_analysis", "rule_id", "analysis_id", unique=True),
+        Index("ix_alerts_rule_field_created", "rule_id", "field_id", "created_at"),
+        Index("ix_alerts_field_created", "field_id", "created_at"),
+        Index("ix_alerts_status_next_attempt", "status", "next_attempt_at"),
+    )
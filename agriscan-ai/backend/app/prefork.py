@@ -0,0 +1,181 @@
+"""
+Pre-forked production serving.
+
+`uvicorn --workers N` spawns N fresh interpreters, each importing the app and
+loading every model itself, so N workers cost N copies of the weights. Here a
+master process imports the app, the model modules and their lookup tables and
+builds the inference sessions once, freezes the GC so those objects' pages
+stay untouched, binds the listening socket and then fork()s the workers. The
+workers share the master's pages copy-on-write; only what a worker writes
+(request state, per-worker caches) becomes private memory.
+
+Forking is only safe before threads exist: the master starts none, BLAS
+thread pools are sized through the environment before numpy is imported, and
+ONNX Runtime sessions are only built in the master when they run without a
+thread pool (SERVE_THREADS_PER_WORKER=1). With more threads per worker each
+worker builds its own sessions after the fork.
+
+The master also runs the migrations. It marks both in the environment the
+workers inherit, and app.main's lifespan then skips init_db() and the model
+warm-up; each worker still starts its own alert dispatcher (deliveries are
+leased per alert, app.alerts).
+
+The master restarts workers that die and forwards SIGINT/SIGTERM to them for
+a graceful shutdown. POSIX only.
+"""
+import asyncio
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from app.config import settings
+
+# Thread pools read these when numpy / ONNX Runtime first load
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+# A worker dying sooner than this after its start is not restarted in a tight loop
+RESTART_BACKOFF_SECONDS = 1.0
+# Set by the master for its workers: migrations ran / inference sessions were built before the fork
+MIGRATED_ENV = "AGRISCAN_PREFORK_MIGRATED"
+MODELS_PRELOADED_ENV = "AGRISCAN_PREFORK_MODELS_PRELOADED"
+
+
+def worker_count() -> int:
+    return settings.SERVE_WORKERS or os.cpu_count() or 1
+
+
+def limit_threads(threads: int):
+    """Size BLAS/OpenMP and ONNX Runtime thread pools; call before importing numpy"""
+    if "numpy" in sys.modules:
+        print("Warning: numpy already imported, BLAS thread settings may not apply")
+    for name in THREAD_ENV_VARS:
+        os.environ.setdefault(name, str(threads))
+    if settings.ORT_INTRA_OP_THREADS == 0:
+        settings.ORT_INTRA_OP_THREADS = threads
+    if settings.ORT_INTER_OP_THREADS == 0:
+        settings.ORT_INTER_OP_THREADS = 1
+
+
+def preload():
+    """Import the app and build everything read-only the workers will share"""
+    from app import main  # noqa: F401 - the ASGI app, schemas, serializers, lookup tables
+    from app import change_detection, detections, forecasting, recommendations  # noqa: F401
+    from app.database import init_db
+    from app.ml_models import backends, pest_detection, yield_prediction, nutrient_analysis  # noqa: F401
+
+    # Migrations run once here rather than racing in every worker's lifespan
+    init_db()
+    os.environ[MIGRATED_ENV] = "1"
+
+    if settings.ORT_INTRA_OP_THREADS == 1 and settings.ORT_INTER_OP_THREADS <= 1:
+        for name in (pest_detection.PEST_MODEL_NAME, yield_prediction.YIELD_MODEL_NAME):
+            backends.get_backend(name)
+        os.environ[MODELS_PRELOADED_ENV] = "1"
+    elif settings.INFERENCE_BACKEND != "mock":
+        print("Models load in each worker: sessions with thread pools can't be shared across fork()")
+
+    if threading.active_count() > 1:
+        names = ", ".join(t.name for t in threading.enumerate() if t is not threading.main_thread())
+        print(f"Warning: threads running before fork ({names}); they will not exist in the workers")
+
+
+def bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(sock: socket.socket):
+    import anyio.to_thread
+    import uvicorn
+    from app.database import engine
+    from app.main import app
+
+    # Connections opened by the master (migrations) belong to it; open our own
+    engine.dispose(close=False)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    config = uvicorn.Config(app, log_level="info", lifespan="on")
+    server = uvicorn.Server(config)
+
+    async def serve():
+        # Threadpool for sync endpoints and run_in_threadpool, per worker
+        anyio.to_thread.current_default_thread_limiter().total_tokens = settings.SERVE_THREADPOOL_SIZE
+        await server.serve(sockets=[sock])
+
+    asyncio.run(serve())
+
+
+class Master:
+    def __init__(self, sock: socket.socket, workers: int):
+        self.sock = sock
+        self.workers = workers
+        self.children: Dict[int, float] = {}  # pid -> start time
+        self.stopping = False
+
+    def spawn(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(self.sock)
+            except BaseException as e:
+                print(f"Worker {os.getpid()} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        return pid
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        print(f"Master {os.getpid()} serving with {self.workers} workers: {sorted(self.children)}")
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            print(f"Worker {pid} exited ({os.waitstatus_to_exitcode(status)}), restarting")
+            if time.monotonic() - started < RESTART_BACKOFF_SECONDS:
+                time.sleep(RESTART_BACKOFF_SECONDS)
+            self.spawn()
+        self.sock.close()
+        return 0
+
+
+def serve(host: Optional[str] = None, port: Optional[int] = None, workers: Optional[int] = None) -> int:
+    limit_threads(settings.SERVE_THREADS_PER_WORKER)
+    workers = workers or worker_count()
+    started = time.perf_counter()
+    preload()
+    print(f"Preloaded app and models in {time.perf_counter() - started:.1f}s")
+    sock = bind(host or settings.SERVE_HOST, port or settings.SERVE_PORT)
+    # Objects created so far are shared with the workers: keep the collector from writing to them
+    gc.collect()
+    gc.freeze()
+    return Master(sock, workers).run()
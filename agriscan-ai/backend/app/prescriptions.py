@@ -0,0 +1,485 @@
+"""
+Variable-rate prescription maps from nutrient rasters.
+
+A nutrient analysis gives one field-wide deficiency and rate; a variable-rate
+sprayer needs a rate per location. The prescription engine:
+  1. computes NDVI (and NDRE when the imagery has a red-edge band) per pixel
+     with the nutrient model's index functions,
+  2. classifies valid pixels into N management zones, ordered from weakest to
+     strongest vigor: by k-means on the index values (fitted on a sample,
+     assigned vectorized), by equal-area quantiles or by fixed thresholds,
+  3. turns each zone's shortfall against the field's high-vigor reference into
+     a deficiency and an application rate through app.recommendations, so the
+     zone rates follow the same rules as the field-wide advice,
+  4. lays a grid of PRESCRIPTION_CELL_METERS cells over the raster, gives each
+     cell its majority zone, and merges equal neighbouring cells into
+     rectangles for export.
+
+Nitrogen zones use NDRE when available (it keeps tracking chlorophyll where
+NDVI saturates in dense canopy); other nutrients and RGB-only imagery use
+NDVI (or the VARI proxy).
+
+The grid is georeferenced to the bounding box of the field's GeoJSON polygon
+(imagery is assumed to be clipped to the field). Fields without a polygon get
+coordinates in metres from the raster's top-left corner, scaled from the
+field's area. Output is a GeoJSON FeatureCollection with one MultiPolygon per
+zone, or a zipped ESRI shapefile (.shp/.shx/.dbf/.prj) for controllers that
+only take shapefiles.
+
+numpy and the nutrient model are imported inside the functions that use them,
+since app.main imports this module.
+"""
+import io
+import json
+import math
+import struct
+import zipfile
+from dataclasses import dataclass, field
+from datetime import date
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.recommendations import ADEQUATE_DEFICIENCY, NUTRIENT_RATES, application_rate
+
+if TYPE_CHECKING:
+    import numpy as np
+
+METHODS = ("kmeans", "quantile", "threshold")
+FORMATS = {"geojson": "application/geo+json", "shapefile": "application/zip"}
+MAX_ZONES = 7
+# Break points for method=threshold (zones = len + 1). NDRE runs well below
+# NDVI over the same canopy, so it gets its own
+NDVI_THRESHOLDS = (0.3, 0.5, 0.7)
+NDRE_THRESHOLDS = (0.2, 0.3, 0.4)
+# Quantiles, k-means centres and the reference vigor come from at most this
+# many pixels; every pixel is then assigned
+SAMPLE_SIZE = 100_000
+KMEANS_ITERATIONS = 20
+# Reference "healthy" vigor for deficiency estimates
+REFERENCE_PERCENTILE = 95
+METRES_PER_DEGREE = 111_320.0
+COORDINATE_DECIMALS = 7  # ~1 cm in degrees
+WGS84_PRJ = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+             'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+
+
+@dataclass
+class Georeference:
+    """Maps raster pixel edges to output coordinates"""
+    left: float
+    top: float
+    x_per_pixel: float
+    y_per_pixel: float  # negative: rows run southwards
+    metres_per_pixel: float
+    geographic: bool
+
+    def x(self, column):
+        return self.left + column * self.x_per_pixel
+
+    def y(self, row):
+        return self.top + row * self.y_per_pixel
+
+
+@dataclass
+class Prescription:
+    nutrient: str
+    method: str
+    index: str
+    cell_size_m: float
+    georef: Georeference
+    zones: List[Dict]
+    grid: "np.ndarray"  # zone number per cell, 0 = no data
+    cell_pixels: int
+    rectangles: List[Tuple[int, int, int, int, int]] = field(default_factory=list)  # zone, row0, row1, col0, col1
+
+    def summary(self) -> Dict:
+        return {
+            "nutrient": self.nutrient,
+            "method": self.method,
+            "index": self.index,
+            "cell_size_m": round(self.cell_size_m, 2),
+            "grid_size": list(self.grid.shape[::-1]),
+            "total_product_kg": round(sum(zone["product_kg"] for zone in self.zones), 1),
+            "zones": self.zones,
+        }
+
+    def _zone_rings(self) -> Dict[int, List[List[Tuple[float, float]]]]:
+        """Counter-clockwise rectangle rings per zone (GeoJSON winding)"""
+        georef, cell = self.georef, self.cell_pixels
+        rings: Dict[int, List[List[Tuple[float, float]]]] = {zone["zone"]: [] for zone in self.zones}
+        decimals = COORDINATE_DECIMALS if georef.geographic else 2
+        for zone, row0, row1, col0, col1 in self.rectangles:
+            x0, x1 = round(georef.x(col0 * cell), decimals), round(georef.x(col1 * cell), decimals)
+            y0, y1 = round(georef.y(row1 * cell), decimals), round(georef.y(row0 * cell), decimals)
+            rings[zone].append([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)])
+        return rings
+
+    def to_geojson(self) -> Dict:
+        rings = self._zone_rings()
+        features = []
+        for zone in self.zones:
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "MultiPolygon", "coordinates": [[ring] for ring in rings[zone["zone"]]]},
+                "properties": zone,
+            })
+        collection = {"type": "FeatureCollection", "features": features, "properties": self.summary()}
+        collection["properties"].pop("zones")
+        if not self.georef.geographic:
+            collection["properties"]["crs"] = "local metres east/north of the image's top-left corner"
+        return collection
+
+    def to_shapefile(self, name: str = "prescription") -> bytes:
+        """Zipped polygon shapefile, one record per zone"""
+        rings = self._zone_rings()
+        records = []
+        for zone in self.zones:
+            # Shapefile outer rings run clockwise
+            parts = [ring[::-1] for ring in rings[zone["zone"]]]
+            records.append((parts, zone))
+        shp, shx = _shapefile_geometry([parts for parts, _ in records])
+        dbf = _dbf([zone for _, zone in records], self.nutrient)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(f"{name}.shp", shp)
+            archive.writestr(f"{name}.shx", shx)
+            archive.writestr(f"{name}.dbf", dbf)
+            if self.georef.geographic:
+                archive.writestr(f"{name}.prj", WGS84_PRJ)
+        return buffer.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Georeferencing
+# ---------------------------------------------------------------------------
+
+def _coordinates(geometry) -> List[Tuple[float, float]]:
+    if isinstance(geometry, dict):
+        if geometry.get("type") == "Feature":
+            return _coordinates(geometry.get("geometry"))
+        return _coordinates(geometry.get("coordinates"))
+    if isinstance(geometry, (list, tuple)):
+        if len(geometry) >= 2 and all(isinstance(v, (int, float)) for v in geometry[:2]):
+            return [(float(geometry[0]), float(geometry[1]))]
+        return [point for item in geometry for point in _coordinates(item)]
+    return []
+
+
+def georeference(shape: Tuple[int, int], location: Optional[Dict] = None,
+                 area_hectares: Optional[float] = None, valid_pixels: Optional[int] = None) -> Georeference:
+    """Stretch the raster over the field polygon's bounding box, else over the field's area"""
+    height, width = shape
+    points = _coordinates(location) if location else []
+    if points:
+        lons, lats = zip(*points)
+        west, east, south, north = min(lons), max(lons), min(lats), max(lats)
+        if east > west and north > south:
+            x_per_pixel = (east - west) / width
+            y_per_pixel = (south - north) / height
+            scale = METRES_PER_DEGREE * math.cos(math.radians((north + south) / 2))
+            metres = math.sqrt(x_per_pixel * scale * -y_per_pixel * METRES_PER_DEGREE)
+            return Georeference(west, north, x_per_pixel, y_per_pixel, metres, True)
+    if area_hectares:
+        metres = math.sqrt(area_hectares * 10_000 / max(1, valid_pixels or width * height))
+    else:
+        metres = 1.0
+    return Georeference(0.0, 0.0, metres, -metres, metres, False)
+
+
+# ---------------------------------------------------------------------------
+# Zoning
+# ---------------------------------------------------------------------------
+
+def _sample(values: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+    if len(values) <= SAMPLE_SIZE:
+        return values
+    return values[np.random.default_rng(0).choice(len(values), SAMPLE_SIZE, replace=False)]
+
+
+def _bucket(values: "np.ndarray", bounds) -> "np.ndarray":
+    """Index of the interval between sorted bounds (one comparison pass per bound)"""
+    import numpy as np
+    labels = np.zeros(values.shape, dtype=np.uint8)
+    for bound in bounds:
+        labels += values > bound
+    return labels
+
+
+def _kmeans_1d(values: "np.ndarray", zones: int) -> "np.ndarray":
+    """Sorted cluster boundaries (zones - 1 midpoints between centres)"""
+    import numpy as np
+    values = np.sort(_sample(values)).astype(np.float64)
+    centres = np.quantile(values, (np.arange(zones) + 0.5) / zones)
+    for _ in range(KMEANS_ITERATIONS):
+        bounds = (centres[1:] + centres[:-1]) / 2
+        # Sorted values: every cluster is a contiguous slice
+        edges = np.concatenate(([0], np.searchsorted(values, bounds), [values.size]))
+        sums = np.add.reduceat(values, np.minimum(edges[:-1], values.size - 1))
+        counts = np.diff(edges)
+        updated = np.where(counts > 0, sums / np.maximum(counts, 1), centres)
+        if np.allclose(updated, centres, atol=1e-5):
+            break
+        centres = np.sort(updated)
+    return (centres[1:] + centres[:-1]) / 2
+
+
+def _nearest(first: "np.ndarray", second: "np.ndarray", centres: "np.ndarray") -> "np.ndarray":
+    """Closest centre per point: argmax of 2 x.c - |c|^2, accumulated in place"""
+    import numpy as np
+    best = np.full(first.shape, -np.inf, dtype=np.float32)
+    score = np.empty_like(best)
+    partial = np.empty_like(best)
+    labels = np.zeros(first.shape, dtype=np.uint8)
+    for i, (a, b) in enumerate(centres):
+        np.multiply(first, np.float32(2 * a), out=score)
+        np.multiply(second, np.float32(2 * b), out=partial)
+        score += partial
+        score -= np.float32(a * a + b * b)
+        closer = score > best
+        np.putmask(labels, closer, i)
+        np.maximum(best, score, out=best)
+    return labels
+
+
+def _kmeans_2d(first: "np.ndarray", second: "np.ndarray", zones: int) -> "np.ndarray":
+    """Zone index per pixel from joint k-means, clusters ordered by their mean of first"""
+    import numpy as np
+    scale = [(float(v.mean()), float(v.std()) + 1e-9) for v in (first, second)]
+    first, second = ((v - np.float32(m)) / np.float32(sd) for v, (m, sd) in zip((first, second), scale))
+    picked = _sample(np.arange(len(first)))
+    sample = np.stack([first[picked], second[picked]], axis=1)
+    order = np.argsort(sample[:, 0])
+    centres = sample[order[((np.arange(zones) + 0.5) / zones * len(order)).astype(int)]].astype(np.float64)
+    for _ in range(KMEANS_ITERATIONS):
+        labels = _nearest(sample[:, 0], sample[:, 1], centres)
+        counts = np.bincount(labels, minlength=zones)
+        sums = np.stack([np.bincount(labels, sample[:, i], minlength=zones) for i in range(2)], axis=1)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centres)
+        if np.allclose(updated, centres, atol=1e-4):
+            break
+        centres = updated
+    rank = np.argsort(np.argsort(centres[:, 0])).astype(np.uint8)
+    return rank[_nearest(first, second, centres)]
+
+
+def classify(index: "np.ndarray", zones: int, method: str, secondary: Optional["np.ndarray"] = None,
+             thresholds: Tuple[float, ...] = NDVI_THRESHOLDS) -> "np.ndarray":
+    """
+    Zone number per pixel (1 = weakest vigor, 0 = no data). secondary, when
+    given with method=kmeans, is clustered jointly with index; thresholds are
+    the index's break points for method=threshold.
+    """
+    import numpy as np
+    valid = np.isfinite(index)
+    if secondary is not None:
+        valid &= np.isfinite(secondary)
+    values = index[valid]
+    labels = np.zeros(index.shape, dtype=np.uint8)
+    if values.size == 0:
+        return labels
+    if method == "threshold":
+        assigned = _bucket(values, thresholds)
+    elif method == "quantile":
+        assigned = _bucket(values, np.quantile(_sample(values), np.arange(1, zones) / zones))
+    elif secondary is not None:
+        assigned = _kmeans_2d(values, secondary[valid], zones)
+    else:
+        assigned = _bucket(values, _kmeans_1d(values, zones))
+    labels[valid] = assigned + 1
+    return labels
+
+
+# ---------------------------------------------------------------------------
+# Grid and rectangles
+# ---------------------------------------------------------------------------
+
+def _majority_grid(labels: "np.ndarray", cell: int, zones: int) -> "np.ndarray":
+    """Most common zone per cell x cell block (0 when the block has no data)"""
+    import numpy as np
+    height, width = labels.shape
+    rows, cols = -(-height // cell), -(-width // cell)
+    cell_ids = (np.arange(height) // cell)[:, None] * cols + (np.arange(width) // cell)[None, :]
+    counts = np.bincount((cell_ids * (zones + 1) + labels).ravel(), minlength=rows * cols * (zones + 1))
+    counts = counts.reshape(rows * cols, zones + 1)
+    counts[:, 0] = 0
+    grid = counts.argmax(axis=1).astype(np.uint8)
+    return grid.reshape(rows, cols)
+
+
+def _rectangles(grid: "np.ndarray") -> List[Tuple[int, int, int, int, int]]:
+    """
+    Cover each zone's cells with rectangles: horizontal runs per row, extended
+    downwards while the next row has the identical run.
+    """
+    import numpy as np
+    done: List[Tuple[int, int, int, int, int]] = []
+    open_runs: Dict[Tuple[int, int, int], int] = {}  # (zone, col0, col1) -> first row
+    for row in range(grid.shape[0]):
+        line = grid[row]
+        starts = np.flatnonzero(np.concatenate(([True], line[1:] != line[:-1])))
+        ends = np.concatenate((starts[1:], [line.size]))
+        runs = {(int(line[s]), int(s), int(e)) for s, e in zip(starts, ends) if line[s]}
+        for key in list(open_runs):
+            if key not in runs:
+                zone, col0, col1 = key
+                done.append((zone, open_runs.pop(key), row, col0, col1))
+        for key in runs:
+            open_runs.setdefault(key, row)
+    for (zone, col0, col1), row0 in open_runs.items():
+        done.append((zone, row0, grid.shape[0], col0, col1))
+    done.sort()
+    return done
+
+
+# ---------------------------------------------------------------------------
+# Prescription
+# ---------------------------------------------------------------------------
+
+def build(ndvi: "np.ndarray", ndre: Optional["np.ndarray"] = None, nutrient: str = "nitrogen",
+          zones: Optional[int] = None, method: str = "kmeans", cell_size_m: Optional[float] = None,
+          location: Optional[Dict] = None, area_hectares: Optional[float] = None) -> Prescription:
+    """Prescription from index rasters (NaN = no data) of one field"""
+    import numpy as np
+    if nutrient not in NUTRIENT_RATES:
+        raise ValueError(f"Unknown nutrient {nutrient}")
+    if method not in METHODS:
+        raise ValueError(f"Unknown zoning method {method}")
+    zones = len(NDVI_THRESHOLDS) + 1 if method == "threshold" else zones or settings.PRESCRIPTION_ZONES
+    if not 2 <= zones <= MAX_ZONES:
+        raise ValueError(f"zones must be between 2 and {MAX_ZONES}")
+    cell_size_m = cell_size_m or settings.PRESCRIPTION_CELL_METERS
+
+    use_ndre = ndre is not None and nutrient == "nitrogen"
+    index = ndre if use_ndre else ndvi
+    secondary = ndvi if use_ndre and method == "kmeans" else None
+    labels = classify(index, zones, method, secondary, NDRE_THRESHOLDS if use_ndre else NDVI_THRESHOLDS)
+
+    valid = labels > 0
+    zone_of, values = labels[valid], index[valid]
+    counts = np.bincount(labels.ravel(), minlength=zones + 1)
+    index_means = np.bincount(zone_of, values, minlength=zones + 1) / np.maximum(counts, 1)
+    ndvi_means = np.bincount(zone_of, ndvi[valid], minlength=zones + 1) / np.maximum(counts, 1) if use_ndre else index_means
+    georef = georeference(labels.shape, location, area_hectares, int(counts[1:].sum()))
+    pixel_hectares = georef.metres_per_pixel ** 2 / 10_000
+
+    # Shortfall of each zone against the field's healthy canopy, as in a sufficiency index
+    reference = float(np.percentile(_sample(values), REFERENCE_PERCENTILE)) if values.size else 0.0
+    zone_rows = []
+    for zone in range(1, zones + 1):
+        if counts[zone] == 0:
+            continue
+        shortfall = (reference - index_means[zone]) / reference if reference > 0 else 0.0
+        deficiency = 100.0 * min(max(float(shortfall), 0.0), 1.0)
+        rate = application_rate(nutrient, deficiency) if deficiency > ADEQUATE_DEFICIENCY else 0
+        area = float(counts[zone] * pixel_hectares)
+        row = {
+            "zone": zone,
+            "rate_kg_ha": rate,
+            "area_ha": round(area, 3),
+            "product_kg": round(rate * area, 1),
+            "mean_ndvi": round(float(ndvi_means[zone]), 3),
+            "deficiency_percentage": round(deficiency, 1),
+        }
+        if use_ndre:
+            row["mean_ndre"] = round(float(index_means[zone]), 3)
+        zone_rows.append(row)
+
+    cell = max(1, int(round(cell_size_m / georef.metres_per_pixel)))
+    grid = _majority_grid(labels, cell, zones)
+    return Prescription(
+        nutrient=nutrient, method=method, index="ndre" if use_ndre else "ndvi",
+        cell_size_m=cell * georef.metres_per_pixel, georef=georef, zones=zone_rows,
+        grid=grid, cell_pixels=cell, rectangles=_rectangles(grid),
+    )
+
+
+def for_pixels(pixels: "np.ndarray", **options) -> Prescription:
+    from app.ml_models.nutrient_analysis import index_rasters
+    ndvi, ndre = index_rasters(pixels)
+    return build(ndvi, ndre, **options)
+
+
+def for_analysis(analysis, **options) -> Optional[Prescription]:
+    """Prescription from the imagery of a nutrient analysis (None if it's gone)"""
+    from pathlib import Path
+
+    from app import rasters
+    if not analysis.original_image_url:
+        return None
+    region = rasters.read_region(Path(analysis.original_image_url).stem, min_side=settings.PRESCRIPTION_MAX_SIDE)
+    if region is None:
+        return None
+    field_row = analysis.field
+    if field_row is not None:
+        options.setdefault("location", field_row.location)
+        options.setdefault("area_hectares", field_row.area_hectares)
+    return for_pixels(region[0], **options)
+
+
+# ---------------------------------------------------------------------------
+# Shapefile writing
+# ---------------------------------------------------------------------------
+
+def _shapefile_header(file_words: int, bbox: Tuple[float, float, float, float]) -> bytes:
+    return (struct.pack(">7i", 9994, 0, 0, 0, 0, 0, file_words)
+            + struct.pack("<2i4d4d", 1000, 5, *bbox, 0.0, 0.0, 0.0, 0.0))
+
+
+def _shapefile_geometry(records: List[List[List[Tuple[float, float]]]]) -> Tuple[bytes, bytes]:
+    """.shp and .shx for polygon records (each a list of rings)"""
+    import numpy as np
+    contents = []
+    for parts in records:
+        points = [point for ring in parts for point in ring]
+        xs = [x for x, _ in points] or [0.0]
+        ys = [y for _, y in points] or [0.0]
+        offsets, total = [], 0
+        for ring in parts:
+            offsets.append(total)
+            total += len(ring)
+        body = struct.pack("<i4d2i", 5, min(xs), min(ys), max(xs), max(ys), len(parts), len(points))
+        body += struct.pack(f"<{len(offsets)}i", *offsets)
+        body += np.asarray(points, dtype="<f8").tobytes()
+        contents.append((body, (min(xs), min(ys), max(xs), max(ys))))
+    boxes = [box for _, box in contents] or [(0.0, 0.0, 0.0, 0.0)]
+    bbox = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    shp, shx, offset = [], [], 50  # in 16-bit words, after the 100-byte header
+    for number, (body, _) in enumerate(contents, 1):
+        words = len(body) // 2
+        shp.append(struct.pack(">2i", number, words) + body)
+        shx.append(struct.pack(">2i", offset, words))
+        offset += 4 + words
+    shp_bytes = _shapefile_header(offset, bbox) + b"".join(shp)
+    shx_bytes = _shapefile_header(50 + 4 * len(contents), bbox) + b"".join(shx)
+    return shp_bytes, shx_bytes
+
+
+def _dbf(zones: List[Dict], nutrient: str) -> bytes:
+    """dBase III attribute table: ZONE, RATE (kg/ha), AREA_HA, NDVI, NUTRIENT"""
+    columns = [("ZONE", "N", 4, 0), ("RATE", "N", 10, 1), ("AREA_HA", "N", 12, 3),
+               ("NDVI", "N", 8, 3), ("NUTRIENT", "C", 12, 0)]
+    record_length = 1 + sum(width for _, _, width, _ in columns)
+    header_length = 32 + 32 * len(columns) + 1
+    today = date.today()
+    out = [struct.pack("<4BIHH20x", 3, today.year - 1900, today.month, today.day, len(zones),
+                       header_length, record_length)]
+    for name, kind, width, decimals in columns:
+        out.append(struct.pack("<11sc4xBB14x", name.encode(), kind.encode(), width, decimals))
+    out.append(b"\r")
+    for zone in zones:
+        values = (zone["zone"], zone["rate_kg_ha"], zone["area_ha"], zone["mean_ndvi"], nutrient)
+        record = b" "
+        for (_, kind, width, decimals), value in zip(columns, values):
+            text = f"{value:>{width}.{decimals}f}" if kind == "N" else f"{value:<{width}}"
+            record += text[:width].encode("ascii")
+        out.append(record)
+    out.append(b"\x1a")
+    return b"".join(out)
+
+
+def encode(prescription: Prescription, format: str) -> bytes:
+    if format == "geojson":
+        return json.dumps(prescription.to_geojson(), separators=(",", ":")).encode()
+    return prescription.to_shapefile()
@@ -0,0 +1,128 @@
+"""
+Progress reporting and cooperative cancellation for analysis tasks.
+
+A running task holds a TaskProgress and calls report(stage, fraction) at
+tile/batch boundaries. Progress is written to the analysis row (throttled),
+so the WebSocket and GET /api/analysis/{id} see it from any process.
+
+Cancellation is a token on the analysis row (cancel_requested), set by
+DELETE /api/analysis/{id}. Tasks never get killed mid-write: report() also
+checks the token and raises Cancelled at the next boundary, and the task
+cleans up in its normal finally blocks. In-process cancellations (no Celery)
+are also signalled through an Event so they take effect immediately.
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from app import metrics
+from app.models import Analysis
+
+# At most one progress write / cancellation read per task per interval
+WRITE_INTERVAL_SECONDS = 0.5
+
+_local_tokens: Dict[str, threading.Event] = {}
+_tokens_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    pass
+
+
+def request_cancel(db: Session, analysis: Analysis) -> bool:
+    """Set the cancellation token; returns False if the analysis already finished"""
+    if analysis.status not in ("queued", "processing"):
+        return False
+    analysis.cancel_requested = True
+    if analysis.status == "queued":
+        # Not picked up yet: nothing to interrupt, the worker skips it on start
+        analysis.status = "cancelled"
+        metrics.incr("tasks", "cancelled_before_start")
+    db.commit()
+    with _tokens_lock:
+        event = _local_tokens.get(analysis.id)
+    if event is not None:
+        event.set()
+    return True
+
+
+class TaskProgress:
+    def __init__(self, db: Session, analysis_id: str, expected_seconds: Optional[float] = None):
+        self.db = db
+        self.analysis_id = analysis_id
+        self.expected_seconds = expected_seconds
+        self.stage = None
+        self.fraction = 0.0
+        self.started = time.perf_counter()
+        self._last_write = 0.0
+        self._event = threading.Event()
+
+    def __enter__(self):
+        with _tokens_lock:
+            _local_tokens[self.analysis_id] = self._event
+            metrics.set_gauge("tasks", "running", len(_local_tokens))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with _tokens_lock:
+            _local_tokens.pop(self.analysis_id, None)
+            metrics.set_gauge("tasks", "running", len(_local_tokens))
+        if exc_type is Cancelled:
+            self._record_cancellation()
+            return True  # swallowed: cancellation is a normal outcome
+        return False
+
+    def start(self):
+        """Claim a queued analysis; raises Cancelled if it was cancelled before it started"""
+        updated = self.db.query(Analysis).filter(
+            Analysis.id == self.analysis_id,
+            Analysis.status == "queued",
+            Analysis.cancel_requested.isnot(True)
+        ).update({"status": "processing", "stage": "starting", "progress": 0.0}, synchronize_session=False)
+        self.db.commit()
+        if not updated:
+            metrics.incr("tasks", "skipped_cancelled")
+            raise Cancelled()
+
+    def report(self, stage: str, fraction: float):
+        """Record progress within the task (0-1); raises Cancelled if a cancel was requested"""
+        self.fraction = max(0.0, min(1.0, fraction))
+        stage_changed = stage != self.stage
+        self.stage = stage
+        now = time.perf_counter()
+        if self._event.is_set():
+            raise Cancelled()
+        if not stage_changed and now - self._last_write < WRITE_INTERVAL_SECONDS:
+            return
+        self._last_write = now
+        cancel_requested = self.db.query(Analysis.cancel_requested).filter(
+            Analysis.id == self.analysis_id
+        ).scalar()
+        if cancel_requested:
+            raise Cancelled()
+        self.db.query(Analysis).filter(Analysis.id == self.analysis_id).update(
+            {"stage": stage, "progress": round(self.fraction, 3)}, synchronize_session=False
+        )
+        self.db.commit()
+
+    def _record_cancellation(self):
+        self.db.rollback()
+        if self.stage is None:
+            return  # cancelled before start(); already recorded by request_cancel
+        self.db.query(Analysis).filter(Analysis.id == self.analysis_id).update(
+            {"status": "cancelled", "stage": self.stage}, synchronize_session=False
+        )
+        self.db.commit()
+        metrics.incr("tasks", "cancelled")
+        elapsed = time.perf_counter() - self.started
+        metrics.incr("tasks", "cancelled_seconds_spent", elapsed)
+        # Worker time freed by stopping early
+        if self.expected_seconds:
+            remaining = max(0.0, self.expected_seconds - elapsed)
+        elif self.fraction > 0:
+            remaining = elapsed * (1 - self.fraction) / self.fraction
+        else:
+            remaining = 0.0
+        metrics.incr("tasks", "cancelled_seconds_reclaimed", remaining)
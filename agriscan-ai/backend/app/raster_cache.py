@@ -0,0 +1,205 @@
+"""
+Decoded-pixel cache for uploads.
+
+Decoding a large JPEG/TIFF often costs more than the analysis that reads it,
+and pest, nutrient and yield analysis of one upload each need the pixels.
+The first reader decodes the upload (optionally downsampled to max_side) and
+writes the array as a .npy file; every later reader, in any worker process on
+the host, np.load()s it with mmap_mode="r". The pages are shared read-only
+through the OS page cache, so N workers reading one raster cost one copy of
+RAM and no decode.
+
+Files are written to a temporary name and renamed into place, so concurrent
+decoders on different processes never expose a partial array. The directory
+is bounded by RASTER_CACHE_MAX_BYTES, evicting least recently used files
+first (reads touch the file mtime). Uploads never change once stored, so
+entries never go stale.
+"""
+import math
+import os
+import threading
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from app import image_probe, metrics, storage
+from app.config import settings
+
+# Modes numpy can't represent directly (palette, bilevel, ...) are decoded as RGB/RGBA
+ARRAY_MODES = {"L", "RGB", "RGBA", "I;16", "I", "F"}
+
+
+def cache_dir() -> Path:
+    if settings.RASTER_CACHE_DIR:
+        return Path(settings.RASTER_CACHE_DIR)
+    if settings.STORAGE_BACKEND == "local":
+        return Path(settings.UPLOAD_DIR) / ".rasters"
+    return Path(settings.STORAGE_CACHE_DIR) / ".rasters"
+
+
+def _fit(pixels: np.ndarray, max_side: Optional[int]) -> np.ndarray:
+    if not max_side or max(pixels.shape[:2]) <= max_side:
+        return pixels
+    try:
+        image = Image.fromarray(np.ascontiguousarray(pixels))
+        image.thumbnail((max_side, max_side), Image.BOX)
+    except (TypeError, ValueError):
+        return pixels  # PIL can't resample these bands; keep the (at most 2x larger) read
+    return np.asarray(image)
+
+
+def decode(path: Path, max_side: Optional[int] = None, max_bytes: Optional[int] = None) -> np.ndarray:
+    """
+    Decode an image file to an (H, W[, bands]) array, downsampled to fit
+    max_side and to no more than max_bytes. JPEGs decode straight at reduced
+    scale and TIFFs read every n-th pixel of their tiles or strips
+    (rasters.read_tiff); other formats are decoded whole, then downsampled,
+    which is why image_probe only lets JPEGs and TIFFs read_tiff can read
+    exceed IN_MEMORY_MAX_BYTES ("tiled" uploads).
+    """
+    if (max_side or max_bytes) and path.suffix.lower() in (".tif", ".tiff"):
+        from app import rasters
+        region = rasters.read_tiff(path, min_side=max_side, max_bytes=max_bytes)
+        if region is not None:
+            return _fit(region[0], max_side)
+    with image_probe.open_validated(path) as image:
+        target = max_side
+        if max_bytes:
+            factor = math.sqrt(image.width * image.height * len(image.getbands()) / max_bytes)
+            if factor > 1:
+                budget_side = int(max(image.size) / factor)
+                target = min(target, budget_side) if target else budget_side
+        if target and image.format == "JPEG":
+            # JPEG decodes straight at reduced scale
+            image.draft(image.mode, (target, target))
+        if image.mode not in ARRAY_MODES:
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        if target and max(image.size) > target:
+            image.thumbnail((target, target), Image.BOX)
+        return np.asarray(image)
+
+
+def to_image(source: Union[bytes, np.ndarray, Image.Image]) -> Image.Image:
+    """PIL image from encoded bytes, a (cached) pixel array or an image"""
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(source))
+    return Image.open(BytesIO(source))
+
+
+class RasterCache:
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._decoding: Dict[str, threading.Lock] = {}
+
+    def path_for(self, upload_id: str, max_side: Optional[int] = None, max_bytes: Optional[int] = None) -> Path:
+        budget = f".{max_bytes}b" if max_bytes else ""
+        return self.directory / f"{upload_id}.{max_side or 'full'}{budget}.npy"
+
+    def _record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            rate = self.hits / (self.hits + self.misses)
+        metrics.incr("raster_cache", "hits" if hit else "misses")
+        metrics.set_gauge("raster_cache", "hit_rate", round(rate, 3))
+
+    def _load(self, path: Path) -> Optional[np.ndarray]:
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None  # evicted meanwhile, or not a complete array
+        os.utime(path)  # recency for eviction
+        return array
+
+    def get(self, upload_id: str, max_side: Optional[int] = None,
+            max_bytes: Optional[int] = None) -> Optional[np.ndarray]:
+        """
+        Read-only memory-mapped pixels of an upload (None if it doesn't exist).
+        Pass max_side or max_bytes to cache a downsampled copy instead of full
+        resolution.
+        """
+        path = self.path_for(upload_id, max_side, max_bytes)
+        array = self._load(path)
+        if array is not None:
+            self._record(hit=True)
+            return array
+
+        # One decode per key in this process; other processes may race, which only wastes work
+        with self._lock:
+            key_lock = self._decoding.setdefault(path.name, threading.Lock())
+        with key_lock:
+            array = self._load(path)
+            if array is not None:
+                self._record(hit=True)
+                return array
+            source = storage.upload_path(upload_id)
+            if source is None:
+                return None
+            self._record(hit=False)
+            pixels = decode(source, max_side, max_bytes)
+            self.directory.mkdir(parents=True, exist_ok=True)
+            partial = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.part")
+            with open(partial, "wb") as f:
+                np.save(f, pixels)
+            os.replace(partial, path)
+            metrics.incr("raster_cache", "decoded_bytes", pixels.nbytes)
+            self._evict(keep=path)
+        with self._lock:
+            self._decoding.pop(path.name, None)
+        array = self._load(path)
+        if array is None:
+            pixels.flags.writeable = False
+            return pixels
+        return array
+
+    def _evict(self, keep: Path):
+        """Delete least recently used arrays until under max_bytes; open memory maps stay valid"""
+        files = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if total > self.max_bytes:
+            for _, size, path in sorted(files):
+                if path == keep:
+                    continue
+                path.unlink(missing_ok=True)
+                metrics.incr("raster_cache", "evictions")
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        metrics.set_gauge("raster_cache", "bytes", total)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> RasterCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RasterCache(cache_dir(), settings.RASTER_CACHE_MAX_BYTES)
+    return _cache
+
+
+def load(upload_id: str, max_side: Optional[int] = None,
+         processing_mode: Optional[str] = None) -> Optional[np.ndarray]:
+    """Pixels of an upload; "tiled" uploads (app.image_probe) are capped at IN_MEMORY_MAX_BYTES decoded"""
+    max_bytes = settings.IN_MEMORY_MAX_BYTES if processing_mode == "tiled" else None
+    return get_cache().get(upload_id, max_side, max_bytes)
@@ -0,0 +1,469 @@
+"""
+Compact, tiled copies of uploads.
+
+Uploads arrive as whatever the drone software wrote, often uncompressed
+TIFFs. After an upload is accepted, transcode_upload() (a background task)
+writes rasters/<upload_id>.<ext> in TRANSCODE_FORMAT:
+  - cog:  TIFF in TRANSCODE_TILE_SIZE tiles, deflate-compressed (horizontal
+          predictor for integer data), with 2x overviews in SubIFDs down to
+          one tile, like a Cloud Optimized GeoTIFF. Bands, bit depth and
+          photometric interpretation of TIFF sources are kept.
+  - webp: lossless WebP, smallest for 8-bit RGB(A)/grey imagery but not
+          tiled; other sources fall back to cog
+JPEG, PNG and WebP uploads are already compressed and are left alone, as are
+compressed TIFFs of "tiled" uploads (they would have to be decoded whole), and
+a raster that comes out no smaller than its original is discarded. The output
+format is chosen from the image header (app.image_probe), so nothing is
+decoded when the needed writer is missing: writing TIFFs needs the optional
+tifffile package.
+
+read_region() returns just a window of an upload at the coarsest overview
+that still has the requested resolution, decoding only the tiles it touches.
+The model modules use it to read what they actually feed the network. TIFF
+uploads without a raster are read the same way through their own tiles or
+strips, taking every n-th pixel when they have no overviews; other uploads
+fall back to the decoded-pixel cache (app.raster_cache). Uploads probed as
+"tiled" (app.image_probe) never decode more than IN_MEMORY_MAX_BYTES.
+
+numpy, tifffile and app.raster_cache are imported inside the functions that
+use them (app.main imports this module); _tifffile() probes for the optional
+package on first use.
+
+Originals are kept for KEEP_ORIGINAL_DAYS after upload (-1 keeps them
+forever; 0 deletes them as soon as the raster is verified). After that, the
+upload's storage_key points at its raster, so readers going through
+storage.find_upload_key() keep working, but links to the original
+/uploads/<id>.<ext> stop resolving.
+"""
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from PIL import Image
+from sqlalchemy import or_
+
+from app import image_probe, metrics, storage
+from app.config import settings
+
+if TYPE_CHECKING:
+    import numpy as np
+
+FORMATS = {"cog": (".tif", "image/tiff"), "webp": (".webp", "image/webp")}
+# Already compressed; re-encoding losslessly only makes them bigger
+SKIP_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+WEBP_MAX_SIDE = 16383
+# Rows of the source halved per step when building overviews
+OVERVIEW_STRIP_ROWS = 1024
+RETENTION_SWEEP_SECONDS = 3600
+
+_last_retention_sweep = 0.0
+_retention_lock = threading.Lock()
+
+
+def _tifffile():
+    """The optional tifffile module, or None if it isn't installed"""
+    try:
+        import tifffile
+    except ImportError:
+        return None
+    return tifffile
+
+
+def can_read_tiff(compression: Optional[str]) -> bool:
+    """Whether read_tiff decodes this compression (an image_probe name) itself, without PIL"""
+    tifffile = _tifffile()
+    codes = [code for code, name in image_probe.TIFF_COMPRESSION.items() if name == compression]
+    if tifffile is None or not codes:
+        return False
+    try:
+        tifffile.TIFF.DECOMPRESSORS[codes[0]]
+    except KeyError:
+        return False  # needs imagecodecs
+    return True
+
+
+def raster_key(upload_id: str, format: str) -> str:
+    return f"rasters/{upload_id}{FORMATS[format][0]}"
+
+
+def find_raster_key(upload_id: str, db=None) -> Optional[str]:
+    recorded = storage.recorded_keys(upload_id, db)
+    if recorded is not None:
+        return recorded[1]
+    keys = storage.get_storage().list(f"rasters/{upload_id}.")
+    return keys[0] if keys else None
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+
+def _load_source(path: Path, max_bytes: Optional[int] = None) -> Optional[Tuple["np.ndarray", str, tuple]]:
+    """
+    (pixels, photometric, extrasamples); uncompressed TIFFs are memory-mapped,
+    not read. None if the source would have to be decoded whole into more
+    than max_bytes (compressed TIFFs of "tiled" uploads).
+    """
+    import numpy as np
+
+    from app import raster_cache
+    tifffile = _tifffile()
+    if tifffile is not None and path.suffix.lower() in (".tif", ".tiff"):
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            memmappable = page.is_memmappable
+            if not memmappable and max_bytes and page.nbytes > max_bytes:
+                return None
+            pixels = None if memmappable else page.asarray()
+            photometric = page.photometric.name.lower()
+            extrasamples = tuple(int(sample) for sample in page.extrasamples)
+        if memmappable:
+            # Maps the file itself: overviews and tiles are built without loading it
+            pixels = tifffile.memmap(path, page=0, mode="r")
+        if page.planarconfig == 1 or pixels.ndim == 2:
+            return pixels, photometric, extrasamples
+        # Band-separate layout: store interleaved like everything else
+        return np.moveaxis(np.asarray(pixels), 0, -1), photometric, extrasamples
+    pixels = raster_cache.decode(path)
+    if pixels.ndim == 2:
+        return pixels, "minisblack", ()
+    return pixels, "rgb", (2,) if pixels.shape[2] == 4 else ()  # 2 = unassociated alpha
+
+
+def _halve(pixels: "np.ndarray") -> "np.ndarray":
+    """2x2 box-filtered half-resolution copy, computed in strips to bound memory"""
+    import numpy as np
+    height, width = pixels.shape[0] // 2, pixels.shape[1] // 2
+    out = np.empty((height, width) + pixels.shape[2:], dtype=pixels.dtype)
+    for top in range(0, height, OVERVIEW_STRIP_ROWS):
+        bottom = min(height, top + OVERVIEW_STRIP_ROWS)
+        block = np.asarray(pixels[2 * top:2 * bottom, :2 * width], dtype=np.float32)
+        block = block.reshape(bottom - top, 2, width, 2, *pixels.shape[2:]).mean(axis=(1, 3))
+        if pixels.dtype.kind in "iu":
+            block = np.rint(block)
+        out[top:bottom] = block.astype(pixels.dtype)
+    return out
+
+
+def write_cog(pixels: "np.ndarray", path: Path, photometric: str = "rgb", extrasamples: tuple = ()):
+    import tifffile
+    tile = settings.TRANSCODE_TILE_SIZE
+    overviews = max(0, math.ceil(math.log2(max(pixels.shape[:2]) / tile)))
+    options = dict(
+        tile=(tile, tile),
+        compression="zlib",
+        compressionargs={"level": settings.TRANSCODE_COMPRESSION_LEVEL},
+        # The floating point predictor needs imagecodecs
+        predictor=pixels.dtype.kind in "iu",
+        photometric=photometric,
+        planarconfig="contig" if pixels.ndim == 3 else None,
+        extrasamples=extrasamples or None,
+        metadata=None,
+    )
+    with tifffile.TiffWriter(path, bigtiff=pixels.nbytes > 2 ** 31) as tif:
+        tif.write(pixels, subifds=overviews, **options)
+        level = pixels
+        for _ in range(overviews):
+            level = _halve(level)
+            tif.write(level, subfiletype=1, **options)
+
+
+def write_webp(pixels: "np.ndarray", path: Path):
+    import numpy as np
+    Image.fromarray(np.ascontiguousarray(pixels)).save(path, "WEBP", lossless=True, quality=100, method=4)
+
+
+def _webp_ok(info: image_probe.ImageInfo) -> bool:
+    return info.bit_depth == 8 and max(info.width, info.height) <= WEBP_MAX_SIDE and info.bands in (1, 3, 4)
+
+
+def _verify(path: Path, format: str, shape: tuple):
+    if format == "cog":
+        import tifffile
+        with tifffile.TiffFile(path) as tif:
+            stored = tif.pages[0].shape
+    else:
+        with image_probe.open_validated(path) as image:
+            stored = (image.height, image.width)
+    if tuple(stored[:2]) != tuple(shape[:2]):
+        raise ValueError(f"Transcoded raster has shape {stored}, expected {shape}")
+
+
+def transcode_upload(upload_id: str):
+    """Write the compact raster for an upload (run as a background task after the tile pyramid)"""
+    if settings.TRANSCODE_FORMAT == "off":
+        return
+    from app.database import SessionLocal
+    from app.models import Upload
+
+    key = storage.find_upload_key(upload_id)
+    if key is None or key.startswith("rasters/") or find_raster_key(upload_id):
+        return
+    if Path(key).suffix.lower() in SKIP_EXTENSIONS:
+        metrics.incr("rasters", "skipped_compressed")
+        return
+    source = storage.get_storage().local_path(key)
+    if source is None:
+        return
+
+    try:
+        info = image_probe.probe(source)
+    except image_probe.InvalidImage as e:
+        print(f"Transcode skipped for {upload_id}: {e}")
+        return
+    format = settings.TRANSCODE_FORMAT
+    if format == "webp" and not _webp_ok(info):
+        format = "cog"
+    if format == "cog" and _tifffile() is None:
+        print(f"Transcode skipped for {upload_id}: TIFF output requires tifffile")
+        metrics.incr("rasters", "skipped_no_tifffile")
+        return
+
+    started = time.perf_counter()
+    target = raster_key(upload_id, format)
+    partial = storage.staging_dir() / f"{upload_id}{FORMATS[format][0]}.part"
+    try:
+        loaded = _load_source(source, settings.IN_MEMORY_MAX_BYTES if info.processing_mode == "tiled" else None)
+        if loaded is None:
+            print(f"Transcode skipped for {upload_id}: compressed source is too large to decode whole")
+            metrics.incr("rasters", "skipped_too_large")
+            return
+        pixels, photometric, extrasamples = loaded
+        if format == "cog":
+            write_cog(pixels, partial, photometric, extrasamples)
+        else:
+            write_webp(pixels, partial)
+        _verify(partial, format, pixels.shape)
+    except Exception as e:
+        partial.unlink(missing_ok=True)
+        print(f"Transcode failed for {upload_id}: {e}")
+        metrics.incr("rasters", "failures")
+        return
+
+    original_bytes = source.stat().st_size
+    raster_bytes = partial.stat().st_size
+    if raster_bytes >= original_bytes:
+        # The original is already as compact; keep it, and never delete it for retention
+        partial.unlink()
+        print(f"Transcode of {upload_id} discarded: {raster_bytes / 1e6:.1f} MB is not smaller than the original")
+        metrics.incr("rasters", "skipped_larger")
+        return
+    storage.get_storage().put_file(target, partial, FORMATS[format][1])
+    metrics.incr("rasters", "transcoded")
+    metrics.incr("rasters", "bytes_in", original_bytes)
+    metrics.incr("rasters", "bytes_out", raster_bytes)
+    print(f"Transcoded {upload_id} to {format}: {original_bytes / 1e6:.1f} MB -> {raster_bytes / 1e6:.1f} MB "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    db = SessionLocal()
+    try:
+        upload = db.get(Upload, upload_id)
+        if upload is not None:
+            upload.raster_key = target
+            upload.raster_bytes = raster_bytes
+            db.commit()
+        if settings.KEEP_ORIGINAL_DAYS == 0:
+            _delete_original(db, upload_id)
+        else:
+            _maybe_apply_retention(db)
+    finally:
+        db.close()
+
+
+# ---------------------------------------------------------------------------
+# Retention
+# ---------------------------------------------------------------------------
+
+def _delete_original(db, upload_id: str) -> bool:
+    from app.models import Upload
+
+    key = storage.find_upload_key(upload_id, db)
+    target = find_raster_key(upload_id, db)
+    if key is None or key.startswith("rasters/") or not target:
+        return False
+    # Readers follow the row to the raster before the original disappears
+    db.query(Upload).filter(Upload.id == upload_id).update({"storage_key": target})
+    db.commit()
+    freed = storage.get_storage().size(key) or 0
+    storage.get_storage().delete(key)
+    metrics.incr("rasters", "originals_deleted")
+    metrics.incr("rasters", "original_bytes_freed", freed)
+    return True
+
+
+def apply_retention(db) -> int:
+    """Delete originals older than KEEP_ORIGINAL_DAYS that have a raster; returns how many"""
+    from app.models import Upload
+
+    if settings.KEEP_ORIGINAL_DAYS < 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=settings.KEEP_ORIGINAL_DAYS)
+    upload_ids = [row.id for row in db.query(Upload.id).filter(
+        Upload.raster_key.isnot(None), Upload.uploaded_at < cutoff,
+        or_(Upload.storage_key.is_(None), Upload.storage_key != Upload.raster_key)
+    )]
+    return sum(_delete_original(db, upload_id) for upload_id in upload_ids)
+
+
+def _maybe_apply_retention(db):
+    global _last_retention_sweep
+    with _retention_lock:
+        if time.monotonic() - _last_retention_sweep < RETENTION_SWEEP_SECONDS:
+            return
+        _last_retention_sweep = time.monotonic()
+    apply_retention(db)
+
+
+# ---------------------------------------------------------------------------
+# Region reads
+# ---------------------------------------------------------------------------
+
+def _read_segments(tif, page, box: Tuple[int, int, int, int], step: int = 1) -> "np.ndarray":
+    """
+    Decode only the tiles or strips of page that intersect box (left, top,
+    right, bottom), keeping every step-th row and column of the box.
+    """
+    import numpy as np
+    left, top, right, bottom = box
+    width, height = page.imagewidth, page.imagelength
+    # Strips are tiles as wide as the image
+    tile_w = page.tilewidth or width
+    tile_h = page.tilelength or page.rowsperstrip or height
+    across, down = -(-width // tile_w), -(-height // tile_h)
+    planes = page.samplesperpixel if page.planarconfig == 2 else 1
+    samples = page.samplesperpixel
+    out = np.empty((-(-(bottom - top) // step), -(-(right - left) // step), samples), dtype=page.dtype)
+    handle = tif.filehandle
+    rows = range(top // tile_h, -(-bottom // tile_h))
+    columns = range(left // tile_w, -(-right // tile_w))
+    for plane in range(planes):
+        for ty in rows:
+            for tx in columns:
+                index = plane * across * down + ty * across + tx
+                handle.seek(page.dataoffsets[index])
+                segment, (_, _, y0, x0, _), _ = page.decode(handle.read(page.databytecounts[index]), index)
+                segment = segment[0]
+                # First kept row/column in this segment, as offsets into the box
+                iy0 = -(-(max(top, y0) - top) // step) * step
+                ix0 = -(-(max(left, x0) - left) // step) * step
+                iy1 = min(bottom, y0 + segment.shape[0]) - top
+                ix1 = min(right, x0 + segment.shape[1]) - left
+                if iy0 >= iy1 or ix0 >= ix1:
+                    continue
+                kept = segment[top + iy0 - y0:top + iy1 - y0:step, left + ix0 - x0:left + ix1 - x0:step]
+                target = out[iy0 // step:iy0 // step + kept.shape[0], ix0 // step:ix0 // step + kept.shape[1]]
+                if planes > 1:
+                    target[..., plane] = kept[..., 0]
+                else:
+                    target[...] = kept
+    metrics.incr("rasters", "tiles_read", planes * len(rows) * len(columns))
+    return out[..., 0] if samples == 1 else out
+
+
+def _scaled_box(box, scale: float, width: int, height: int) -> Tuple[int, int, int, int]:
+    left, top, right, bottom = box
+    return (max(0, int(left / scale)), max(0, int(top / scale)),
+            min(width, max(int(left / scale) + 1, math.ceil(right / scale))),
+            min(height, max(int(top / scale) + 1, math.ceil(bottom / scale))))
+
+
+def read_tiff(path: Path, box: Optional[Tuple[int, int, int, int]] = None, min_side: Optional[int] = None,
+              max_bytes: Optional[int] = None) -> Optional[Tuple["np.ndarray", float]]:
+    """
+    read_region() for one TIFF file: the coarsest overview level that keeps
+    min_side across the box, then every n-th pixel of it where that level is
+    still more than min_side needs or than max_bytes allows. Returns
+    (pixels, scale), or None if tifffile is missing or can't read the file
+    as plain grey/RGB samples (callers then decode it with PIL).
+    """
+    tifffile = _tifffile()
+    if tifffile is None:
+        return None
+    try:
+        with tifffile.TiffFile(path) as tif:
+            levels = tif.series[0].levels
+            full = levels[0].keyframe
+            if full.photometric.name.lower() not in ("minisblack", "rgb") or full.imagedepth > 1:
+                return None
+            box = box or (0, 0, full.imagewidth, full.imagelength)
+            extent = max(box[2] - box[0], box[3] - box[1])
+            chosen, scale = full, 1.0
+            for level in levels[1:]:
+                page = level.keyframe
+                level_scale = full.imagewidth / page.imagewidth
+                if min_side is None or extent / level_scale < min_side:
+                    break
+                chosen, scale = page, level_scale
+            region = _scaled_box(box, scale, chosen.imagewidth, chosen.imagelength)
+            region_w, region_h = region[2] - region[0], region[3] - region[1]
+            step = max(1, int(max(region_w, region_h) / min_side)) if min_side else 1
+            if max_bytes:
+                decoded = region_w * region_h * chosen.samplesperpixel * chosen.dtype.itemsize
+                step = max(step, math.ceil(math.sqrt(decoded / max_bytes)))
+            if step > 1:
+                metrics.incr("rasters", "strided_reads")
+            pixels = _read_segments(tif, chosen, region, step)
+    except Exception as e:
+        # Compressions tifffile can't decode without imagecodecs, malformed files, ...
+        print(f"TIFF region read of {path.name} failed, decoding with PIL: {e}")
+        return None
+    return pixels, scale * step
+
+
+def _processing_mode(upload_id: str) -> Optional[str]:
+    from app.database import SessionLocal
+    from app.models import Upload
+
+    db = SessionLocal()
+    try:
+        row = db.query(Upload.processing_mode).filter(Upload.id == upload_id).first()
+    finally:
+        db.close()
+    return row[0] if row is not None else None
+
+
+def read_region(upload_id: str, box: Optional[Tuple[int, int, int, int]] = None,
+                min_side: Optional[int] = None,
+                processing_mode: Optional[str] = None) -> Optional[Tuple["np.ndarray", float]]:
+    """
+    Pixels of box (left, top, right, bottom in full-resolution pixels; None
+    for the whole image) at the coarsest level whose longest side across the
+    box is still at least min_side (None for full resolution).
+    processing_mode is the upload's (image_probe; looked up when not given):
+    for "tiled" uploads no more than IN_MEMORY_MAX_BYTES is decoded, reading
+    a coarser level instead if need be.
+    Returns (pixels, scale), where scale is full-resolution pixels per returned
+    pixel, or None if the upload doesn't exist.
+    """
+    from app import raster_cache
+
+    if processing_mode is None:
+        processing_mode = _processing_mode(upload_id)
+    max_bytes = settings.IN_MEMORY_MAX_BYTES if processing_mode == "tiled" else None
+
+    # The tiled raster, or a TIFF original: read through its tiles or strips
+    key = find_raster_key(upload_id) or storage.find_upload_key(upload_id)
+    path = storage.get_storage().local_path(key) if key else None
+    if path is not None and path.suffix.lower() in (".tif", ".tiff"):
+        region = read_tiff(path, box, min_side, max_bytes)
+        if region is not None:
+            metrics.incr("rasters", "region_reads")
+            return region
+
+    # WebP rasters and other uploads: decode through the pixel cache, then crop
+    metrics.incr("rasters", "region_fallbacks")
+    source = storage.upload_path(upload_id)
+    if source is None:
+        return None
+    with image_probe.open_validated(source) as image:
+        width = image.width
+    if box is None:
+        pixels = raster_cache.load(upload_id, min_side, processing_mode)
+        return pixels, width / pixels.shape[1]
+    pixels = raster_cache.load(upload_id, processing_mode=processing_mode)
+    scale = width / pixels.shape[1]
+    left, top, right, bottom = _scaled_box(box, scale, pixels.shape[1], pixels.shape[0])
+    return pixels[top:bottom, left:right], scale
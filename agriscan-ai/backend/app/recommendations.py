@@ -0,0 +1,85 @@
+"""
+Agronomic recommendation rules.
+
+Shared by the nutrient model (per-analysis recommendation text) and the report
+pipeline (per-field recommendations from cached aggregates), so the same
+deficiency always produces the same advice.
+"""
+from typing import Dict, List, Optional
+
+# Application rate range (kg/ha) per nutrient, scaled by deficiency
+NUTRIENT_RATES = {
+    "nitrogen": (80, 150),
+    "phosphorus": (30, 80),
+    "potassium": (20, 60),
+}
+# Deficiency (% of field) at or below which no application is needed
+ADEQUATE_DEFICIENCY = 5
+# Deficiency at which the top of the rate range is applied
+MAX_RATE_DEFICIENCY = 35
+
+PEST_ACTIONS = {
+    "LOW": "No immediate action required. Continue routine monitoring.",
+    "MEDIUM": "Apply targeted treatment in affected zones within 48 hours.",
+    "HIGH": "Urgent: treat affected zones immediately and re-scan within 3 days.",
+}
+
+
+def application_rate(nutrient: str, deficiency: float) -> int:
+    low, high = NUTRIENT_RATES[nutrient]
+    share = min(max(deficiency - ADEQUATE_DEFICIENCY, 0) / (MAX_RATE_DEFICIENCY - ADEQUATE_DEFICIENCY), 1.0)
+    return int(round(low + share * (high - low)))
+
+
+def nutrient_recommendation(nutrient: str, deficiency: float) -> str:
+    if deficiency <= ADEQUATE_DEFICIENCY:
+        return f"{nutrient.capitalize()} levels adequate"
+    return f"Apply {application_rate(nutrient, deficiency)} kg/ha {nutrient} fertilizer"
+
+
+def pest_risk_level(detections: int) -> str:
+    return "HIGH" if detections > 10 else "MEDIUM" if detections > 5 else "LOW"
+
+
+def pest_recommendation(risk_level: str, zones: Optional[List[str]] = None) -> str:
+    action = PEST_ACTIONS.get(risk_level, PEST_ACTIONS["LOW"])
+    if zones and risk_level != "LOW":
+        action += f" Focus on {', '.join(sorted(zones))}."
+    return action
+
+
+def harvest_recommendation(days_to_harvest: Optional[int]) -> Optional[str]:
+    if days_to_harvest is None:
+        return None
+    if days_to_harvest <= 7:
+        return "Harvest window is open within a week; schedule equipment and labour."
+    if days_to_harvest <= 21:
+        return f"Plan harvest logistics: about {days_to_harvest} days to harvest."
+    return None
+
+
+def field_recommendations(zone_values: Dict[str, Dict], days_to_harvest: Optional[int] = None) -> List[str]:
+    """
+    Recommendations for a field from its cached per-type aggregates.
+
+    Args:
+        zone_values: {analysis_type: {metric: {zone: value}}} (FieldState.zone_values by type)
+        days_to_harvest: from the field's forecast, if any
+    """
+    recommendations = []
+    nutrients = zone_values.get("nutrient_mapping", {})
+    for nutrient in NUTRIENT_RATES:
+        deficiency = nutrients.get(f"{nutrient}_deficiency", {}).get("field")
+        if deficiency is not None and deficiency > ADEQUATE_DEFICIENCY:
+            recommendations.append(nutrient_recommendation(nutrient, deficiency))
+
+    pests = zone_values.get("pest_detection", {})
+    counts = pests.get("detections", {})
+    if pests:
+        level = pest_risk_level(sum(counts.values()))
+        recommendations.append(pest_recommendation(level, [zone for zone, n in counts.items() if n]))
+
+    harvest = harvest_recommendation(days_to_harvest)
+    if harvest:
+        recommendations.append(harvest)
+    return recommendations
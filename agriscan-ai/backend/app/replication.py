@@ -0,0 +1,342 @@
+"""
+Edge-to-central replication of fields, uploads and analyses.
+
+Edge units (REPLICATION_ROLE=edge) run SQLite. Triggers on the replicated
+tables append (table, row id, upsert|delete) to replication_log, so every
+write is captured, including bulk UPDATEs that bypass the ORM. SQLite
+serializes writers, so log sequence numbers are assigned in commit order and
+"everything up to seq N" is a safe high-water mark.
+
+push() asks the central API how far this edge has been applied, then sends
+the log past that point in batches of REPLICATION_BATCH_SIZE entries. Entries
+for the same row are coalesced and the row's current content (results JSON
+included) is read at send time. Rows travel as column lists plus value
+arrays, gzip-compressed. The central side (REPLICATION_ROLE=central) applies
+a batch with one bulk upsert per table and advances the edge's last_seq in the
+same transaction. The edge then prunes the acknowledged log. Central requires
+REPLICATION_TOKEN and decompresses at most REPLICATION_MAX_BATCH_BYTES.
+
+Interrupted pushes resume on their own: the central high-water mark only
+moves with applied data. A batch whose acknowledgement was lost is resent
+and recognised as already applied. Image files are not copied; uploads
+reference them by URL (use STORAGE_BACKEND=s3 to share them).
+
+Run on an edge unit:
+  python -m app.replication push          # once
+  python -m app.replication push --loop   # every REPLICATION_INTERVAL_SECONDS
+"""
+import gzip
+import json
+import socket
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import DateTime, delete, select, text
+from sqlalchemy.engine import Engine
+
+from app import metrics, serialization
+from app.config import settings
+from app.models import Analysis, Field, ReplicationPeer, Upload
+
+# In foreign key order: upserts go front to back, deletes back to front
+REPLICATED_TABLES = [model.__table__ for model in (Field, Upload, Analysis)]
+TABLES_BY_NAME = {table.name: table for table in REPLICATED_TABLES}
+# SQLite allows 999 bound parameters per statement
+IN_CHUNK = 500
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def edge_id() -> str:
+    return settings.REPLICATION_EDGE_ID or socket.gethostname()
+
+
+def _headers() -> Dict[str, str]:
+    if settings.REPLICATION_TOKEN:
+        return {"Authorization": f"Bearer {settings.REPLICATION_TOKEN}"}
+    return {}
+
+
+# ---------------------------------------------------------------------------
+# Edge: change capture
+# ---------------------------------------------------------------------------
+
+def install_triggers(engine: Engine):
+    """Create the change log triggers (SQLite); rows that predate them are logged once as upserts"""
+    if engine.dialect.name != "sqlite":
+        raise ReplicationError("Edge replication captures changes with SQLite triggers")
+    with engine.begin() as conn:
+        for table in REPLICATED_TABLES:
+            trigger = f"replication_{table.name}_insert"
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"), {"name": trigger}
+            ).first()
+            if not exists:
+                conn.execute(text(
+                    f"INSERT INTO replication_log (table_name, row_id, op, changed_at) "
+                    f"SELECT '{table.name}', id, 'upsert', CURRENT_TIMESTAMP FROM {table.name}"
+                ))
+            for event, row, op in (("INSERT", "NEW", "upsert"), ("UPDATE", "NEW", "upsert"), ("DELETE", "OLD", "delete")):
+                conn.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS replication_{table.name}_{event.lower()} "
+                    f"AFTER {event} ON {table.name} BEGIN "
+                    f"INSERT INTO replication_log (table_name, row_id, op, changed_at) "
+                    f"VALUES ('{table.name}', {row}.id, '{op}', CURRENT_TIMESTAMP); END"
+                ))
+
+
+def collect(engine: Engine, after_seq: int, limit: int) -> Optional[Dict]:
+    """The next batch of changes after after_seq, or None when the edge is caught up"""
+    with engine.connect() as conn:
+        entries = conn.execute(text(
+            "SELECT seq, table_name, row_id, op FROM replication_log WHERE seq > :after ORDER BY seq LIMIT :limit"
+        ), {"after": after_seq, "limit": limit}).all()
+        if not entries:
+            return None
+
+        # Last operation per row wins
+        latest: Dict[str, Dict[str, str]] = {}
+        for _, table_name, row_id, op in entries:
+            if table_name in TABLES_BY_NAME:
+                latest.setdefault(table_name, {})[row_id] = op
+
+        tables = {}
+        for table in REPLICATED_TABLES:
+            ops = latest.get(table.name)
+            if not ops:
+                continue
+            upsert_ids = [row_id for row_id, op in ops.items() if op == "upsert"]
+            rows = []
+            for start in range(0, len(upsert_ids), IN_CHUNK):
+                chunk = upsert_ids[start:start + IN_CHUNK]
+                rows.extend(conn.execute(select(table).where(table.c.id.in_(chunk))).all())
+            found = {row.id for row in rows}
+            # Upserted then deleted before this read: ship the delete
+            deletes = [row_id for row_id, op in ops.items() if op == "delete" or row_id not in found]
+            tables[table.name] = {
+                "columns": list(table.columns.keys()),
+                "rows": [list(row) for row in rows],
+                "deletes": deletes,
+            }
+    return {"edge_id": edge_id(), "from_seq": after_seq, "to_seq": entries[-1].seq, "tables": tables}
+
+
+def encode(batch: Dict) -> bytes:
+    raw = serialization.dumps(batch)
+    body = gzip.compress(raw, compresslevel=6)
+    metrics.incr("replication", "bytes_raw", len(raw))
+    metrics.incr("replication", "bytes_sent", len(body))
+    return body
+
+
+def prune(engine: Engine, through_seq: int):
+    """Drop log entries the central side has applied"""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM replication_log WHERE seq <= :seq"), {"seq": through_seq})
+
+
+def push(engine: Engine, central_url: Optional[str] = None, client=None, batch_size: Optional[int] = None,
+         max_batches: Optional[int] = None) -> int:
+    """
+    Send every pending change to the central API; returns the number of rows
+    sent. client is anything with requests' get/post (a requests.Session by
+    default). Safe to interrupt at any point and call again.
+    """
+    import requests
+
+    client = client or requests.Session()
+    base = (central_url or settings.REPLICATION_CENTRAL_URL).rstrip("/")
+    batch_size = batch_size or settings.REPLICATION_BATCH_SIZE
+
+    response = client.get(f"{base}/api/replication/peers/{edge_id()}", headers=_headers(),
+                          timeout=REQUEST_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    applied = response.json()["last_seq"]
+    with engine.connect() as conn:
+        issued = conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'")).scalar() or 0
+    if applied > issued:
+        # A rebuilt edge database restarts its sequence; its changes would be skipped as already applied
+        raise ReplicationError(
+            f"Central has applied up to {applied} but this edge's log only reaches {issued}; "
+            f"use a new REPLICATION_EDGE_ID"
+        )
+    prune(engine, applied)
+
+    sent = batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = collect(engine, applied, batch_size)
+        if batch is None:
+            break
+        headers = dict(_headers(), **{"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        response = client.post(f"{base}/api/replication/batches", data=encode(batch), headers=headers,
+                               timeout=REQUEST_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        applied = response.json()["last_seq"]
+        prune(engine, applied)
+        rows = sum(len(t["rows"]) + len(t["deletes"]) for t in batch["tables"].values())
+        sent += rows
+        batches += 1
+        metrics.incr("replication", "batches_sent")
+        metrics.incr("replication", "rows_sent", rows)
+    metrics.set_gauge("replication", "last_seq", applied)
+    return sent
+
+
+# ---------------------------------------------------------------------------
+# Central: apply
+# ---------------------------------------------------------------------------
+
+def _insert(db):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise ReplicationError(f"Bulk upsert is not supported on {dialect}")
+    return insert
+
+
+def _decode_rows(table, columns: List[str], rows: List[List]) -> List[Dict]:
+    # Only columns both sides know; edges may run an older or newer schema
+    known = [(i, name) for i, name in enumerate(columns) if name in table.c]
+    datetimes = {name for _, name in known if isinstance(table.c[name].type, DateTime)}
+    decoded = []
+    for row in rows:
+        values = {}
+        for i, name in known:
+            value = row[i]
+            if name in datetimes and value is not None:
+                value = datetime.fromisoformat(value)
+            values[name] = value
+        decoded.append(values)
+    return decoded
+
+
+def apply_batch(db, batch: Dict) -> int:
+    """Apply one decoded batch in the caller's transaction; returns the edge's new last_seq"""
+    peer = db.query(ReplicationPeer).filter(ReplicationPeer.edge_id == batch["edge_id"]).with_for_update().first()
+    if peer is None:
+        peer = ReplicationPeer(edge_id=batch["edge_id"], last_seq=0, rows_applied=0)
+        db.add(peer)
+    if batch["to_seq"] <= peer.last_seq:
+        # Resent after a lost acknowledgement
+        metrics.incr("replication", "duplicate_batches")
+        return peer.last_seq
+    if batch["from_seq"] > peer.last_seq:
+        raise ReplicationError(
+            f"Batch from {batch['edge_id']} starts at {batch['from_seq']}, central has applied {peer.last_seq}"
+        )
+
+    insert = _insert(db)
+    tables = batch["tables"]
+    applied = 0
+    for table in REPLICATED_TABLES:
+        changes = tables.get(table.name)
+        if not changes or not changes["rows"]:
+            continue
+        rows = _decode_rows(table, changes["columns"], changes["rows"])
+        statement = insert(table)
+        updates = {name: statement.excluded[name] for name in rows[0] if name != "id"}
+        db.execute(statement.on_conflict_do_update(index_elements=["id"], set_=updates), rows)
+        if table is Analysis.__table__:
+            # Superseded bodies would otherwise sit in the LRU until they age out
+            serialization.payload_cache.invalidate(*(row["id"] for row in rows))
+        applied += len(rows)
+        metrics.incr("replication", "rows_upserted", len(rows))
+    for table in reversed(REPLICATED_TABLES):
+        changes = tables.get(table.name)
+        if not changes or not changes["deletes"]:
+            continue
+        for start in range(0, len(changes["deletes"]), IN_CHUNK):
+            db.execute(delete(table).where(table.c.id.in_(changes["deletes"][start:start + IN_CHUNK])))
+        if table is Analysis.__table__:
+            serialization.payload_cache.invalidate(*changes["deletes"])
+        applied += len(changes["deletes"])
+        metrics.incr("replication", "rows_deleted", len(changes["deletes"]))
+
+    peer.last_seq = batch["to_seq"]
+    peer.rows_applied = (peer.rows_applied or 0) + applied
+    peer.last_batch_at = datetime.utcnow()
+    metrics.incr("replication", "batches_applied")
+    return peer.last_seq
+
+
+def _gunzip(body: bytes, limit: int) -> bytes:
+    """Decompress incrementally, refusing bodies that inflate past limit bytes"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = decompressor.decompress(body, limit + 1)
+    if len(out) > limit:
+        raise ValueError(f"batch inflates to more than {limit} bytes")
+    if not decompressor.eof:
+        raise ValueError("corrupt gzip body (truncated)")
+    return out
+
+
+def apply_payload(body: bytes, content_encoding: str = "gzip") -> int:
+    """Decode a pushed request body and apply it in its own transaction"""
+    from app.database import SessionLocal
+
+    limit = settings.REPLICATION_MAX_BATCH_BYTES
+    try:
+        if content_encoding == "gzip":
+            body = _gunzip(body, limit)
+    except zlib.error as e:
+        raise ValueError(f"corrupt gzip body ({e})") from e
+    if len(body) > limit:
+        raise ValueError(f"batch is larger than {limit} bytes")
+    batch = json.loads(body)
+    db = SessionLocal()
+    try:
+        last_seq = apply_batch(db, batch)
+        db.commit()
+        return last_seq
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def peer_state(db, edge: str) -> Dict:
+    peer = db.query(ReplicationPeer).filter(ReplicationPeer.edge_id == edge).first()
+    return {
+        "edge_id": edge,
+        "last_seq": peer.last_seq if peer else 0,
+        "rows_applied": peer.rows_applied if peer else 0,
+        "last_batch_at": peer.last_batch_at if peer else None,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Push this edge unit's changes to the central API")
+    parser.add_argument("command", choices=["push"])
+    parser.add_argument("--url", default=None, help="default REPLICATION_CENTRAL_URL")
+    parser.add_argument("--loop", action="store_true", help="keep pushing every REPLICATION_INTERVAL_SECONDS")
+    args = parser.parse_args()
+
+    from app.database import engine, init_db
+
+    if settings.REPLICATION_ROLE != "edge":
+        raise SystemExit("Set REPLICATION_ROLE=edge to push changes")
+    init_db()
+    while True:
+        try:
+            started = time.perf_counter()
+            rows = push(engine, args.url)
+            print(f"✓ Replicated {rows} rows in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            metrics.incr("replication", "push_errors")
+            print(f"Replication push failed, will resume from the central high-water mark: {e}")
+            if not args.loop:
+                raise SystemExit(1)
+        if not args.loop:
+            break
+        time.sleep(settings.REPLICATION_INTERVAL_SECONDS)
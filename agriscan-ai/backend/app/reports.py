@@ -0,0 +1,363 @@
+"""
+Precomputed per-field reports.
+
+A report is assembled from aggregates that are already cached per field
+(FieldState, FieldForecast, FieldChange), never from raw analyses. Rendering
+(JSON + HTML) happens on a background thread after analyses complete; the
+artifacts are written to storage as reports/<field_id>/<report_id>.<format>
+(app.storage, so every API node can serve them) and a Report row holds their
+keys, so a fetch is one indexed lookup plus an object read.
+
+Every report stores a fingerprint of its inputs. generate() returns the
+existing report untouched when the fingerprint has not changed, so repeated
+scheduling is cheap. When it does render, the field's older reports (rows and
+artifacts) are pruned, keeping the newest REPORTS_KEPT. Rebuild from the command line:
+
+    python -m app.reports                  # every field
+    python -m app.reports --field-id <id>  # one field
+"""
+import argparse
+import hashlib
+import html
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from app import metrics, models, recommendations, serialization, storage
+
+FORMATS = {"json": "application/json", "html": "text/html; charset=utf-8"}
+# Analyses completing within this window after the first are folded into one report
+SCHEDULE_DELAY_SECONDS = 2.0
+CHANGE_TYPES = ("pest_detection", "nutrient_mapping", "yield_prediction")
+# Reports kept per field, newest first; older rows and their artifacts are deleted
+REPORTS_KEPT = 1
+
+
+def artifact_key(field_id: str, report_id: str, format: str) -> str:
+    return f"reports/{field_id}/{report_id}.{format}"
+
+
+def artifact_path(report: models.Report, format: str) -> Optional[Path]:
+    """Local file for a rendered artifact (downloaded through the cache on S3), or None"""
+    key = report.html_path if format == "html" else report.json_path
+    try:
+        return storage.get_storage().local_path(key) if key else None
+    except ValueError:
+        # A path under the old REPORT_DIR; the report is rendered again on the next generate()
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Inputs
+# ---------------------------------------------------------------------------
+
+def gather_inputs(db: Session, field_id: str) -> Dict:
+    """The cached aggregates a field's report is built from"""
+    field = db.query(models.Field).filter(models.Field.id == field_id).first()
+    states = db.query(models.FieldState).filter(models.FieldState.field_id == field_id).all()
+    forecast = db.query(models.FieldForecast).filter(models.FieldForecast.field_id == field_id).first()
+
+    changes = {}
+    for analysis_type in CHANGE_TYPES:
+        change = db.query(models.FieldChange).filter(
+            models.FieldChange.field_id == field_id,
+            models.FieldChange.analysis_type == analysis_type
+        ).order_by(models.FieldChange.created_at.desc()).first()
+        if change is not None:
+            changes[analysis_type] = {
+                "id": change.id,
+                "zone_deltas": change.zone_deltas,
+                "grid_summary": change.grid_summary,
+            }
+
+    return {
+        "field": {
+            "id": field_id,
+            "name": field.field_name if field else None,
+            "crop_type": field.crop_type if field else None,
+            "area_hectares": field.area_hectares if field else None,
+            "planting_date": field.planting_date if field else None,
+        },
+        "states": {
+            state.analysis_type: {"analysis_id": state.analysis_id, "zone_values": state.zone_values or {}}
+            for state in states
+        },
+        "forecast": {
+            "predicted_yield_tons_per_hectare": forecast.forecast_yield,
+            "days_to_harvest": forecast.forecast_days_to_harvest,
+        } if forecast else None,
+        "changes": changes,
+    }
+
+
+def fingerprint(inputs: Dict) -> str:
+    canonical = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# Assembly and rendering
+# ---------------------------------------------------------------------------
+
+def _field_value(zone_values: Dict, metric: str):
+    return (zone_values.get(metric) or {}).get("field")
+
+
+def assemble(inputs: Dict) -> Dict:
+    """summary, findings and recommendations from the gathered inputs"""
+    field = inputs["field"]
+    states = inputs["states"]
+    forecast = inputs["forecast"] or {}
+    zone_values = {analysis_type: state["zone_values"] for analysis_type, state in states.items()}
+
+    findings = []
+    parts = []
+    nutrients = zone_values.get("nutrient_mapping")
+    if nutrients:
+        health = _field_value(nutrients, "overall_health_score")
+        findings.append({
+            "type": "nutrient_mapping",
+            "analysis_id": states["nutrient_mapping"]["analysis_id"],
+            "overall_health_score": health,
+            "deficiencies": {
+                nutrient: _field_value(nutrients, f"{nutrient}_deficiency")
+                for nutrient in recommendations.NUTRIENT_RATES
+            },
+        })
+        if health is not None:
+            parts.append(f"health score {health}")
+
+    pests = zone_values.get("pest_detection")
+    if pests:
+        counts = pests.get("detections") or {}
+        total = int(sum(counts.values()))
+        risk = recommendations.pest_risk_level(total)
+        findings.append({
+            "type": "pest_detection",
+            "analysis_id": states["pest_detection"]["analysis_id"],
+            "detections": total,
+            "detections_by_zone": counts,
+            "affected_area_percentage": _field_value(pests, "affected_area_percentage"),
+            "risk_level": risk,
+        })
+        parts.append(f"{total} pest detections ({risk} risk)")
+
+    if forecast.get("predicted_yield_tons_per_hectare") is not None:
+        findings.append({"type": "forecast", **forecast})
+        parts.append(f"forecast {forecast['predicted_yield_tons_per_hectare']} t/ha")
+        if forecast.get("days_to_harvest") is not None:
+            parts.append(f"{forecast['days_to_harvest']} days to harvest")
+
+    for analysis_type, change in inputs["changes"].items():
+        grid = change.get("grid_summary") or {}
+        findings.append({
+            "type": "change",
+            "analysis_type": analysis_type,
+            "zone_deltas": change.get("zone_deltas"),
+            "worsened_fraction": grid.get("worsened_fraction"),
+            "improved_fraction": grid.get("improved_fraction"),
+        })
+
+    title = " ".join(filter(None, [field.get("crop_type"), "field", field.get("name") or field["id"]]))
+    if field.get("area_hectares"):
+        title += f" ({field['area_hectares']} ha)"
+    summary = f"{title}: {', '.join(parts)}." if parts else f"{title}: no completed analyses yet."
+
+    return {
+        "summary": summary,
+        "findings": findings,
+        "recommendations": recommendations.field_recommendations(zone_values, forecast.get("days_to_harvest")),
+    }
+
+
+def render_html(report: Dict) -> str:
+    def cell(value):
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, default=str)
+        return html.escape("" if value is None else str(value))
+
+    sections = []
+    for finding in report["findings"]:
+        rows = "".join(
+            f"<tr><th>{cell(key)}</th><td>{cell(value)}</td></tr>"
+            for key, value in finding.items() if key != "type"
+        )
+        sections.append(f"<h2>{cell(finding['type'].replace('_', ' ').title())}</h2><table>{rows}</table>")
+    items = "".join(f"<li>{cell(text)}</li>" for text in report["recommendations"])
+
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+        f"<title>AgriScan report - {cell(report['field_id'])}</title>"
+        "<style>body{font-family:sans-serif;max-width:50em;margin:2em auto}"
+        "table{border-collapse:collapse}th,td{border:1px solid #ccc;padding:4px 8px;text-align:left}</style>"
+        "</head><body>"
+        f"<h1>Field report</h1><p>{cell(report['summary'])}</p>"
+        f"<p><small>Generated {cell(report['generated_at'])}</small></p>"
+        f"{''.join(sections)}"
+        f"<h2>Recommendations</h2><ul>{items}</ul>"
+        "</body></html>"
+    )
+
+
+def _store(key: str, data: bytes, format: str):
+    partial = storage.staging_dir() / f".{uuid.uuid4().hex}.{format}.part"
+    partial.write_bytes(data)
+    storage.get_storage().put_file(key, partial, FORMATS[format])
+
+
+# ---------------------------------------------------------------------------
+# Generation
+# ---------------------------------------------------------------------------
+
+def latest_report(db: Session, field_id: str) -> Optional[models.Report]:
+    return db.query(models.Report).filter(
+        models.Report.field_id == field_id
+    ).order_by(models.Report.generated_at.desc()).first()
+
+
+def generate(db: Session, field_id: str, force: bool = False) -> models.Report:
+    """Render a new report for the field unless its inputs are unchanged"""
+    inputs = gather_inputs(db, field_id)
+    inputs_hash = fingerprint(inputs)
+    current = latest_report(db, field_id)
+    if (not force and current is not None and current.inputs_hash == inputs_hash
+            and artifact_path(current, "html") is not None):
+        metrics.incr("reports", "unchanged")
+        return current
+
+    started = time.perf_counter()
+    report = models.Report(field_id=field_id, generated_at=datetime.utcnow(), inputs_hash=inputs_hash)
+    db.add(report)
+    db.flush()  # assigns the id used in the artifact names
+
+    content = assemble(inputs)
+    document = {"id": report.id, "field_id": field_id, "generated_at": report.generated_at, **content}
+
+    json_key = artifact_key(field_id, report.id, "json")
+    html_key = artifact_key(field_id, report.id, "html")
+    _store(json_key, serialization.dumps(document), "json")
+    _store(html_key, render_html(document).encode(), "html")
+
+    report.summary = content["summary"]
+    report.findings = content["findings"]
+    report.recommendations = content["recommendations"]
+    report.json_path = json_key
+    report.html_path = html_key
+    db.commit()
+    prune(db, field_id)
+
+    metrics.incr("reports", "generated")
+    metrics.incr("reports", "render_seconds", time.perf_counter() - started)
+    return report
+
+
+def prune(db: Session, field_id: str, keep: int = REPORTS_KEPT) -> int:
+    """Delete all but the newest keep reports of a field, artifacts first; returns how many went"""
+    stale = db.query(models.Report).filter(
+        models.Report.field_id == field_id
+    ).order_by(models.Report.generated_at.desc()).offset(keep).all()
+    for report in stale:
+        for key in (report.json_path, report.html_path):
+            try:
+                if key:
+                    storage.get_storage().delete(key)
+            except ValueError:
+                pass  # a path under the old REPORT_DIR
+        db.delete(report)
+    db.commit()
+    if stale:
+        metrics.incr("reports", "pruned", len(stale))
+    return len(stale)
+
+
+class ReportWorker:
+    """
+    Background thread that renders reports for scheduled fields.
+    A field scheduled again before its report is rendered is rendered once.
+    """
+
+    def __init__(self, delay: float = SCHEDULE_DELAY_SECONDS):
+        self.delay = delay
+        self._due: Dict[str, float] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, field_id: str):
+        with self._condition:
+            self._due.setdefault(field_id, time.monotonic() + self.delay)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="report-worker", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._due)
+
+    def _next_field(self) -> str:
+        with self._condition:
+            while True:
+                if not self._due:
+                    self._condition.wait()
+                    continue
+                field_id, due = min(self._due.items(), key=lambda item: item[1])
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    del self._due[field_id]
+                    return field_id
+                self._condition.wait(remaining)
+
+    def _run(self):
+        from app.database import SessionLocal
+
+        while True:
+            field_id = self._next_field()
+            db = SessionLocal()
+            try:
+                generate(db, field_id)
+            except Exception as e:
+                db.rollback()
+                metrics.incr("reports", "failures")
+                print(f"Report generation failed for field {field_id}: {e}")
+            finally:
+                db.close()
+
+
+worker = ReportWorker()
+
+
+def schedule(field_id: str):
+    worker.schedule(field_id)
+
+
+def main():
+    from app.database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(prog="python -m app.reports", description="Render field reports")
+    parser.add_argument("--field-id", default=None, help="only this field")
+    parser.add_argument("--force", action="store_true", help="re-render even if inputs are unchanged")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.field_id:
+            field_ids = [args.field_id]
+        else:
+            field_ids = [row[0] for row in db.query(models.FieldState.field_id).distinct()]
+        started = time.perf_counter()
+        for field_id in field_ids:
+            generate(db, field_id, force=args.force)
+        print(f"✓ Reports for {len(field_ids)} fields in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ class AnalysisResponse(AnalysisBase):
     results_json: Optional[Dict[str, Any]]
     confidence_score: Optional[float]
     status: str
+    stage: Optional[str] = None
+    progress: Optional[float] = None
     created_at: datetime
     
     class Config:
@@ -34,3 +36,48 @@ class YieldPredictionRequest(BaseModel):
     field_id: str
     image_id: str
     historical_yield: Optional[float] = None
+
+class FieldChangeResponse(BaseModel):
+    id: str
+    field_id: str
+    analysis_type: str
+    analysis_id: str
+    previous_analysis_id: Optional[str]
+    zone_deltas: Optional[Dict[str, Any]]
+    grid_summary: Optional[Dict[str, Any]]
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class AlertRuleCreate(BaseModel):
+    name: Optional[str] = None
+    field_id: Optional[str] = None  # None = every field
+    analysis_type: str
+    condition: Dict[str, Any]
+    sink: str = "queue"
+    target: Optional[str] = None
+    throttle_seconds: Optional[int] = None
+    enabled: bool = True
+
+class AlertRuleResponse(AlertRuleCreate):
+    id: str
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class AlertResponse(BaseModel):
+    id: str
+    rule_id: str
+    field_id: Optional[str]
+    analysis_id: Optional[str]
+    message: Optional[str]
+    payload: Optional[Dict[str, Any]]
+    status: str
+    attempts: Optional[int]
+    created_at: datetime
+    delivered_at: Optional[datetime]
+    
+    class Config:
+        from_attributes = True
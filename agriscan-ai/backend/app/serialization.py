@@ -0,0 +1,205 @@
+"""
+Fast response path for large analysis payloads.
+
+- dumps(): orjson when installed (falls back to the json module)
+- encode_analysis(): builds the AnalysisResponse shape directly from the ORM
+  row, skipping jsonable_encoder and pydantic validation
+- columnar detections: {"pest_type": [...], "confidence": [...], ...} instead of
+  a list of dicts, roughly halving payload size for dense results. Pest
+  results are stored this way (marked "pests_encoding": "columnar");
+  results_for() expands them to one dict per detection only for responses
+  that ask for rows (lists stored by older versions are converted to columns
+  when those are asked for)
+- analysis_response(): negotiates br/gzip for large bodies and caches the
+  encoded (and compressed) bytes of terminal analyses. Entries are keyed on
+  the row's updated_at, so a later write (replication upserts a terminal
+  analysis again, for one) misses the cache in every worker process
+"""
+import gzip
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Response
+
+from app import metrics
+from app.config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+# Below this size compression costs more than it saves
+COMPRESSION_MIN_BYTES = 1024
+DETECTION_ENCODINGS = ("rows", "columnar")
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Type {type(value)} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def to_columnar(pests: List[Dict]) -> Dict[str, List]:
+    """List of detection dicts -> parallel arrays (bbox flattened to x/y/width/height)"""
+    columns = {"pest_type": [], "confidence": [], "x": [], "y": [], "width": [], "height": [], "zone": []}
+    for pest in pests:
+        bbox = pest.get("bbox") or {}
+        columns["pest_type"].append(pest.get("pest_type"))
+        columns["confidence"].append(pest.get("confidence"))
+        columns["x"].append(bbox.get("x"))
+        columns["y"].append(bbox.get("y"))
+        columns["width"].append(bbox.get("width"))
+        columns["height"].append(bbox.get("height"))
+        columns["zone"].append(pest.get("zone"))
+    return columns
+
+
+def to_records(columns: Dict[str, List]) -> List[Dict]:
+    """Parallel arrays -> one detection dict per row, with the bbox nested"""
+    return [
+        {"pest_type": pest_type, "confidence": confidence,
+         "bbox": {"x": x, "y": y, "width": width, "height": height}, "zone": zone}
+        for pest_type, confidence, x, y, width, height, zone in zip(
+            columns["pest_type"], columns["confidence"], columns["x"], columns["y"],
+            columns["width"], columns["height"], columns["zone"])
+    ]
+
+
+def results_for(results: Optional[Dict], detections: str = "rows") -> Optional[Dict]:
+    """results_json with its pests in the requested encoding, whichever way they were stored"""
+    pests = results.get("pests") if results else None
+    if detections == "columnar" and isinstance(pests, list):
+        return {**results, "pests": to_columnar(pests), "pests_encoding": "columnar"}
+    if detections == "rows" and isinstance(pests, dict):
+        expanded = {key: value for key, value in results.items() if key != "pests_encoding"}
+        expanded["pests"] = to_records(pests)
+        return expanded
+    return results
+
+
+def encode_analysis(analysis, detections: str = "rows") -> Dict:
+    """AnalysisResponse-shaped dict straight from the ORM row"""
+    results = results_for(analysis.results_json, detections)
+    return {
+        "field_id": analysis.field_id,
+        "analysis_type": analysis.analysis_type,
+        "id": analysis.id,
+        "original_image_url": analysis.original_image_url,
+        "results_json": results,
+        "confidence_score": analysis.confidence_score,
+        "status": analysis.status,
+        "stage": analysis.stage,
+        "progress": analysis.progress,
+        "created_at": analysis.created_at,
+    }
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {part.split(";")[0].strip() for part in (accept_encoding or "").lower().split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+
+class PayloadCache:
+    """
+    LRU of encoded bodies for terminal analyses, bounded by total bytes.
+    Keyed by (analysis id, updated_at, detection encoding, accepted content
+    encoding); values are (body, content encoding actually applied).
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, Tuple[bytes, Optional[str]]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[Tuple[bytes, Optional[str]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                metrics.incr("serialization", "cache_misses")
+                return None
+            self._entries.move_to_end(key)
+            metrics.incr("serialization", "cache_hits")
+            return entry
+
+    def put(self, key: tuple, body: bytes, encoding: Optional[str]):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (body, encoding)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+            metrics.set_gauge("serialization", "cache_bytes", self._bytes)
+
+    def invalidate(self, *analysis_ids: str):
+        ids = set(analysis_ids)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] in ids]:
+                self._bytes -= len(self._entries.pop(key)[0])
+            metrics.set_gauge("serialization", "cache_bytes", self._bytes)
+
+
+payload_cache = PayloadCache(settings.PAYLOAD_CACHE_MAX_BYTES)
+
+
+def analysis_response(analysis, accept_encoding: str = "", detections: str = "rows") -> Response:
+    """Serialized (and possibly compressed) response for one analysis"""
+    cacheable = analysis.status in TERMINAL_STATUSES
+    accepted = choose_encoding(accept_encoding)
+    key = (analysis.id, analysis.updated_at, detections, accepted)
+
+    entry = payload_cache.get(key) if cacheable else None
+    if entry is None:
+        raw = dumps(encode_analysis(analysis, detections))
+        encoding = accepted if len(raw) >= COMPRESSION_MIN_BYTES else None
+        entry = (compress(raw, encoding), encoding)
+        if cacheable:
+            payload_cache.put(key, *entry)
+
+    body, encoding = entry
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
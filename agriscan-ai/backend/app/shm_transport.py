@@ -0,0 +1,276 @@
+"""
+Zero-copy handoff of image buffers to worker processes.
+
+Passing a decoded raster to a process pool normally pickles it: the array is
+copied into the pipe, again into the worker, and both processes hold it. Here
+the producer copies the pixels once into a multiprocessing.shared_memory
+segment and sends only a small SharedRaster handle (segment name, shape,
+dtype). Workers attach by name and wrap the segment as a read-only ndarray.
+
+Lifetime is reference counted with lease files in LEASE_DIR, one per holder:
+  - create()/publish() make the segment with a lease for the producer
+  - share() adds a pending lease for one consumer; attach() claims it
+  - release() (or leaving attach()) drops a lease; the last one unlinks the
+    segment
+Each lease records its holder's pid. sweep() drops leases whose holder died
+and unclaimed leases older than PENDING_TTL_SECONDS, and unlinks segments left
+with none, so crashed producers or workers don't leak /dev/shm. create()
+sweeps on every call.
+
+Segments are unregistered from Python's resource_tracker, which would
+otherwise unlink them when whichever process touched them first exits.
+Lease locking uses fcntl, so this is POSIX-only (the workers run on Linux).
+"""
+import fcntl
+import json
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app import metrics
+
+SEGMENT_PREFIX = "agriscan_"
+LEASE_DIR = Path(tempfile.gettempdir()) / "agriscan-shm"
+SHM_DIR = Path("/dev/shm")
+# A shared handle nobody attached to within this time is treated as lost
+PENDING_TTL_SECONDS = 600
+
+
+@dataclass(frozen=True)
+class SharedRaster:
+    """Picklable handle to a shared pixel buffer; token identifies the holder's lease"""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    token: Optional[str] = None
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _untrack(segment: SharedMemory):
+    # Lifetime is ours (leases + sweep), not the resource tracker's
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _open(name: str) -> SharedMemory:
+    segment = SharedMemory(name=name)
+    _untrack(segment)
+    return segment
+
+
+def _unlink(name: str) -> bool:
+    try:
+        # Left registered: unlink() unregisters it again
+        segment = SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    segment.close()
+    segment.unlink()
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Leases
+# ---------------------------------------------------------------------------
+
+@contextmanager
+def _locked():
+    # One lock for all segments: lease operations are a few small file writes
+    LEASE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LEASE_DIR / ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _lease_path(name: str, token: str) -> Path:
+    return LEASE_DIR / f"{name}.{token}.lease"
+
+
+def _write_lease(name: str, token: str, claimed: bool):
+    path = _lease_path(name, token)
+    partial = path.with_suffix(".tmp")
+    partial.write_text(json.dumps({"pid": os.getpid(), "claimed": claimed, "created": time.time()}))
+    os.replace(partial, path)
+
+
+def _leases(name: str) -> List[Path]:
+    return list(LEASE_DIR.glob(f"{name}.*.lease"))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    try:
+        # A crashed worker not yet reaped by its parent is a zombie: signalable, but gone
+        return Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+def _lease_live(path: Path, now: float) -> bool:
+    try:
+        lease = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return False
+    if not _alive(lease["pid"]):
+        return False
+    return lease["claimed"] or now - lease["created"] < PENDING_TTL_SECONDS
+
+
+def _drop(name: str, token: str):
+    with _locked():
+        _lease_path(name, token).unlink(missing_ok=True)
+        if not _leases(name):
+            _unlink(name)
+            metrics.incr("shm", "segments_freed")
+
+
+# ---------------------------------------------------------------------------
+# Producer / consumer API
+# ---------------------------------------------------------------------------
+
+def _close(segment: SharedMemory):
+    try:
+        segment.close()
+    except BufferError:
+        # A view outlived its with-block; the mapping goes when it is collected
+        pass
+
+
+@contextmanager
+def create(shape: Tuple[int, ...], dtype="uint8") -> Iterator[Tuple[SharedRaster, np.ndarray]]:
+    """
+    New segment as (handle, writable array), so the producer can decode
+    straight into shared memory. The caller holds the handle's lease.
+    """
+    sweep()
+    dtype = np.dtype(dtype)
+    name = f"{SEGMENT_PREFIX}{uuid.uuid4().hex[:20]}"
+    handle = SharedRaster(name, tuple(shape), dtype.str, uuid.uuid4().hex[:12])
+    with _locked():
+        segment = SharedMemory(name=name, create=True, size=max(1, handle.nbytes))
+        _untrack(segment)
+        _write_lease(name, handle.token, claimed=True)
+    metrics.incr("shm", "segments_created")
+    metrics.incr("shm", "bytes_shared", handle.nbytes)
+    view = np.ndarray(handle.shape, dtype=dtype, buffer=segment.buf)
+    try:
+        yield handle, view
+    except BaseException:
+        del view
+        _close(segment)
+        release(handle)
+        raise
+    del view
+    _close(segment)
+
+
+def publish(array: np.ndarray) -> SharedRaster:
+    """Copy array into a new segment (the only copy made); the caller holds the returned lease"""
+    with create(array.shape, array.dtype) as (handle, view):
+        np.copyto(view, array)
+        del view
+    return handle
+
+
+def share(handle: SharedRaster) -> SharedRaster:
+    """A handle with its own pending lease, to send to one consumer"""
+    token = uuid.uuid4().hex[:12]
+    with _locked():
+        if not _leases(handle.name):
+            raise FileNotFoundError(f"Shared raster {handle.name} was already freed")
+        _write_lease(handle.name, token, claimed=False)
+    return replace(handle, token=token)
+
+
+def release(handle: SharedRaster):
+    """Drop this handle's lease; the last lease unlinks the segment"""
+    if handle.token:
+        _drop(handle.name, handle.token)
+
+
+@contextmanager
+def attach(handle: SharedRaster) -> Iterator[np.ndarray]:
+    """Claim the handle's lease and yield the pixels as a read-only array (no copy); released on exit"""
+    with _locked():
+        segment = _open(handle.name)
+        if handle.token:
+            _write_lease(handle.name, handle.token, claimed=True)
+    array = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=segment.buf)
+    array.flags.writeable = False
+    metrics.incr("shm", "attaches")
+    try:
+        yield array
+    finally:
+        del array
+        _close(segment)
+        release(handle)
+
+
+def sweep() -> int:
+    """Drop leases of dead holders and expired pending leases; unlink segments left without leases"""
+    if not LEASE_DIR.is_dir():
+        return 0
+    now = time.time()
+    names = {path.name.split(".", 1)[0] for path in LEASE_DIR.glob(f"{SEGMENT_PREFIX}*.lease")}
+    if SHM_DIR.is_dir():
+        # Segments whose creator died before writing its lease
+        for path in SHM_DIR.glob(f"{SEGMENT_PREFIX}*"):
+            try:
+                if now - path.stat().st_mtime > PENDING_TTL_SECONDS:
+                    names.add(path.name)
+            except FileNotFoundError:
+                continue
+    reclaimed = 0
+    for name in names:
+        with _locked():
+            for lease in _leases(name):
+                if not _lease_live(lease, now):
+                    lease.unlink(missing_ok=True)
+                    metrics.incr("shm", "leases_reclaimed")
+            if not _leases(name):
+                if _unlink(name):
+                    reclaimed += 1
+    if reclaimed:
+        metrics.incr("shm", "segments_reclaimed", reclaimed)
+    return reclaimed
+
+
+# ---------------------------------------------------------------------------
+# Process pools
+# ---------------------------------------------------------------------------
+
+def _run_attached(fn: Callable, handle: SharedRaster, args, kwargs):
+    with attach(handle) as array:
+        return fn(array, *args, **kwargs)
+
+
+def submit(executor: Executor, fn: Callable, array: np.ndarray, *args, **kwargs) -> Future:
+    """
+    executor.submit(fn, array, *args) with the array passed through shared
+    memory; fn must be picklable (module level) and not keep the array.
+    """
+    handle = publish(array)
+    try:
+        return executor.submit(_run_attached, fn, share(handle), args, kwargs)
+    finally:
+        release(handle)
@@ -0,0 +1,372 @@
+"""
+Storage for uploads and derived artifacts (tile pyramids, rasters, reports).
+
+Objects are addressed by key ("<upload_id>.jpg", "tiles/<upload_id>.mbtiles").
+The key an upload was stored under is recorded on its row (Upload.storage_key),
+so finding it is a primary-key lookup rather than a listing of the store.
+Two backends:
+  - local: keys are paths under UPLOAD_DIR (single node, or a shared mount)
+  - s3:    any S3-compatible store (AWS, MinIO, ...), so API nodes and
+           workers on different machines share one set of objects
+
+Code that needs a real file (PIL, SQLite) calls local_path(). The local
+backend returns the file itself; the S3 backend downloads into a size-bounded
+read-through cache on the worker, revalidating cached copies by ETag at most
+every CACHE_REVALIDATE_SECONDS. Clients download via url(): a /uploads path
+for local storage, a presigned URL for S3.
+
+boto3 is only needed for the s3 backend and is imported there.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app import metrics
+from app.config import settings
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Cached objects are checked against the store at most this often
+CACHE_REVALIDATE_SECONDS = 60
+
+
+class LocalStorage:
+    """Objects are files under root"""
+
+    is_local = True
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Invalid storage key {key}")
+        return path
+
+    def put_file(self, key: str, source: Path, content_type: Optional[str] = None):
+        """Move source into the store (atomic rename when on the same filesystem)"""
+        target = self._path(key)
+        if Path(source).resolve() == target:
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(source), str(target))
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def size(self, key: str) -> Optional[int]:
+        path = self._path(key)
+        return path.stat().st_size if path.is_file() else None
+
+    def list(self, prefix: str) -> List[str]:
+        directory = self._path(prefix).parent if "/" in prefix else self.root
+        if not directory.is_dir():
+            return []
+        base = prefix.rsplit("/", 1)[-1]
+        return [
+            str(path.relative_to(self.root)) for path in directory.iterdir()
+            if path.is_file() and path.name.startswith(base)
+        ]
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def iter_range(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Stream bytes [start, end) of an object"""
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def local_path(self, key: str) -> Optional[Path]:
+        path = self._path(key)
+        return path if path.is_file() else None
+
+    def url(self, key: str, expires: Optional[int] = None) -> str:
+        return f"/uploads/{key}"
+
+
+class ReadThroughCache:
+    """
+    Worker-local copies of remote objects, evicted least recently used first.
+    The directory is scanned once at start; after that sizes are kept as a
+    running total, so misses and puts never walk the cache.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (etag, last validated)
+        self._validated: Dict[str, Tuple[str, float]] = {}
+        # key -> size, least recently used first
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        if self.directory.is_dir():
+            found = [p for p in self.directory.rglob("*") if p.is_file() and not p.name.endswith(".part")]
+            for path in sorted(found, key=lambda p: p.stat().st_mtime):
+                self._files[str(path.relative_to(self.directory))] = path.stat().st_size
+            self._bytes = sum(self._files.values())
+
+    def path_for(self, key: str) -> Path:
+        return self.directory / key
+
+    def get(self, key: str, etag_of, download) -> Optional[Path]:
+        """
+        Cached path for key. etag_of(key) returns the remote ETag (None if
+        missing); download(key, path) fetches the object into path.
+        """
+        path = self.path_for(key)
+        with self._lock:
+            validated = self._validated.get(key)
+        if path.is_file() and validated and time.monotonic() - validated[1] < CACHE_REVALIDATE_SECONDS:
+            metrics.incr("storage", "cache_hits")
+            self._touch(key)
+            return path
+
+        etag = etag_of(key)
+        if etag is None:
+            return None
+        if path.is_file() and validated and validated[0] == etag:
+            metrics.incr("storage", "cache_hits")
+        else:
+            metrics.incr("storage", "cache_misses")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            partial = path.with_name(f".{path.name}.{threading.get_ident()}.part")
+            download(key, partial)
+            os.replace(partial, path)
+            self._added(key, path)
+        with self._lock:
+            self._validated[key] = (etag, time.monotonic())
+        self._touch(key)
+        return path
+
+    def put(self, key: str, source: Path, etag: str):
+        """Keep a just-uploaded file as the cached copy"""
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if Path(source).resolve() != path.resolve():
+            shutil.copyfile(source, path)
+        with self._lock:
+            self._validated[key] = (etag, time.monotonic())
+        self._added(key, path)
+
+    def _touch(self, key: str):
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+
+    def _added(self, key: str, path: Path):
+        """Account a new or replaced file, then evict down to max_bytes; key (in use by the caller) is spared"""
+        evicted = []
+        with self._lock:
+            self._bytes -= self._files.pop(key, 0)
+            self._files[key] = path.stat().st_size
+            self._bytes += self._files[key]
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self._bytes -= size
+                self._validated.pop(old, None)
+                evicted.append(old)
+            total = self._bytes
+        for old in evicted:
+            self.path_for(old).unlink(missing_ok=True)
+            metrics.incr("storage", "cache_evictions")
+        metrics.set_gauge("storage", "cache_bytes", total)
+
+    def discard(self, key: str):
+        """Drop a cached copy (the object was deleted from the store)"""
+        with self._lock:
+            self._bytes -= self._files.pop(key, 0)
+            self._validated.pop(key, None)
+        self.path_for(key).unlink(missing_ok=True)
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, with a local read-through cache"""
+
+    is_local = False
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None,
+                 cache_dir: str = "./cache/storage", cache_max_bytes: int = 10 * 1024 ** 3):
+        import boto3
+
+        self.bucket = bucket
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=settings.S3_ACCESS_KEY_ID or None,
+            aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY or None,
+        )
+        self.cache = ReadThroughCache(cache_dir, cache_max_bytes)
+
+    def _head(self, key: str) -> Optional[Dict]:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def put_file(self, key: str, source: Path, content_type: Optional[str] = None):
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.upload_file(str(source), self.bucket, key, ExtraArgs=extra)
+        head = self._head(key)
+        self.cache.put(key, Path(source), head["ETag"])
+        if Path(source).resolve() != self.cache.path_for(key).resolve():
+            Path(source).unlink(missing_ok=True)
+        metrics.incr("storage", "uploads")
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str) -> Optional[int]:
+        head = self._head(key)
+        return head["ContentLength"] if head else None
+
+    def list(self, prefix: str) -> List[str]:
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=prefix)
+        return [item["Key"] for item in response.get("Contents", [])]
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+        self.cache.discard(key)
+
+    def iter_range(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Stream bytes [start, end) of an object without buffering it whole"""
+        byte_range = f"bytes={start}-{'' if end is None else end - 1}"
+        body = self.client.get_object(Bucket=self.bucket, Key=key, Range=byte_range)["Body"]
+        try:
+            yield from body.iter_chunks(STREAM_CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def _download(self, key: str, path: Path):
+        with open(path, "wb") as f:
+            for chunk in self.iter_range(key):
+                f.write(chunk)
+        metrics.incr("storage", "downloaded_bytes", path.stat().st_size)
+
+    def _etag(self, key: str) -> Optional[str]:
+        head = self._head(key)
+        return head["ETag"] if head else None
+
+    def local_path(self, key: str) -> Optional[Path]:
+        return self.cache.get(key, self._etag, self._download)
+
+    def url(self, key: str, expires: Optional[int] = None) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=expires or settings.PRESIGNED_URL_TTL_SECONDS
+        )
+
+
+def create_storage():
+    if settings.STORAGE_BACKEND == "s3":
+        return S3Storage(
+            settings.S3_BUCKET,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region=settings.S3_REGION,
+            cache_dir=settings.STORAGE_CACHE_DIR,
+            cache_max_bytes=settings.STORAGE_CACHE_MAX_BYTES,
+        )
+    return LocalStorage(settings.UPLOAD_DIR)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def staging_dir() -> Path:
+    """Where new objects are written before put_file(); on the same filesystem for local storage"""
+    storage = get_storage()
+    directory = storage.root / ".staging" if storage.is_local else Path(tempfile.gettempdir()) / "agriscan-staging"
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+# ---------------------------------------------------------------------------
+# Uploads
+# ---------------------------------------------------------------------------
+
+@contextmanager
+def _session(db=None):
+    """The caller's session, or a short-lived one of our own"""
+    if db is not None:
+        yield db
+        return
+    from app.database import SessionLocal
+
+    own = SessionLocal()
+    try:
+        yield own
+    finally:
+        own.close()
+
+
+def recorded_keys(upload_id: str, db=None) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """(storage_key, raster_key) from the Upload row, or None if there is no row"""
+    from app.models import Upload
+
+    with _session(db) as session:
+        row = session.query(Upload.storage_key, Upload.raster_key).filter(Upload.id == upload_id).first()
+    return (row[0], row[1]) if row is not None else None
+
+
+def find_upload_key(upload_id: str, db=None) -> Optional[str]:
+    """
+    The key an upload is read from, as recorded on its row at upload time (the
+    raster's key once the original is removed under the retention policy, see
+    app.rasters). Rows from before keys were recorded fall back to listing
+    <upload_id>.<ext>, and the key found is saved on the row. db is the
+    caller's session, if it has one. Raises ValueError for ids that are not
+    a single path segment.
+    """
+    if "/" in upload_id or "\\" in upload_id or upload_id in ("", ".", ".."):
+        raise ValueError(f"Invalid upload id {upload_id!r}")
+    recorded = recorded_keys(upload_id, db)
+    if recorded is not None and recorded[0]:
+        return recorded[0]
+
+    keys = get_storage().list(f"{upload_id}.") or get_storage().list(f"rasters/{upload_id}.")
+    if not keys:
+        return None
+    if recorded is not None:
+        from app.models import Upload
+
+        with _session(db) as session:
+            session.query(Upload).filter(Upload.id == upload_id).update({"storage_key": keys[0]})
+            session.commit()
+        metrics.incr("storage", "upload_keys_backfilled")
+    return keys[0]
+
+
+def upload_path(upload_id: str) -> Optional[Path]:
+    """Local file for an upload (downloaded through the cache on S3)"""
+    key = find_upload_key(upload_id)
+    return get_storage().local_path(key) if key else None
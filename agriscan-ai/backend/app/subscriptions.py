@@ -0,0 +1,267 @@
+"""
+Multiplexed analysis status subscriptions.
+
+One connection (WebSocket /ws/analyses, or SSE /api/analyses/events) can
+watch any set of analysis ids and/or whole fields. Instead of a polling loop
+per analysis, a single Hub per process asks the database for analyses whose
+updated_at moved since its last poll (one indexed query per interval, however
+many clients are connected) and fans the changed rows out to the subscribers
+that asked for them. Per subscriber, updates are coalesced (the latest status
+per analysis wins) and sent in one batch per BATCH_WINDOW_SECONDS, so cost is
+O(connections + events), not O(analyses x seconds).
+
+Messages are {"type": "updates", "analyses": [status, ...]}; a subscription
+first receives the current status of what it subscribed to, in the same shape.
+WebSocket clients send {"subscribe": {"ids": [...], "field_ids": [...]}} or
+{"unsubscribe": {...}}.
+"""
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+
+from app import metrics, serialization
+from app.models import Analysis
+
+POLL_INTERVAL_SECONDS = 1.0
+BATCH_WINDOW_SECONDS = 0.25
+HEARTBEAT_SECONDS = 15.0
+MAX_IDS = 1000
+# Re-read this far behind the watermark: commits can land with a slightly older updated_at
+POLL_OVERLAP = timedelta(seconds=2)
+# SQLite allows 999 bound parameters per statement
+IN_CHUNK = 500
+STATUS_COLUMNS = (Analysis.id, Analysis.field_id, Analysis.analysis_type, Analysis.status,
+                  Analysis.stage, Analysis.progress, Analysis.updated_at)
+
+
+def status_of(row) -> Dict:
+    return {
+        "id": row.id,
+        "field_id": row.field_id,
+        "analysis_type": row.analysis_type,
+        "status": row.status,
+        "stage": row.stage,
+        "progress": row.progress,
+        "updated_at": row.updated_at,
+    }
+
+
+def fetch_statuses(db, ids: Iterable[str]) -> List[Dict]:
+    """Current status of each id, with one IN query per IN_CHUNK ids"""
+    ids = list(dict.fromkeys(ids))
+    statuses = []
+    for start in range(0, len(ids), IN_CHUNK):
+        rows = db.query(*STATUS_COLUMNS).filter(Analysis.id.in_(ids[start:start + IN_CHUNK])).all()
+        statuses.extend(status_of(row) for row in rows)
+    return statuses
+
+
+def fetch_field_statuses(db, field_ids: Iterable[str]) -> List[Dict]:
+    """Queued and running analyses of the given fields"""
+    field_ids = list(field_ids)
+    if not field_ids:
+        return []
+    rows = db.query(*STATUS_COLUMNS).filter(
+        Analysis.field_id.in_(field_ids),
+        Analysis.status.in_(("queued", "processing"))
+    ).all()
+    return [status_of(row) for row in rows]
+
+
+class Subscriber:
+    def __init__(self):
+        self.ids: Set[str] = set()
+        self.field_ids: Set[str] = set()
+        self.pending: Dict[str, Dict] = {}
+        self.wakeup = asyncio.Event()
+
+    def push(self, status: Dict):
+        self.pending[status["id"]] = status
+        self.wakeup.set()
+
+    async def next_batch(self, timeout: float) -> List[Dict]:
+        """Coalesced updates; empty after timeout with nothing to send"""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        await asyncio.sleep(BATCH_WINDOW_SECONDS)
+        self.wakeup.clear()
+        batch, self.pending = list(self.pending.values()), {}
+        return batch
+
+
+class Hub:
+    def __init__(self):
+        self.by_id: Dict[str, Set[Subscriber]] = defaultdict(set)
+        self.by_field: Dict[str, Set[Subscriber]] = defaultdict(set)
+        self.subscribers: Set[Subscriber] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._watermark: Optional[datetime] = None
+        # analysis id -> updated_at already delivered, for rows re-read in the overlap
+        self._delivered: Dict[str, datetime] = {}
+
+    async def subscribe(self, subscriber: Subscriber, ids: Iterable[str] = (), field_ids: Iterable[str] = ()):
+        ids = set(ids) - subscriber.ids
+        field_ids = set(field_ids) - subscriber.field_ids
+        if len(subscriber.ids) + len(ids) > MAX_IDS:
+            raise ValueError(f"At most {MAX_IDS} analysis ids per subscription")
+        self.subscribers.add(subscriber)
+        subscriber.ids |= ids
+        subscriber.field_ids |= field_ids
+        for analysis_id in ids:
+            self.by_id[analysis_id].add(subscriber)
+        for field_id in field_ids:
+            self.by_field[field_id].add(subscriber)
+        self._ensure_running()
+        metrics.set_gauge("subscriptions", "subscribers", len(self.subscribers))
+
+        def snapshot():
+            from app.database import SessionLocal
+
+            db = SessionLocal()
+            try:
+                return fetch_statuses(db, ids) + fetch_field_statuses(db, field_ids)
+            finally:
+                db.close()
+
+        for status in await run_in_threadpool(snapshot):
+            subscriber.push(status)
+
+    def unsubscribe(self, subscriber: Subscriber, ids: Iterable[str] = (), field_ids: Iterable[str] = ()):
+        for analysis_id in set(ids) & subscriber.ids:
+            subscriber.ids.discard(analysis_id)
+            self._discard(self.by_id, analysis_id, subscriber)
+        for field_id in set(field_ids) & subscriber.field_ids:
+            subscriber.field_ids.discard(field_id)
+            self._discard(self.by_field, field_id, subscriber)
+
+    def remove(self, subscriber: Subscriber):
+        self.unsubscribe(subscriber, list(subscriber.ids), list(subscriber.field_ids))
+        self.subscribers.discard(subscriber)
+        metrics.set_gauge("subscriptions", "subscribers", len(self.subscribers))
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[Subscriber]], key: str, subscriber: Subscriber):
+        subscribers = index.get(key)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del index[key]
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        # A task left on another (closed) loop, e.g. after an app restart in tests, is dead too
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            if self._watermark is None:
+                self._watermark = datetime.utcnow()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        # Stops when the last subscriber leaves; the next subscribe() restarts it
+        while self.subscribers:
+            try:
+                statuses = await run_in_threadpool(self._poll)
+            except Exception as e:
+                metrics.incr("subscriptions", "poll_errors")
+                print(f"Subscription poll failed: {e}")
+                statuses = []
+            self._dispatch(statuses)
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+        self._watermark = None
+        self._delivered.clear()
+
+    def _poll(self) -> List[Dict]:
+        from app.database import SessionLocal
+
+        since = self._watermark - POLL_OVERLAP
+        db = SessionLocal()
+        try:
+            rows = db.query(*STATUS_COLUMNS).filter(Analysis.updated_at > since).order_by(Analysis.updated_at).all()
+        finally:
+            db.close()
+        metrics.incr("subscriptions", "polls")
+
+        changed = []
+        for row in rows:
+            if self._delivered.get(row.id) == row.updated_at:
+                continue
+            self._delivered[row.id] = row.updated_at
+            changed.append(status_of(row))
+        if rows:
+            self._watermark = max(self._watermark, rows[-1].updated_at)
+        horizon = self._watermark - POLL_OVERLAP
+        for analysis_id in [k for k, updated in self._delivered.items() if updated <= horizon]:
+            del self._delivered[analysis_id]
+        return changed
+
+    def _dispatch(self, statuses: List[Dict]):
+        for status in statuses:
+            targets = self.by_id.get(status["id"], set()) | self.by_field.get(status["field_id"], set())
+            for subscriber in targets:
+                subscriber.push(status)
+            if targets:
+                metrics.incr("subscriptions", "events", len(targets))
+
+
+hub = Hub()
+
+
+def _message(batch: List[Dict]) -> str:
+    return serialization.dumps({"type": "updates", "analyses": batch}).decode()
+
+
+async def serve_websocket(websocket: WebSocket):
+    """Subscribe/unsubscribe requests in, batched updates out, over one socket"""
+    subscriber = Subscriber()
+
+    async def receive():
+        while True:
+            message = await websocket.receive_json()
+            for action in ("subscribe", "unsubscribe"):
+                request = message.get(action) if isinstance(message, dict) else None
+                if not isinstance(request, dict):
+                    continue
+                ids, field_ids = request.get("ids") or [], request.get("field_ids") or []
+                if action == "unsubscribe":
+                    hub.unsubscribe(subscriber, ids, field_ids)
+                    continue
+                try:
+                    await hub.subscribe(subscriber, ids, field_ids)
+                except ValueError as e:
+                    await websocket.send_json({"type": "error", "message": str(e)})
+
+    async def send():
+        while True:
+            batch = await subscriber.next_batch(HEARTBEAT_SECONDS)
+            await websocket.send_text(_message(batch) if batch else '{"type":"heartbeat"}')
+
+    metrics.incr("subscriptions", "websocket_connections")
+    tasks = [asyncio.ensure_future(receive()), asyncio.ensure_future(send())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.remove(subscriber)
+    for task in tasks:
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                print(f"Subscription socket error: {task.exception()}")
+
+
+async def event_stream(request, ids: List[str], field_ids: List[str]):
+    """Server-sent events for one fixed subscription (for clients without WebSockets)"""
+    subscriber = Subscriber()
+    await hub.subscribe(subscriber, ids, field_ids)
+    metrics.incr("subscriptions", "sse_connections")
+    try:
+        while not await request.is_disconnected():
+            batch = await subscriber.next_batch(HEARTBEAT_SECONDS)
+            yield f"event: updates\ndata: {_message(batch)}\n\n" if batch else ": heartbeat\n\n"
+    finally:
+        hub.remove(subscriber)
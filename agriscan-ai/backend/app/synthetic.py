@@ -0,0 +1,431 @@
+"""
+Reproducible synthetic fields for benchmarks and load tests.
+
+Everything here is a pure function of its parameters and a seed, so a
+benchmark run can be repeated on the same data:
+  - ndvi_window(): an NDVI pattern (patches, gradient, crop rows, uniform)
+    evaluated on any window of a field of a given size, so rasters far larger
+    than memory are generated tile by tile with identical pixels at any tiling
+  - bands_from_ndvi(): R, G, B, NIR, Red Edge reflectances whose NDVI (band 4
+    as NIR, as in app.tiles and the nutrient model) is the requested pattern
+  - write_raster(): streams a tiled multiband TIFF of any size (multi-gigabyte
+    5-band uint16 included) through tifffile without holding it in memory
+  - plant_pests(): draws pest-like blobs into an image, clustered around
+    hotspots, and returns their ground-truth boxes in the stored detection
+    record format (pest type, bbox, zone as pest_detection assigns it)
+  - field_polygon(): a GeoJSON polygon of a given area for Field.location
+  - populate(): bulk Field and Analysis fixtures (millions of rows) through
+    batched Core inserts
+
+From the command line:
+
+    python -m app.synthetic raster field.tif --width 20000 --height 20000 --bands 5
+    python -m app.synthetic image flight.jpg --megapixels 20 --pests 500 --truth truth.json
+    python -m app.synthetic fixtures --fields 200 --analyses 2000000
+"""
+import argparse
+import json
+import math
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+PATTERNS = ("patches", "gradient", "rows", "uniform")
+# NDRE follows NDVI at this ratio (it saturates later but spans less of the range)
+NDRE_RATIO = 0.55
+NOISE = 0.03  # per-pixel NDVI noise (standard deviation)
+PATCH_COUNT = 12
+ROW_SPACING_PIXELS = 16
+TILE_SIZE = 512
+ANALYSIS_TYPES = ("pest_detection", "nutrient_mapping", "yield_prediction")
+STATUS_WEIGHTS = {"completed": 0.94, "failed": 0.03, "processing": 0.01, "queued": 0.02}
+# RGB of planted objects per pest class (cycled for classes past the table)
+PEST_COLORS = ((40, 60, 20), (235, 235, 225), (95, 120, 30), (30, 25, 20), (150, 40, 30))
+METRES_PER_DEGREE = 111_320.0
+
+
+# ---------------------------------------------------------------------------
+# Rasters
+# ---------------------------------------------------------------------------
+
+def _pattern_params(pattern: str, seed: int) -> Dict:
+    rng = np.random.default_rng(seed)
+    if pattern == "patches":
+        return {
+            "centres": rng.uniform(0, 1, (PATCH_COUNT, 2)),
+            "radii": rng.uniform(0.04, 0.2, PATCH_COUNT),
+            "weights": rng.choice([-1.0, 1.0], PATCH_COUNT, p=[0.6, 0.4]) * rng.uniform(0.8, 2.0, PATCH_COUNT),
+            "waves": rng.uniform(1, 4, 2),
+        }
+    if pattern == "gradient":
+        return {"angle": rng.uniform(0, 2 * math.pi)}
+    return {}
+
+
+def ndvi_window(box: Tuple[int, int, int, int], size: Tuple[int, int], pattern: str = "patches",
+                seed: int = 0, ndvi_range: Tuple[float, float] = (0.2, 0.85), noise: float = NOISE) -> np.ndarray:
+    """
+    NDVI (float32, H x W) of the window box = (left, top, right, bottom) of a
+    field size = (width, height) pixels. The pattern is a function of field
+    coordinates; noise is seeded per window, so a fixed tiling reproduces
+    the same raster.
+    """
+    if pattern not in PATTERNS:
+        raise ValueError(f"Unknown pattern {pattern}; expected one of {', '.join(PATTERNS)}")
+    left, top, right, bottom = box
+    width, height = size
+    u = ((np.arange(left, right, dtype=np.float32) + 0.5) / width)[None, :]
+    v = ((np.arange(top, bottom, dtype=np.float32) + 0.5) / height)[:, None]
+    params = _pattern_params(pattern, seed)
+
+    if pattern == "patches":
+        a, b = params["waves"]
+        signal = 0.4 * np.sin(2 * math.pi * a * u) * np.cos(2 * math.pi * b * v)
+        for (cx, cy), radius, weight in zip(params["centres"], params["radii"], params["weights"]):
+            signal = signal + weight * np.exp(-((u - cx) ** 2 + (v - cy) ** 2) / (2 * radius ** 2))
+        vigor = 0.5 + 0.5 * np.tanh(signal + 0.5)
+    elif pattern == "gradient":
+        angle = params["angle"]
+        vigor = (u - 0.5) * math.cos(angle) + (v - 0.5) * math.sin(angle) + 0.5
+        vigor = np.clip(vigor, 0, 1)
+    elif pattern == "rows":
+        # Crop rows along x with bare soil between them, vigor fading across the field
+        rows = np.arange(top, bottom, dtype=np.float32)[:, None]
+        canopy = 0.5 + 0.5 * np.cos(2 * math.pi * rows / ROW_SPACING_PIXELS)
+        vigor = canopy * (0.6 + 0.4 * np.cos(math.pi * u)) ** 2
+    else:
+        vigor = np.full((1, 1), 0.7, dtype=np.float32)
+
+    low, high = ndvi_range
+    ndvi = np.broadcast_to(low + (high - low) * vigor, (bottom - top, right - left)).astype(np.float32)
+    if noise:
+        rng = np.random.default_rng((seed, top, left))
+        ndvi = ndvi + rng.normal(0, noise, ndvi.shape).astype(np.float32)
+    return np.clip(ndvi, -0.95, 0.95)
+
+
+def bands_from_ndvi(ndvi: np.ndarray, bands: int = 5, dtype=np.uint16, seed=0) -> np.ndarray:
+    """H x W x bands reflectances (R, G, B, NIR, Red Edge) whose NDVI is ndvi"""
+    rng = np.random.default_rng(seed)
+    brightness = (0.55 + rng.normal(0, 0.03, ndvi.shape)).astype(np.float32)
+    nir = brightness * (1 + ndvi) / 2
+    red = brightness * (1 - ndvi) / 2
+    vigor = np.clip(ndvi, 0, 1)
+    green = brightness * (0.18 + 0.2 * vigor)
+    blue = brightness * (0.2 - 0.1 * vigor)
+    channels = [red, green, blue]
+    if bands >= 4:
+        channels.append(nir)
+    if bands >= 5:
+        ndre = NDRE_RATIO * ndvi
+        channels.append(nir * (1 - ndre) / (1 + ndre))
+    scale = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.0
+    out = np.empty(ndvi.shape + (bands,), dtype=dtype)
+    for i, channel in enumerate(channels[:bands]):
+        out[..., i] = np.clip(channel * scale, 0, scale).astype(dtype)
+    return out
+
+
+def raster_window(box: Tuple[int, int, int, int], size: Tuple[int, int], bands: int = 5, dtype=np.uint16,
+                  pattern: str = "patches", seed: int = 0, **options) -> np.ndarray:
+    left, top, _, _ = box
+    ndvi = ndvi_window(box, size, pattern, seed, **options)
+    return bands_from_ndvi(ndvi, bands, dtype, seed=(seed, top, left, 1))
+
+
+def _tiles(width: int, height: int, bands: int, dtype, pattern: str, seed: int, tile: int,
+           **options) -> Iterator[np.ndarray]:
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            box = (left, top, min(left + tile, width), min(top + tile, height))
+            block = raster_window(box, (width, height), bands, dtype, pattern, seed, **options)
+            if block.shape[:2] != (tile, tile):
+                padded = np.zeros((tile, tile, bands), dtype=dtype)
+                padded[:block.shape[0], :block.shape[1]] = block
+                block = padded
+            yield block
+
+
+def write_raster(path, width: int, height: int, bands: int = 5, dtype=np.uint16, pattern: str = "patches",
+                 seed: int = 0, tile: int = TILE_SIZE, compression: Optional[str] = None, **options) -> Path:
+    """
+    Tiled TIFF written tile by tile (memory stays at one tile regardless of
+    size). Uncompressed by default, like drone software output.
+    """
+    if tifffile is None:
+        raise RuntimeError("Writing synthetic TIFFs requires tifffile")
+    path = Path(path)
+    dtype = np.dtype(dtype)
+    nbytes = width * height * bands * dtype.itemsize
+    tifffile.imwrite(
+        path, _tiles(width, height, bands, dtype, pattern, seed, tile, **options),
+        shape=(height, width, bands), dtype=dtype, tile=(tile, tile),
+        photometric="rgb" if bands == 3 else "minisblack", planarconfig="contig",
+        compression=compression, bigtiff=nbytes > 2 ** 31 - 2 ** 25, metadata=None,
+    )
+    return path
+
+
+def image(width: int, height: int, bands: int = 3, dtype=np.uint8, pattern: str = "patches",
+          seed: int = 0, **options) -> np.ndarray:
+    """Whole raster in memory (e.g. a 20-megapixel RGB frame)"""
+    return raster_window((0, 0, width, height), (width, height), bands, dtype, pattern, seed, **options)
+
+
+# ---------------------------------------------------------------------------
+# Planted pests
+# ---------------------------------------------------------------------------
+
+def plant_pests(pixels: np.ndarray, count: int, seed: int = 0, classes: Optional[List[str]] = None,
+                hotspots: int = 3, spread: float = 0.08, background: float = 0.2,
+                size_range: Tuple[int, int] = (12, 48)) -> List[Dict]:
+    """
+    Draw count elliptical pest-like objects into pixels (H x W x bands, in
+    place) and return their ground truth as detection records. Objects
+    cluster around hotspots (spread as a share of the image side); a
+    background share is scattered uniformly.
+    """
+    from app.ml_models.pest_detection import PEST_CLASSES, ZONES, _zone_ids
+
+    classes = classes or PEST_CLASSES
+    rng = np.random.default_rng(seed)
+    height, width = pixels.shape[:2]
+    centres = rng.uniform(0.1, 0.9, (hotspots, 2)) * (width, height)
+    clustered = rng.random(count) >= background
+    hotspot = rng.integers(0, hotspots, count)
+    cx = np.where(clustered, rng.normal(centres[hotspot, 0], spread * width), rng.uniform(0, width, count))
+    cy = np.where(clustered, rng.normal(centres[hotspot, 1], spread * height), rng.uniform(0, height, count))
+    w = rng.integers(size_range[0], size_range[1] + 1, count)
+    h = np.clip((w * rng.uniform(0.5, 1.0, count)).astype(int), 4, None)
+    x = np.clip(cx - w / 2, 0, width - w).astype(int)
+    y = np.clip(cy - h / 2, 0, height - h).astype(int)
+    class_ids = rng.integers(0, len(classes), count)
+    zone_ids = _zone_ids(x + w / 2, y + h / 2, width, height)
+
+    scale = np.iinfo(pixels.dtype).max / 255 if np.issubdtype(pixels.dtype, np.integer) else 1 / 255
+    records = []
+    for i in range(count):
+        xi, yi, wi, hi = int(x[i]), int(y[i]), int(w[i]), int(h[i])
+        dy, dx = np.ogrid[0:hi, 0:wi]
+        mask = ((dx + 0.5 - wi / 2) / (wi / 2)) ** 2 + ((dy + 0.5 - hi / 2) / (hi / 2)) ** 2 <= 1
+        color = np.array(PEST_COLORS[class_ids[i] % len(PEST_COLORS)], dtype=np.float32) * scale
+        window = pixels[yi:yi + hi, xi:xi + wi]
+        window[..., :3][mask] = color.astype(pixels.dtype)
+        if pixels.shape[2] > 3:
+            # Insects reflect little NIR compared with the leaves around them
+            window[..., 3:][mask] = window[..., 3:][mask] // 4
+        records.append({
+            "pest_type": classes[class_ids[i]],
+            "confidence": 1.0,
+            "bbox": {"x": xi, "y": yi, "width": wi, "height": hi},
+            "zone": ZONES[zone_ids[i]],
+        })
+    return records
+
+
+def frame(megapixels: float = 20.0, bands: int = 3, pests: int = 200, seed: int = 0, pattern: str = "patches",
+          hotspots: int = 3) -> Tuple[np.ndarray, List[Dict]]:
+    """A 3:2 camera frame (20 MP = 5472 x 3648) with planted pests: (pixels, ground truth)"""
+    height = int(round(math.sqrt(megapixels * 1e6 / 1.5) / 16)) * 16
+    width = height * 3 // 2
+    pixels = image(width, height, bands, np.uint8 if bands == 3 else np.uint16, pattern, seed)
+    return pixels, plant_pests(pixels, pests, seed=seed, hotspots=hotspots)
+
+
+# ---------------------------------------------------------------------------
+# Fields and database fixtures
+# ---------------------------------------------------------------------------
+
+def field_polygon(area_hectares: float, origin: Tuple[float, float] = (-93.0, 45.0),
+                  aspect: float = 1.0) -> Dict:
+    """Axis-aligned GeoJSON polygon of area_hectares (width / height = aspect) from its south-west corner"""
+    lon, lat = origin
+    height_m = math.sqrt(area_hectares * 10_000 / aspect)
+    width_m = height_m * aspect
+    east = lon + width_m / (METRES_PER_DEGREE * math.cos(math.radians(lat)))
+    north = lat + height_m / METRES_PER_DEGREE
+    ring = [[lon, lat], [east, lat], [east, north], [lon, north], [lon, lat]]
+    return {"type": "Polygon", "coordinates": [[[round(x, 7), round(y, 7)] for x, y in ring]]}
+
+
+def analysis_results(analysis_type: str, rng: np.random.Generator, detections: int = 0) -> Dict:
+    """results_json with exactly the keys the app.tasks runners store"""
+    if analysis_type == "pest_detection":
+        from app.ml_models.pest_detection import PEST_CLASSES, ZONES
+        from app.recommendations import pest_risk_level
+
+        classes = rng.integers(len(PEST_CLASSES), size=detections).tolist()
+        zones = rng.integers(len(ZONES), size=detections).tolist()
+        confidences = np.round(rng.uniform(0.7, 0.99, detections), 2).tolist()
+        xs, ys = rng.integers(0, 5000, detections).tolist(), rng.integers(0, 3500, detections).tolist()
+        sizes = rng.integers(10, 100, (detections, 2))
+        # Stored columnar, as the pest task writes it
+        pests = {
+            "pest_type": [PEST_CLASSES[i] for i in classes],
+            "confidence": confidences,
+            "x": xs,
+            "y": ys,
+            "width": sizes[:, 0].tolist(),
+            "height": sizes[:, 1].tolist(),
+            "zone": [ZONES[i] for i in zones],
+        }
+        return {"pests": pests, "pests_encoding": "columnar",
+                "affected_area_percentage": round(float(rng.uniform(0, 30)), 1),
+                "risk_level": pest_risk_level(detections)}
+    if analysis_type == "nutrient_mapping":
+        from app.recommendations import nutrient_recommendation
+
+        deficiencies = {"nitrogen": rng.integers(5, 36), "phosphorus": rng.integers(0, 21),
+                        "potassium": rng.integers(3, 26)}
+        results = {nutrient: {"percentage": int(value), "recommendation": nutrient_recommendation(nutrient, value)}
+                   for nutrient, value in deficiencies.items()}
+        health = 100 - (deficiencies["nitrogen"] * 0.4 + deficiencies["phosphorus"] * 0.3
+                        + deficiencies["potassium"] * 0.3)
+        results["overall_health_score"] = int(round(health))
+        results["vegetation_indices"] = {"ndvi": round(float(rng.uniform(0.3, 0.9)), 2),
+                                         "ndre": round(float(rng.uniform(0.2, 0.8)), 2),
+                                         "gndvi": round(float(rng.uniform(0.4, 0.85)), 2)}
+        return results
+    weeks = int(rng.integers(1, 5))
+    maturity = np.sort(rng.uniform(40, 100, weeks))
+    return {"predicted_yield_tons_per_hectare": round(float(rng.uniform(3, 12)), 1),
+            "confidence_score": 0.91,
+            "days_to_harvest": int(rng.integers(5, 120)),
+            "growth_stages": [{"week": week + 1, "maturity": int(round(value))} for week, value in enumerate(maturity)],
+            "estimated_revenue": int(rng.integers(80000, 150001))}
+
+
+def populate(engine, fields: int = 100, analyses: int = 1_000_000, seed: int = 0, batch_size: int = 20_000,
+             detections: Tuple[int, int] = (0, 20), days: int = 365) -> Dict[str, int]:
+    """
+    Insert fields (with polygons) and analyses spread over the last days,
+    in batched multi-row inserts. Returns row counts. Queued and processing
+    rows are older than admission.INFLIGHT_TIMEOUT, like work a lost worker
+    left behind, so they never count as live load.
+    """
+    from app import models
+    from app.admission import INFLIGHT_TIMEOUT
+
+    rng = np.random.default_rng(seed)
+    now = datetime.utcnow()
+    field_rows = [{
+        "id": f"synthetic-field-{seed}-{i}",
+        "field_name": f"Synthetic field {i}",
+        "crop_type": ("corn", "wheat", "soybean", "rice")[i % 4],
+        "area_hectares": float(area),
+        "location": field_polygon(float(area), origin=(-93.0 + 0.02 * (i % 50), 45.0 + 0.02 * (i // 50))),
+        "created_at": now - timedelta(days=days),
+        "updated_at": now,
+    } for i, area in enumerate(np.round(rng.uniform(5, 200, fields), 1))]
+    statuses = list(STATUS_WEIGHTS)
+    unfinished = [statuses.index("queued"), statuses.index("processing")]
+    stale_seconds = min(2 * INFLIGHT_TIMEOUT.total_seconds(), days * 86400)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(models.Field.__table__.insert(), field_rows)
+    inserted = 0
+    while inserted < analyses:
+        count = min(batch_size, analyses - inserted)
+        field_ids = rng.integers(0, fields, count)
+        types = rng.integers(0, len(ANALYSIS_TYPES), count)
+        status_ids = rng.choice(len(statuses), count, p=list(STATUS_WEIGHTS.values()))
+        ages = rng.uniform(0, days * 86400, count)
+        ages = np.where(np.isin(status_ids, unfinished), np.maximum(ages, stale_seconds), ages)
+        counts = rng.integers(detections[0], detections[1] + 1, count)
+        rows = []
+        for i in range(count):
+            analysis_type, status = ANALYSIS_TYPES[types[i]], statuses[status_ids[i]]
+            created = now - timedelta(seconds=float(ages[i]))
+            rows.append({
+                "id": f"synthetic-{seed}-{inserted + i}",
+                "field_id": field_rows[field_ids[i]]["id"],
+                "analysis_type": analysis_type,
+                "status": status,
+                "results_json": analysis_results(analysis_type, rng, int(counts[i])) if status == "completed" else None,
+                "confidence_score": round(float(rng.uniform(0.7, 0.99)), 2) if status == "completed" else None,
+                "created_at": created,
+                "updated_at": created,
+            })
+        with engine.begin() as conn:
+            conn.execute(models.Analysis.__table__.insert(), rows)
+        inserted += count
+        rate = inserted / (time.perf_counter() - started)
+        print(f"  {inserted:,}/{analyses:,} analyses ({rate:,.0f} rows/s)", end="\r", flush=True)
+    print()
+    return {"fields": fields, "analyses": inserted}
+
+
+# ---------------------------------------------------------------------------
+# Command line
+# ---------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.synthetic", description="Generate synthetic test data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    raster = commands.add_parser("raster", help="tiled multiband TIFF, streamed (any size)")
+    raster.add_argument("path")
+    raster.add_argument("--width", type=int, default=8192)
+    raster.add_argument("--height", type=int, default=8192)
+    raster.add_argument("--bands", type=int, default=5, choices=(3, 4, 5))
+    raster.add_argument("--dtype", default="uint16", choices=("uint8", "uint16"))
+
+    frames = commands.add_parser("image", help="RGB(+NIR) frame with planted pests and ground truth")
+    frames.add_argument("path")
+    frames.add_argument("--megapixels", type=float, default=20.0)
+    frames.add_argument("--bands", type=int, default=3, choices=(3, 4, 5))
+    frames.add_argument("--pests", type=int, default=200)
+    frames.add_argument("--hotspots", type=int, default=3)
+    frames.add_argument("--truth", help="write ground-truth detections (JSON) here")
+
+    fixtures = commands.add_parser("fixtures", help="bulk Field/Analysis rows in DATABASE_URL")
+    fixtures.add_argument("--fields", type=int, default=100)
+    fixtures.add_argument("--analyses", type=int, default=1_000_000)
+    fixtures.add_argument("--batch-size", type=int, default=20_000)
+
+    for command in (raster, frames):
+        command.add_argument("--pattern", default="patches", choices=PATTERNS)
+    for command in (raster, frames, fixtures):
+        command.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "raster":
+        path = write_raster(args.path, args.width, args.height, args.bands, np.dtype(args.dtype), args.pattern,
+                            args.seed)
+        print(f"✓ {path}: {args.width}x{args.height}x{args.bands} {args.dtype}, "
+              f"{path.stat().st_size / 1e6:.1f} MB in {time.perf_counter() - started:.1f}s")
+    elif args.command == "image":
+        pixels, truth = frame(args.megapixels, args.bands, args.pests, args.seed, args.pattern, args.hotspots)
+        height, width = pixels.shape[:2]
+        path = Path(args.path)
+        if args.bands == 3:
+            from PIL import Image
+            Image.fromarray(pixels).save(path, quality=92)
+        elif tifffile is not None:
+            tifffile.imwrite(path, pixels, photometric="minisblack", planarconfig="contig", metadata=None)
+        else:
+            raise SystemExit("Multiband frames are written as TIFF, which requires tifffile")
+        if args.truth:
+            Path(args.truth).write_text(json.dumps({"width": width, "height": height, "pests": truth}))
+        print(f"✓ {path}: {width}x{height}x{args.bands}, {len(truth)} planted pests "
+              f"in {time.perf_counter() - started:.1f}s")
+    else:
+        from app.database import engine, init_db
+
+        init_db()
+        counts = populate(engine, args.fields, args.analyses, args.seed, args.batch_size)
+        print(f"✓ {counts['fields']} fields and {counts['analyses']:,} analyses "
+              f"in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,112 @@
 from app.celery_worker import celery_app
 from app.database import SessionLocal
-from app.models import Analysis
+from app.models import Analysis, Field, Upload
 from app.config import settings
+from app import tiles, change_detection, forecasting, recommendations, reports, alerts, metrics, admission
+from app.progress import TaskProgress
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+import argparse
+import os
 import time
 import random
 import json
 from datetime import datetime
 
+def _on_analysis_completed(db, analysis: Analysis):
+    """Post-completion hooks; failures here must not fail the analysis itself"""
+    try:
+        if analysis.analysis_type == "pest_detection" and analysis.original_image_url:
+            tiles.build_pest_overlay(Path(analysis.original_image_url).stem, analysis.results_json["pests"])
+    except Exception as e:
+        print(f"Pest overlay failed for {analysis.id}: {e}")
+    change = None
+    try:
+        change = change_detection.record_analysis(db, analysis)
+    except Exception as e:
+        db.rollback()
+        print(f"Change detection failed for {analysis.id}: {e}")
+    try:
+        alerts.evaluate(db, analysis, change)
+    except Exception as e:
+        db.rollback()
+        print(f"Alert evaluation failed for {analysis.id}: {e}")
+    try:
+        forecasting.observe(db, analysis)
+        forecasting.forecast_fields(db, [analysis.field_id])
+    except Exception as e:
+        db.rollback()
+        print(f"Forecast update failed for {analysis.id}: {e}")
+    if analysis.field_id:
+        # Rendered off the task path; bursts of analyses for one field coalesce into one report
+        reports.schedule(analysis.field_id)
+
+# Simulated inference: total duration and how it splits across stages
+SIMULATED_SECONDS = 5.0
+INFERENCE_BATCHES = 20
+STAGES = (("loading", 0.1), ("inference", 0.8), ("postprocessing", 0.1))
+
+def _run_stages(task: TaskProgress):
+    """Work through the stages batch by batch, reporting (and checking for cancellation) at each boundary"""
+    done = 0.0
+    for stage, share in STAGES:
+        batches = INFERENCE_BATCHES if stage == "inference" else 1
+        for batch in range(batches):
+            task.report(stage, done + share * batch / batches)
+            time.sleep(SIMULATED_SECONDS * share / batches)
+        done += share
+    task.report("storing", done)
+
+def _complete(db, analysis: Analysis, result: dict):
+    analysis.results_json = result
+    analysis.status = "completed"
+    analysis.stage = None
+    analysis.progress = 1.0
+    db.commit()
+    _on_analysis_completed(db, analysis)
+
 # Synchronous task execution functions
 def _process_pest_detection_sync(analysis_id: str):
     """Synchronous version of pest detection task"""
+    # Imported here so importing app.tasks (app.main does) doesn't load numpy
+    import numpy as np
+    from app.detections import Detections
+
     db = SessionLocal()
     try:
-        # Simulate processing
-        time.sleep(5)
-        
-        # Mock Results
-        num_detections = random.randint(1, 15)
-        pests = ["Aphid", "Whitefly", "Caterpillar", "Beetle", "Mite"]
-        detections = []
-        for _ in range(num_detections):
-            detections.append({
-                "pest_type": random.choice(pests),
-                "confidence": round(random.uniform(0.7, 0.99), 2),
-                "bbox": {
-                    "x": random.randint(50, 400),
-                    "y": random.randint(50, 400),
-                    "width": random.randint(30, 100),
-                    "height": random.randint(30, 100)
-                },
-                "zone": random.choice(["Zone A", "Zone B", "Zone C"])
-            })
-            
-        result = {
-            "pests": detections,
-            "affected_area_percentage": round(random.uniform(5, 30), 1),
-            "risk_level": "HIGH" if len(detections) > 10 else "MEDIUM" if len(detections) > 5 else "LOW"
-        }
-        
-        # Update DB
-        analysis = db.query(Analysis).filter(Analysis.id == analysis_id).first()
-        if analysis:
-            analysis.results_json = result
-            analysis.status = "completed"
-            analysis.processing_time_seconds = 5.0
-            db.commit()
-            
+        with TaskProgress(db, analysis_id, expected_seconds=SIMULATED_SECONDS) as task:
+            task.start()
+            _run_stages(task)
+
+            # Mock Results
+            num_detections = random.randint(1, 15)
+            pests = ["Aphid", "Whitefly", "Caterpillar", "Beetle", "Mite"]
+            zones = ["Zone A", "Zone B", "Zone C"]
+            detections = Detections.from_arrays(
+                np.random.randint(0, len(pests), num_detections),
+                np.round(np.random.uniform(0.7, 0.99, num_detections), 2),
+                np.column_stack([
+                    np.random.randint(50, 401, size=(num_detections, 2)),
+                    np.random.randint(30, 101, size=(num_detections, 2))
+                ]),
+                np.random.randint(0, len(zones), num_detections),
+                pests, zones
+            )
+
+            result = {
+                # Stored columnar; app.serialization expands it to one dict per detection for responses
+                "pests": detections.to_columnar(),
+                "pests_encoding": "columnar",
+                "affected_area_percentage": round(random.uniform(5, 30), 1),
+                "risk_level": detections.risk_level()
+            }
+
+            # Update DB
+            analysis = db.query(Analysis).filter(Analysis.id == analysis_id).first()
+            if analysis:
+                analysis.processing_time_seconds = SIMULATED_SECONDS
+                _complete(db, analysis, result)
     finally:
         db.close()
 
@@ -53,19 +114,29 @@ def _process_nutrient_analysis_sync(analysis_id: str):
     """Synchronous version of nutrient analysis task"""
     db = SessionLocal()
     try:
-        time.sleep(5)
-        result = {
-            "nitrogen": {"percentage": random.randint(10, 30), "recommendation": "120 kg/ha"},
-            "phosphorus": {"percentage": random.randint(0, 10), "recommendation": "40 kg/ha"},
-            "potassium": {"percentage": random.randint(5, 15), "recommendation": "25 kg/ha"},
-            "overall_health_score": random.randint(60, 95)
-        }
-        
-        analysis = db.query(Analysis).filter(Analysis.id == analysis_id).first()
-        if analysis:
-            analysis.results_json = result
-            analysis.status = "completed"
-            db.commit()
+        with TaskProgress(db, analysis_id, expected_seconds=SIMULATED_SECONDS) as task:
+            task.start()
+            _run_stages(task)
+            deficiencies = {
+                "nitrogen": random.randint(10, 30),
+                "phosphorus": random.randint(0, 10),
+                "potassium": random.randint(5, 15)
+            }
+            result = {
+                nutrient: {"percentage": value, "recommendation": recommendations.nutrient_recommendation(nutrient, value)}
+                for nutrient, value in deficiencies.items()
+            }
+            result["overall_health_score"] = random.randint(60, 95)
+            # Same keys as ml_models.nutrient_analysis; forecasting.observe reads the NDVI
+            result["vegetation_indices"] = {
+                "ndvi": round(random.uniform(0.3, 0.9), 2),
+                "ndre": round(random.uniform(0.2, 0.8), 2),
+                "gndvi": round(random.uniform(0.4, 0.85), 2)
+            }
+
+            analysis = db.query(Analysis).filter(Analysis.id == analysis_id).first()
+            if analysis:
+                _complete(db, analysis, result)
     finally:
         db.close()
 
@@ -73,48 +144,123 @@ def _process_yield_prediction_sync(analysis_id: str):
     """Synchronous version of yield prediction task"""
     db = SessionLocal()
     try:
-        time.sleep(5)
-        result = {
-            "predicted_yield_tons_per_hectare": round(random.uniform(3.5, 8.0), 1),
-            "confidence_score": 0.91,
-            "days_to_harvest": 28,
-            "growth_stages": [
-                {"week": 1, "maturity": 45},
-                {"week": 2, "maturity": 68},
-                {"week": 3, "maturity": 85},
-                {"week": 4, "maturity": 98}
-            ],
-            "estimated_revenue": random.randint(80000, 150000)
-        }
-        
-        analysis = db.query(Analysis).filter(Analysis.id == analysis_id).first()
-        if analysis:
-            analysis.results_json = result
-            analysis.status = "completed"
-            db.commit()
+        with TaskProgress(db, analysis_id, expected_seconds=SIMULATED_SECONDS) as task:
+            task.start()
+            _run_stages(task)
+            result = {
+                "predicted_yield_tons_per_hectare": round(random.uniform(3.5, 8.0), 1),
+                "confidence_score": 0.91,
+                "days_to_harvest": 28,
+                "growth_stages": [
+                    {"week": 1, "maturity": 45},
+                    {"week": 2, "maturity": 68},
+                    {"week": 3, "maturity": 85},
+                    {"week": 4, "maturity": 98}
+                ],
+                "estimated_revenue": random.randint(80000, 150000)
+            }
+
+            analysis = db.query(Analysis).filter(Analysis.id == analysis_id).first()
+            if analysis:
+                field = db.query(Field).filter(Field.id == analysis.field_id).first()
+                if field is not None:
+                    # Real planting date instead of a canned growth curve
+                    result.update(forecasting.growth_schedule(field.planting_date, field.crop_type))
+                _complete(db, analysis, result)
     finally:
         db.close()
 
+def _run(function, analysis_id: str, processing_mode: Optional[str]):
+    """Analyses of "tiled" uploads (app.image_probe) share the one-at-a-time large-image lane with tile builds"""
+    # Load shedding counts this process's queue (app.admission)
+    admission.local_queue.started(analysis_id)
+    try:
+        if processing_mode == "tiled":
+            with tiles.large_image_lane:
+                metrics.incr("tasks", "large_image_runs")
+                return function(analysis_id)
+        return function(analysis_id)
+    finally:
+        admission.local_queue.finished(analysis_id)
+
 # Celery task decorators (only if Celery is enabled)
 if celery_app:
     @celery_app.task
-    def process_pest_detection(analysis_id: str):
-        return _process_pest_detection_sync(analysis_id)
+    def process_pest_detection(analysis_id: str, processing_mode: Optional[str] = None):
+        return _run(_process_pest_detection_sync, analysis_id, processing_mode)
 
     @celery_app.task
-    def process_nutrient_analysis(analysis_id: str):
-        return _process_nutrient_analysis_sync(analysis_id)
+    def process_nutrient_analysis(analysis_id: str, processing_mode: Optional[str] = None):
+        return _run(_process_nutrient_analysis_sync, analysis_id, processing_mode)
 
     @celery_app.task
-    def process_yield_prediction(analysis_id: str):
-        return _process_yield_prediction_sync(analysis_id)
+    def process_yield_prediction(analysis_id: str, processing_mode: Optional[str] = None):
+        return _run(_process_yield_prediction_sync, analysis_id, processing_mode)
 else:
     # Fallback to synchronous execution
-    def process_pest_detection(analysis_id: str):
-        return _process_pest_detection_sync(analysis_id)
+    def process_pest_detection(analysis_id: str, processing_mode: Optional[str] = None):
+        return _run(_process_pest_detection_sync, analysis_id, processing_mode)
     
-    def process_nutrient_analysis(analysis_id: str):
-        return _process_nutrient_analysis_sync(analysis_id)
+    def process_nutrient_analysis(analysis_id: str, processing_mode: Optional[str] = None):
+        return _run(_process_nutrient_analysis_sync, analysis_id, processing_mode)
     
-    def process_yield_prediction(analysis_id: str):
-        return _process_yield_prediction_sync(analysis_id)
+    def process_yield_prediction(analysis_id: str, processing_mode: Optional[str] = None):
+        return _run(_process_yield_prediction_sync, analysis_id, processing_mode)
+
+RUNNERS = {
+    "pest_detection": process_pest_detection,
+    "nutrient_mapping": process_nutrient_analysis,
+    "yield_prediction": process_yield_prediction,
+}
+_RUN_SYNC = {
+    "pest_detection": _process_pest_detection_sync,
+    "nutrient_mapping": _process_nutrient_analysis_sync,
+    "yield_prediction": _process_yield_prediction_sync,
+}
+
+def dispatch(analysis_id: str, analysis_type: str, processing_mode: Optional[str] = None) -> bool:
+    """Hand a queued analysis to Celery; without a broker it stays queued for run_queued()"""
+    if not settings.USE_CELERY:
+        return False
+    RUNNERS[analysis_type].delay(analysis_id, processing_mode)
+    return True
+
+def run_queued(workers: int, field_id: Optional[str] = None) -> int:
+    """Run analyses still queued (bulk ingestion without Celery); returns how many were picked up"""
+    db = SessionLocal()
+    try:
+        query = db.query(Analysis.id, Analysis.analysis_type, Analysis.original_image_url).filter(
+            Analysis.status == "queued", Analysis.analysis_type.in_(list(_RUN_SYNC))
+        )
+        if field_id:
+            query = query.filter(Analysis.field_id == field_id)
+        rows = query.order_by(Analysis.created_at).all()
+        upload_ids = {Path(row.original_image_url).stem for row in rows if row.original_image_url}
+        modes = dict(db.query(Upload.id, Upload.processing_mode).filter(Upload.id.in_(upload_ids)))
+    finally:
+        db.close()
+
+    def run(row):
+        mode = modes.get(Path(row.original_image_url).stem) if row.original_image_url else None
+        return _run(_RUN_SYNC[row.analysis_type], row.id, mode)
+
+    # Each task claims its row on start, so an analysis picked up elsewhere meanwhile is skipped
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run, rows))
+    return len(rows)
+
+def main():
+    from app.database import init_db
+
+    parser = argparse.ArgumentParser(prog="python -m app.tasks", description="Run queued analyses in this process")
+    parser.add_argument("--field-id", default=None, help="only this field's analyses")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    args = parser.parse_args()
+
+    init_db()
+    started = time.perf_counter()
+    count = run_queued(args.workers, args.field_id)
+    print(f"✓ Ran {count} queued analyses in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
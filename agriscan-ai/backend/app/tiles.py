@@ -0,0 +1,382 @@
+"""
+Multi-resolution tile pyramids for uploaded imagery and analysis overlays.
+
+Each upload gets one MBTiles-style SQLite file (storage key tiles/<id>.mbtiles)
+holding 256px PNG tiles for every zoom level of every layer:
+  - image: the upload itself
+  - ndvi:  vegetation index overlay (true NDVI when a NIR band is present,
+           otherwise the visible-band VARI proxy)
+  - pest:  detection heatmap, written when a pest analysis completes
+
+Zoom max_zoom is full resolution; each lower level halves the image until it
+fits in a single tile. Hot tiles are kept in an in-memory LRU (TileCache).
+
+numpy (and app.detections) are only needed to render overlays, so they are
+imported there rather than at module import (app.main imports this module).
+"""
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from app import image_probe, metrics, storage
+from app.config import settings
+
+if TYPE_CHECKING:
+    from app.detections import Detections
+
+TILE_SIZE = 256
+LAYERS = ("image", "ndvi", "pest")
+
+# Images too large to decode whole are built (and analysed, app.tasks) one at a time per process
+large_image_lane = threading.Semaphore(1)
+
+
+def pyramid_key(upload_id: str) -> str:
+    return f"tiles/{upload_id}.mbtiles"
+
+
+def pyramid_path(upload_id: str) -> Optional[Path]:
+    """Local copy of the pyramid (the file itself, or a cached download)"""
+    return storage.get_storage().local_path(pyramid_key(upload_id))
+
+
+def max_zoom_for(width: int, height: int) -> int:
+    return max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE)))
+
+
+# ---------------------------------------------------------------------------
+# Overlay rendering
+# ---------------------------------------------------------------------------
+
+def _colorize(index, valid) -> Image.Image:
+    """Map an index in [-1, 1] onto a red -> yellow -> green ramp"""
+    import numpy as np
+    t = np.clip((index + 1.0) / 2.0, 0.0, 1.0)
+    rgba = np.zeros(index.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = (255 * np.clip(2.0 - 2.0 * t, 0, 1)).astype(np.uint8)
+    rgba[..., 1] = (255 * np.clip(2.0 * t, 0, 1)).astype(np.uint8)
+    rgba[..., 3] = np.where(valid, 180, 0).astype(np.uint8)
+    return Image.fromarray(rgba, "RGBA")
+
+
+def vegetation_index(image: Image.Image):
+    """
+    Per-pixel vegetation index in [-1, 1] and a validity mask.
+    True NDVI when band 4 is NIR, otherwise the visible-band VARI proxy.
+    """
+    import numpy as np
+    bands = image.getbands()
+    if len(bands) >= 4 and image.mode != "RGBA":
+        pixels = np.asarray(image, dtype=np.float32)
+        red, nir = pixels[..., 0], pixels[..., 3]
+        denominator = nir + red
+        index = (nir - red) / np.where(denominator == 0, 1e-6, denominator)
+        valid = denominator > 0
+    else:
+        pixels = np.asarray(image.convert("RGB"), dtype=np.float32)
+        red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+        denominator = green + red - blue
+        index = (green - red) / np.where(denominator == 0, 1e-6, denominator)
+        valid = (green + red + blue) > 0
+    return np.clip(index, -1, 1), valid
+
+
+def render_ndvi(image: Image.Image) -> Image.Image:
+    """NDVI overlay; uses band 4 as NIR for multispectral images"""
+    return _colorize(*vegetation_index(image))
+
+
+def render_pest_heatmap(size: Tuple[int, int], detections: "Detections") -> Image.Image:
+    """Accumulate detection boxes (weighted by confidence) into a heatmap overlay"""
+    import numpy as np
+    width, height = size
+    # Accumulate at <= 1024px and let the pyramid scale it; heatmaps are smooth
+    scale = min(1.0, 1024 / max(width, height))
+    grid_w, grid_h = max(1, int(width * scale)), max(1, int(height * scale))
+    heat = detections.paint((grid_h, grid_w), scale, scale)
+
+    peak = heat.max()
+    if peak > 0:
+        heat /= peak
+    rgba = np.zeros((grid_h, grid_w, 4), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = (160 * (1 - heat)).astype(np.uint8)
+    rgba[..., 3] = (200 * heat).astype(np.uint8)
+    return Image.fromarray(rgba, "RGBA").resize(size, Image.BILINEAR)
+
+
+# ---------------------------------------------------------------------------
+# Pyramid building
+# ---------------------------------------------------------------------------
+
+def _encode_png(tile: Image.Image) -> bytes:
+    buffer = BytesIO()
+    tile.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def _iter_level_tiles(level: Image.Image):
+    width, height = level.size
+    for tx in range(math.ceil(width / TILE_SIZE)):
+        for ty in range(math.ceil(height / TILE_SIZE)):
+            box = (tx * TILE_SIZE, ty * TILE_SIZE,
+                   min((tx + 1) * TILE_SIZE, width), min((ty + 1) * TILE_SIZE, height))
+            tile = level.crop(box)
+            if tile.size != (TILE_SIZE, TILE_SIZE):
+                # Pad edge tiles with transparency so every tile is 256x256
+                padded = Image.new("RGBA", (TILE_SIZE, TILE_SIZE))
+                padded.paste(tile, (0, 0))
+                tile = padded
+            yield tx, ty, tile
+
+
+def _open_store(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tiles ("
+        " layer TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,"
+        " PRIMARY KEY (layer, zoom_level, tile_column, tile_row))"
+    )
+    return conn
+
+
+def _write_layer(conn: sqlite3.Connection, upload_id: str, layer: str, image: Image.Image, max_zoom: int):
+    conn.execute("DELETE FROM tiles WHERE layer = ?", (layer,))
+    level = image if image.mode in ("RGB", "RGBA") else image.convert("RGBA")
+    for z in range(max_zoom, -1, -1):
+        conn.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?, ?, ?)",
+            ((layer, z, tx, ty, _encode_png(tile)) for tx, ty, tile in _iter_level_tiles(level))
+        )
+        if z > 0:
+            level = level.reduce(2) if min(level.size) >= 2 else level
+    tile_cache.invalidate(upload_id, layer)
+
+
+def _open_reduced(path: Path) -> Image.Image:
+    """
+    Open a large image at the coarsest decode scale that fits IN_MEMORY_MAX_BYTES.
+    JPEGs decode at reduced scale and TIFFs are read every n-th pixel through
+    their tiles or strips (rasters.read_tiff); image_probe refuses other formats
+    this large, so anything else here is decoded whole.
+    The original size is kept in image.info["source_size"].
+    """
+    if path.suffix.lower() in (".tif", ".tiff"):
+        from app import rasters
+        region = rasters.read_tiff(path, max_bytes=settings.IN_MEMORY_MAX_BYTES)
+        if region is not None:
+            import numpy as np
+            pixels, scale = region
+            try:
+                image = Image.fromarray(np.ascontiguousarray(pixels))
+            except (TypeError, ValueError):
+                image = None  # no PIL mode for these bands
+            if image is not None:
+                if scale != 1.0:
+                    info = image_probe.probe(path)
+                    image.info["source_size"] = (info.width, info.height)
+                return image
+    image = image_probe.open_validated(path)
+    if image.format == "JPEG":
+        width, height = image.size
+        bands = len(image.getbands())
+        factor = math.sqrt(width * height * bands / settings.IN_MEMORY_MAX_BYTES)
+        if factor > 1:
+            image.info["source_size"] = (width, height)
+            image.draft(image.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+    return image
+
+
+def build_pyramid(upload_id: str, file_path: Optional[str] = None, processing_mode: str = "in_memory"):
+    """
+    Build the image and NDVI layers for an upload (run as a background task).
+    processing_mode "tiled" (set by image_probe at upload time) routes large
+    images through a one-at-a-time lane with reduced-scale decoding.
+    """
+    if processing_mode == "tiled":
+        with large_image_lane:
+            metrics.incr("tiles", "large_image_builds")
+            return _build_pyramid(upload_id, file_path, reduced=True)
+    return _build_pyramid(upload_id, file_path, reduced=False)
+
+
+def _build_pyramid(upload_id: str, file_path: Optional[str], reduced: bool):
+    path = Path(file_path) if file_path else storage.upload_path(upload_id)
+    if path is None or not path.exists():
+        print(f"Tile build skipped, upload {upload_id} not found")
+        return
+
+    try:
+        image = _open_reduced(path) if reduced else image_probe.open_validated(path)
+        source_width, source_height = image.info.get("source_size", image.size)
+        image.load()
+    except Exception as e:
+        print(f"Tile build failed for {upload_id}: {e}")
+        return
+
+    partial = storage.staging_dir() / f"{upload_id}.mbtiles.part"
+    partial.unlink(missing_ok=True)
+
+    width, height = image.size
+    max_zoom = max_zoom_for(width, height)
+    conn = _open_store(partial)
+    try:
+        conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", [
+            ("upload_id", upload_id),
+            ("width", str(width)),
+            ("height", str(height)),
+            ("source_width", str(source_width)),
+            ("source_height", str(source_height)),
+            ("max_zoom", str(max_zoom)),
+            ("tile_size", str(TILE_SIZE)),
+            ("format", "png"),
+        ])
+        _write_layer(conn, upload_id, "image", image, max_zoom)
+        _write_layer(conn, upload_id, "ndvi", render_ndvi(image), max_zoom)
+        conn.commit()
+    finally:
+        conn.close()
+    # Publish atomically so readers never see a half-built pyramid
+    storage.get_storage().put_file(pyramid_key(upload_id), partial)
+    metrics.incr("tiles", "pyramids_built")
+
+
+def build_pest_overlay(upload_id: str, detections: Union["Detections", List[Dict]]):
+    """(Re)write the pest heatmap layer of an existing pyramid"""
+    from app.detections import Detections
+    detections = Detections.coerce(detections)
+    target = pyramid_path(upload_id)
+    if target is None:
+        build_pyramid(upload_id)
+        target = pyramid_path(upload_id)
+    if target is None:
+        return
+
+    conn = _open_store(target)
+    try:
+        info = _read_metadata(conn)
+        size = (int(info["width"]), int(info["height"]))
+        # Detections are in source pixels; large images may be tiled at reduced scale
+        scale = size[0] / int(info.get("source_width", size[0]))
+        if scale != 1:
+            detections = detections.scaled(scale)
+        _write_layer(conn, upload_id, "pest", render_pest_heatmap(size, detections), int(info["max_zoom"]))
+        conn.commit()
+    finally:
+        conn.close()
+    storage.get_storage().put_file(pyramid_key(upload_id), target)
+    metrics.incr("tiles", "pest_overlays_built")
+
+
+# ---------------------------------------------------------------------------
+# Serving
+# ---------------------------------------------------------------------------
+
+class TileCache:
+    """
+    LRU of encoded tiles, bounded by total bytes. Keys carry the pyramid
+    file's version (get_tile), so a layer rebuilt by another worker is never
+    served from this one's cache; invalidate() only frees the memory early.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._tiles: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            data = self._tiles.get(key)
+            if data is None:
+                metrics.incr("tiles", "cache_misses")
+                return None
+            self._tiles.move_to_end(key)
+            metrics.incr("tiles", "cache_hits")
+            return data
+
+    def put(self, key: tuple, data: bytes):
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._tiles[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= len(evicted)
+                metrics.incr("tiles", "cache_evictions")
+            metrics.set_gauge("tiles", "cache_bytes", self._bytes)
+
+    def invalidate(self, upload_id: str, layer: str):
+        with self._lock:
+            for key in [k for k in self._tiles if k[0] == upload_id and k[1] == layer]:
+                self._bytes -= len(self._tiles.pop(key))
+            metrics.set_gauge("tiles", "cache_bytes", self._bytes)
+
+
+tile_cache = TileCache(settings.TILE_CACHE_MAX_BYTES)
+
+
+def _read_metadata(conn: sqlite3.Connection) -> Dict[str, str]:
+    return dict(conn.execute("SELECT name, value FROM metadata").fetchall())
+
+
+def get_pyramid_info(upload_id: str) -> Optional[Dict]:
+    path = pyramid_path(upload_id)
+    if path is None:
+        return None
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        info = _read_metadata(conn)
+        layers = [row[0] for row in conn.execute("SELECT DISTINCT layer FROM tiles")]
+    finally:
+        conn.close()
+    return {
+        "upload_id": upload_id,
+        "width": int(info["width"]),
+        "height": int(info["height"]),
+        # Pyramids of large images may be built at reduced scale
+        "source_width": int(info.get("source_width", info["width"])),
+        "source_height": int(info.get("source_height", info["height"])),
+        "min_zoom": 0,
+        "max_zoom": int(info["max_zoom"]),
+        "tile_size": int(info["tile_size"]),
+        "layers": layers,
+        "tiles": f"/tiles/{upload_id}/{{z}}/{{x}}/{{y}}.png",
+    }
+
+
+def get_tile(upload_id: str, layer: str, z: int, x: int, y: int) -> Optional[bytes]:
+    path = pyramid_path(upload_id)
+    if path is None:
+        return None
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    # Rebuilds replace the file (or rewrite it in place), changing its mtime
+    key = (upload_id, layer, stat.st_mtime_ns, stat.st_ino, z, x, y)
+    data = tile_cache.get(key)
+    if data is not None:
+        return data
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = conn.execute(
+            "SELECT tile_data FROM tiles WHERE layer = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (layer, z, x, y)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    tile_cache.put(key, row[0])
+    return row[0]
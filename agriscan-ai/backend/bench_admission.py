@@ -0,0 +1,98 @@
+"""
+Overload test for admission control.
+
+Runs against a live server: one misbehaving client floods analysis submissions
+with many concurrent connections while a few well-behaved clients submit at a
+modest rate. Reports status codes and latency percentiles per client class.
+With admission control on, the flood is answered with fast 429/503s and the
+well-behaved clients' latency stays bounded; run the server with
+ADMISSION_ENABLED=false to compare.
+
+Usage:
+  uvicorn app.main:app --port 8000 &
+  python bench_admission.py --url http://localhost:8000 --duration 20
+  python bench_admission.py --flood-concurrency 200 --polite-clients 5
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+
+import httpx
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+async def submit(client, api_key, results):
+    started = time.perf_counter()
+    try:
+        response = await client.post(
+            "/api/analysis/pest-detection",
+            json={"field_id": "bench-field", "image_id": "bench-image"},
+            headers={"X-API-Key": api_key}
+        )
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    results.append((status, time.perf_counter() - started))
+
+
+async def flood_worker(client, deadline, results):
+    while time.perf_counter() < deadline:
+        await submit(client, "flood", results)
+
+
+async def polite_worker(client, index, deadline, interval, results):
+    while time.perf_counter() < deadline:
+        await submit(client, f"polite-{index}", results)
+        await asyncio.sleep(interval)
+
+
+def report(name, results, duration):
+    statuses = Counter(status for status, _ in results)
+    latencies = [latency * 1000 for _, latency in results]
+    accepted = [latency * 1000 for status, latency in results if status == 200]
+    print(f"\n{name}: {len(results)} requests ({len(results) / duration:.0f}/s)")
+    print("  status: " + ", ".join(f"{status}={count}" for status, count in sorted(statuses.items(), key=str)))
+    print(f"  all      p50 {percentile(latencies, 50):8.1f} ms  p99 {percentile(latencies, 99):8.1f} ms  "
+          f"max {max(latencies, default=float('nan')):8.1f} ms")
+    if accepted:
+        print(f"  accepted p50 {percentile(accepted, 50):8.1f} ms  p99 {percentile(accepted, 99):8.1f} ms  "
+              f"mean {statistics.mean(accepted):8.1f} ms")
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.flood_concurrency + args.polite_clients)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        deadline = time.perf_counter() + args.duration
+        flood, polite = [], []
+        await asyncio.gather(
+            *[flood_worker(client, deadline, flood) for _ in range(args.flood_concurrency)],
+            *[polite_worker(client, i, deadline, args.polite_interval, polite) for i in range(args.polite_clients)]
+        )
+    print("=" * 72)
+    print(f"Admission overload test: {args.duration}s against {args.url}")
+    print("=" * 72)
+    report("Flooding client", flood, args.duration)
+    report("Well-behaved clients", polite, args.duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overload the analysis endpoint and measure tail latency")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--flood-concurrency", type=int, default=100)
+    parser.add_argument("--polite-clients", type=int, default=5)
+    parser.add_argument("--polite-interval", type=float, default=1.0, help="seconds between polite submissions")
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
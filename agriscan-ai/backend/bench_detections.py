@@ -0,0 +1,107 @@
+"""
+Detection representation benchmark.
+
+Runs the worker's hot path (build results, filter by confidence, count per
+zone, risk level, paint the density grid) for 10k / 100k / 1M detections,
+once with a dict per detection and once with app.detections.Detections, and
+reports time, peak traced memory and garbage collections triggered.
+
+Usage:
+  python bench_detections.py
+  python bench_detections.py --sizes 10000,100000 --repeat 5
+"""
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.detections import Detections
+
+CLASSES = ["Aphid", "Whitefly", "Caterpillar", "Beetle", "Mite"]
+ZONES = ["Zone A", "Zone B", "Zone C", "Zone D"]
+GRID = 64
+FRAME = 5000
+
+
+def raw_output(size: int):
+    rng = np.random.default_rng(0)
+    return (rng.integers(0, len(CLASSES), size), np.round(rng.uniform(0.5, 0.99, size), 2).astype(np.float32),
+            np.column_stack([rng.integers(0, FRAME, (size, 2)), rng.integers(10, 100, (size, 2))]),
+            rng.integers(0, len(ZONES), size))
+
+
+def dict_path(output, threshold: float):
+    class_ids, confidences, boxes, zone_ids = output
+    detections = [{
+        "pest_type": CLASSES[c], "confidence": round(float(p), 2),
+        "bbox": {"x": int(b[0]), "y": int(b[1]), "width": int(b[2]), "height": int(b[3])},
+        "zone": ZONES[z],
+    } for c, p, b, z in zip(class_ids, confidences, boxes, zone_ids)]
+    kept = [d for d in detections if d["confidence"] >= threshold]
+    counts = {}
+    for d in kept:
+        counts[d["zone"]] = counts.get(d["zone"], 0) + 1
+    grid = np.zeros((GRID, GRID), dtype=np.float32)
+    scale = GRID / FRAME
+    for d in kept:
+        bbox = d["bbox"]
+        x0, y0 = int(bbox["x"] * scale), int(bbox["y"] * scale)
+        x1 = max(x0 + 1, int((bbox["x"] + bbox["width"]) * scale))
+        y1 = max(y0 + 1, int((bbox["y"] + bbox["height"]) * scale))
+        grid[y0:y1, x0:x1] += d["confidence"]
+    return len(kept), counts
+
+
+def array_path(output, threshold: float):
+    detections = Detections.from_arrays(*output, CLASSES, ZONES).filter(threshold)
+    detections.risk_level()
+    detections.paint((GRID, GRID), GRID / FRAME, GRID / FRAME)
+    return len(detections), detections.counts_by_zone()
+
+
+def measure(fn, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        collections = sum(stat["collections"] for stat in gc.get_stats())
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+        collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best * 1000, peak, collections, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dict vs array-backed detections")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--threshold", type=float, default=0.75)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("=" * 72)
+    print(f"Detection hot path (best of {args.repeat}, confidence >= {args.threshold})")
+    print("=" * 72)
+    print(f"{'detections':>10} {'representation':<16} {'ms':>9} {'peak MB':>9} {'gc runs':>8} {'kept':>9}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        output = raw_output(size)
+        results = []
+        for name, path in (("dicts", dict_path), ("Detections", array_path)):
+            ms, peak, collections, result = measure(lambda: path(output, args.threshold), args.repeat)
+            results.append(result)
+            print(f"{size:>10} {name:<16} {ms:>9.1f} {peak / 1e6:>9.1f} {collections:>8} {result[0]:>9,}")
+        if results[0] != results[1]:
+            print(f"{'':>10} WARNING: results differ")
+
+
+if __name__ == "__main__":
+    main()
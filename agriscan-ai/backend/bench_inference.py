@@ -0,0 +1,165 @@
+"""
+Accuracy vs latency benchmark for inference backends.
+
+Runs the pest and yield models over a fixed local image set once per
+precision variant (fp32 / fp16 / int8), plus the mock backend the app falls
+back to without model files (INFERENCE_BACKEND=mock) as the baseline, and
+reports latency, images/second per core, and agreement with the fp32 results
+(detection F1 at IoU 0.5, mean absolute yield error; "-" without fp32).
+
+Usage:
+  python bench_inference.py --images ../sample-images --threads 1
+  python bench_inference.py --precisions mock,fp32,int8 --repeat 3
+  python bench_inference.py --synthetic 8 --megapixels 20   # generated frames (app.synthetic)
+"""
+import argparse
+import io
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app import synthetic
+from app.config import settings
+from app.ml_models import backends, pest_detection, yield_prediction
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".tif", ".tiff"}
+
+
+def load_images(directory: Path):
+    paths = sorted(p for p in directory.rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES)
+    return [(p.name, p.read_bytes()) for p in paths]
+
+
+def synthetic_images(count: int, megapixels: float):
+    """JPEG frames with planted pests, the same for every run"""
+    from PIL import Image
+
+    images = []
+    for seed in range(count):
+        pixels, _ = synthetic.frame(megapixels, seed=seed, pattern=synthetic.PATTERNS[seed % 3])
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, "JPEG", quality=92)
+        images.append((f"synthetic-{seed}.jpg", buffer.getvalue()))
+    return images
+
+
+def _iou(a, b):
+    ax2, ay2 = a["x"] + a["width"], a["y"] + a["height"]
+    bx2, by2 = b["x"] + b["width"], b["y"] + b["height"]
+    iw = max(0, min(ax2, bx2) - max(a["x"], b["x"]))
+    ih = max(0, min(ay2, by2) - max(a["y"], b["y"]))
+    intersection = iw * ih
+    union = a["width"] * a["height"] + b["width"] * b["height"] - intersection
+    return intersection / union if union else 0.0
+
+
+def detection_f1(reference, candidate, iou_threshold=0.5):
+    """F1 of candidate detections against the reference run (same class, IoU >= threshold)"""
+    if not reference and not candidate:
+        return 1.0
+    matched = set()
+    true_positives = 0
+    for detection in candidate:
+        for i, ref in enumerate(reference):
+            if i in matched or ref["pest_type"] != detection["pest_type"]:
+                continue
+            if _iou(ref["bbox"], detection["bbox"]) >= iou_threshold:
+                matched.add(i)
+                true_positives += 1
+                break
+    precision = true_positives / len(candidate) if candidate else 0.0
+    recall = true_positives / len(reference) if reference else 0.0
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def run_mock(images, repeat, confidence):
+    """The model modules' own entry points with no model loaded (simulated results)"""
+    configured = settings.INFERENCE_BACKEND
+    settings.INFERENCE_BACKEND = "mock"
+    latencies, outputs = [], {}
+    try:
+        # Untimed first call: the model modules import their dependencies lazily
+        pest_detection.detect_pests(images[0][1], confidence)["pests"].to_records()
+        yield_prediction.predict_yield(images[0][1])
+        for _ in range(repeat):
+            for name, data in images:
+                started = time.perf_counter()
+                detections = pest_detection.detect_pests(data, confidence)["pests"].to_records()
+                predicted = yield_prediction.predict_yield(data)["predicted_yield_tons_per_hectare"]
+                latencies.append(time.perf_counter() - started)
+                outputs[name] = (detections, predicted)
+    finally:
+        settings.INFERENCE_BACKEND = configured
+    return latencies, outputs
+
+
+def run_variant(precision, images, threads, repeat, model_dir, confidence):
+    if precision == "mock":
+        return run_mock(images, repeat, confidence)
+    pest = backends.create_backend(pest_detection.PEST_MODEL_NAME, "onnxruntime", precision,
+                                   threads, 1, model_dir)
+    yield_model = backends.create_backend(yield_prediction.YIELD_MODEL_NAME, "onnxruntime", precision,
+                                          threads, 1, model_dir)
+    if pest is None or yield_model is None:
+        return None
+
+    latencies, outputs = [], {}
+    for _ in range(repeat):
+        for name, data in images:
+            started = time.perf_counter()
+            detections = pest_detection._detect_with_model(pest, data, confidence)["pests"].to_records()
+            predicted = yield_prediction.run_yield_model(yield_model, data)
+            latencies.append(time.perf_counter() - started)
+            outputs[name] = (detections, predicted)
+    return latencies, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inference backends on local images")
+    parser.add_argument("--images", type=Path, default=Path(__file__).parent.parent / "sample-images")
+    parser.add_argument("--model-dir", default=None)
+    parser.add_argument("--precisions", default="fp32,fp16,int8,mock", help="variants; mock is the no-model baseline")
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per session")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--confidence", type=float, default=0.25)
+    parser.add_argument("--synthetic", type=int, default=0, help="use this many generated frames instead of --images")
+    parser.add_argument("--megapixels", type=float, default=20.0, help="size of generated frames")
+    args = parser.parse_args()
+
+    images = synthetic_images(args.synthetic, args.megapixels) if args.synthetic else load_images(args.images)
+    if not images:
+        print(f"✗ No images found in {args.images}")
+        sys.exit(1)
+
+    print("=" * 72)
+    print(f"Inference benchmark: {len(images)} images x {args.repeat}, {args.threads} thread(s)")
+    print("=" * 72)
+    print(f"{'variant':<8} {'mean ms':>9} {'p95 ms':>9} {'img/s/core':>11} {'det F1':>8} {'yield MAE':>10}")
+
+    reference = None
+    for precision in args.precisions.split(","):
+        result = run_variant(precision, images, args.threads, args.repeat, args.model_dir, args.confidence)
+        if result is None:
+            print(f"{precision:<8} (model files missing, skipped)")
+            continue
+        latencies, outputs = result
+        if reference is None and precision != "mock":
+            # First available model variant (normally fp32) is the accuracy reference
+            reference = outputs
+
+        mean_ms = statistics.mean(latencies) * 1000
+        p95_ms = sorted(latencies)[int(0.95 * (len(latencies) - 1))] * 1000
+        per_core = 1000 / mean_ms / args.threads
+        if reference is None:
+            print(f"{precision:<8} {mean_ms:>9.1f} {p95_ms:>9.1f} {per_core:>11.2f} {'-':>8} {'-':>10}")
+            continue
+        f1 = statistics.mean(detection_f1(reference[n][0], outputs[n][0]) for n in outputs)
+        mae = statistics.mean(abs(reference[n][1] - outputs[n][1]) for n in outputs)
+        print(f"{precision:<8} {mean_ms:>9.1f} {p95_ms:>9.1f} {per_core:>11.2f} {f1:>8.3f} {mae:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
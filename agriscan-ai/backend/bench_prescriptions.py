@@ -0,0 +1,67 @@
+"""
+Prescription map benchmark.
+
+Builds a synthetic 100-hectare field (1 km x 1 km polygon) as a 5-band
+R, G, B, NIR, Red Edge raster (app.synthetic, vigor patches by default), and times
+index computation, zoning, gridding and export for each zoning method, with
+NDRE (nitrogen) and NDVI only (potassium).
+
+Usage:
+  python bench_prescriptions.py
+  python bench_prescriptions.py --side 2048 --cell 10 --zones 5
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app import prescriptions, synthetic  # noqa: E402
+from app.ml_models.nutrient_analysis import index_rasters  # noqa: E402
+
+# 1 km x 1 km
+FIELD = synthetic.field_polygon(100)
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time prescription map generation for a 100 ha field")
+    parser.add_argument("--side", type=int, default=2048, help="raster side in pixels (2048 ~ 0.5 m GSD)")
+    parser.add_argument("--cell", type=float, default=10.0, help="grid cell size in metres")
+    parser.add_argument("--zones", type=int, default=4)
+    parser.add_argument("--pattern", default="patches", choices=synthetic.PATTERNS)
+    args = parser.parse_args()
+
+    pixels = synthetic.image(args.side, args.side, bands=5, dtype=np.uint16, pattern=args.pattern)
+    (ndvi, ndre), index_ms = timed(index_rasters, pixels)
+    print("=" * 78)
+    print(f"Prescription maps: 100 ha, {args.side}x{args.side} px, {args.cell:g} m cells")
+    print(f"Index rasters (NDVI + NDRE): {index_ms:.0f} ms")
+    print("=" * 78)
+    print(f"{'method':<10} {'nutrient':<11} {'zone ms':>8} {'geojson ms':>11} {'shp ms':>7} {'total ms':>9} "
+          f"{'rects':>6} {'geojson KB':>11}")
+    for method in prescriptions.METHODS:
+        for nutrient in ("nitrogen", "potassium"):
+            prescription, build_ms = timed(prescriptions.build, ndvi, ndre if nutrient == "nitrogen" else None,
+                                           nutrient=nutrient, zones=args.zones, method=method,
+                                           cell_size_m=args.cell, location=FIELD)
+            geojson, geojson_ms = timed(prescriptions.encode, prescription, "geojson")
+            _, shp_ms = timed(prescriptions.encode, prescription, "shapefile")
+            total = index_ms + build_ms + geojson_ms
+            print(f"{method:<10} {nutrient:<11} {build_ms:>8.0f} {geojson_ms:>11.0f} {shp_ms:>7.0f} {total:>9.0f} "
+                  f"{len(prescription.rectangles):>6} {len(geojson) / 1024:>11.1f}")
+    print("\nZones (kmeans, nitrogen):")
+    for zone in prescriptions.build(ndvi, ndre, zones=args.zones, cell_size_m=args.cell, location=FIELD).zones:
+        print(f"  {zone}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Serialization benchmark for analysis payloads.
+
+Compares the default FastAPI path (pydantic validation + jsonable_encoder +
+json) with the fast path in app/serialization.py, for pest results with
+100 / 10k / 100k detections, in row and columnar encodings.
+
+Usage:
+  python bench_serialization.py
+  python bench_serialization.py --sizes 100,10000 --repeat 5
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.encoders import jsonable_encoder
+
+from app import schemas, serialization
+
+
+def make_analysis(detections: int):
+    zones = ["Zone A", "Zone B", "Zone C", "Zone D"]
+    pests = [{
+        "pest_type": random.choice(["Aphid", "Whitefly", "Caterpillar", "Beetle", "Mite"]),
+        "confidence": round(random.uniform(0.7, 0.99), 2),
+        "bbox": {"x": random.randint(0, 5000), "y": random.randint(0, 5000),
+                 "width": random.randint(10, 100), "height": random.randint(10, 100)},
+        "zone": random.choice(zones),
+    } for _ in range(detections)]
+    return SimpleNamespace(
+        id="bench", field_id="field-1", analysis_type="pest_detection",
+        original_image_url="/uploads/bench.jpg", confidence_score=None,
+        status="completed", stage=None, progress=None, created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(), results_json={"pests": pests, "affected_area_percentage": 12.5, "risk_level": "HIGH"},
+    )
+
+
+def default_path(analysis):
+    model = schemas.AnalysisResponse.model_validate(analysis)
+    return json.dumps(jsonable_encoder(model)).encode()
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark analysis serialization")
+    parser.add_argument("--sizes", default="100,10000,100000")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("=" * 78)
+    print(f"Serialization benchmark (best of {args.repeat}, orjson={'yes' if serialization.orjson else 'no'})")
+    print("=" * 78)
+    print(f"{'detections':>10} {'path':<22} {'ms':>9} {'bytes':>12} {'gzip bytes':>12}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        analysis = make_analysis(size)
+        paths = [
+            ("pydantic + json", lambda: default_path(analysis)),
+            ("fast rows", lambda: serialization.dumps(serialization.encode_analysis(analysis))),
+            ("fast columnar", lambda: serialization.dumps(serialization.encode_analysis(analysis, "columnar"))),
+        ]
+        for name, fn in paths:
+            ms, body = timed(fn, args.repeat)
+            gzipped = len(serialization.compress(body, "gzip"))
+            print(f"{size:>10} {name:<22} {ms:>9.1f} {len(body):>12,} {gzipped:>12,}")
+
+        serialization.payload_cache.invalidate(analysis.id)
+        serialization.analysis_response(analysis, "gzip")
+        ms, _ = timed(lambda: serialization.analysis_response(analysis, "gzip"), args.repeat)
+        print(f"{size:>10} {'cached (gzip)':<22} {ms:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Startup-time benchmark for the API.
+
+Runs `python -X importtime -c "import app.main"` in fresh interpreters, reports
+the slowest imports, and compares the median total against the committed
+baseline (startup_baseline.json) so cold-start regressions show up in review.
+It exits non-zero when the median exceeds the baseline by more than the
+tolerance, when the baseline is missing, or when a module that must stay
+deferred (DEFERRED_MODULES: numpy and friends, imported inside the functions
+that need them) is loaded by the import.
+
+Usage:
+  python bench_startup.py                  # report + compare with baseline
+  python bench_startup.py --save-baseline  # record current numbers as baseline
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent
+BASELINE_FILE = BACKEND_DIR / "startup_baseline.json"
+# Heavy packages only the request paths that need them may import
+DEFERRED_MODULES = ("numpy", "tifffile", "onnxruntime", "torch", "pyarrow", "celery")
+
+
+def measure_once(module: str):
+    """Return {module name: cumulative microseconds} for one cold import"""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        cumulative[name.strip()] = int(cumulative_us)
+    return cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API import/startup time")
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline (0.2 = 20%%)")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    runs = [measure_once(args.module) for _ in range(args.runs)]
+    totals = [run.get(args.module, 0) for run in runs]
+    median_ms = statistics.median(totals) / 1000
+
+    print("=" * 60)
+    print(f"Import time for {args.module} ({args.runs} runs)")
+    print("=" * 60)
+    print(f"  Median total: {median_ms:.1f} ms (min {min(totals) / 1000:.1f}, max {max(totals) / 1000:.1f})")
+
+    # Top-level packages only, so numpy/sqlalchemy show up as one line each
+    last = runs[-1]
+    top_level = {name: us for name, us in last.items() if "." not in name or name.startswith("app.")}
+    print(f"\n  Slowest imports (cumulative, last run):")
+    for name, us in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"    {us / 1000:8.1f} ms  {name}")
+
+    loaded = [name for name in DEFERRED_MODULES if any(name in run for run in runs)]
+    if loaded:
+        print(f"\n✗ Deferred modules imported at startup: {', '.join(loaded)}")
+        sys.exit(1)
+
+    report = {"module": args.module, "median_ms": round(median_ms, 1)}
+    if args.save_baseline:
+        BASELINE_FILE.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"\n✓ Baseline saved to {BASELINE_FILE}")
+        return
+
+    if not BASELINE_FILE.exists():
+        print(f"\n✗ No baseline found, run with --save-baseline to record one")
+        sys.exit(1)
+
+    baseline = json.loads(BASELINE_FILE.read_text())
+    limit = baseline["median_ms"] * (1 + args.tolerance)
+    print(f"\n  Baseline: {baseline['median_ms']:.1f} ms (limit {limit:.1f} ms)")
+    if median_ms > limit:
+        print("✗ Startup time regressed")
+        sys.exit(1)
+    print("✓ Startup time within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Memory benchmark for multi-worker serving.
+
+Starts the API with 1..N workers, once pre-forked (serve.py) and once with
+`uvicorn --workers N`, waits for /health, and reads each process's memory
+from /proc/<pid>/smaps_rollup:
+  RSS  resident pages, counting shared pages in every process
+  PSS  shared pages divided among the processes sharing them (sums to real use)
+  USS  pages private to the process (what one more worker really costs)
+
+With --model-mb, a synthetic ONNX model of that size is written to a temp
+MODEL_DIR (requires the onnx package) so the weights show up in the numbers.
+
+Usage:
+  python bench_workers.py
+  python bench_workers.py --workers 1,2,4 --model-mb 200
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent
+
+
+def write_model(model_dir: Path, megabytes: int):
+    """Stand-in for the real weights: one MatMul with a megabytes-sized initializer"""
+    import numpy as np
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    side = int((megabytes * 1e6 / 4) ** 0.5)
+    weight = numpy_helper.from_array(np.random.default_rng(0).standard_normal((side, side), dtype=np.float32), "w")
+    graph = helper.make_graph(
+        [helper.make_node("MatMul", ["x", "w"], ["y"])], "synthetic",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [1, side])],
+        [helper.make_tensor_value_info("y", TensorProto.FLOAT, [1, side])],
+        initializer=[weight],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    for name in ("pest_yolov8", "yield_cnn"):
+        onnx.save(model, str(model_dir / f"{name}.onnx"))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def descendants(pid: int):
+    children = []
+    for task in Path(f"/proc/{pid}/task").iterdir():
+        children += [int(c) for c in (task / "children").read_text().split()]
+    result = []
+    for child in children:
+        result += [child] + descendants(child)
+    return result
+
+
+def memory(pid: int):
+    """(rss, pss, uss) in bytes"""
+    fields = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()[1:]:
+        name, value = line.split(":", 1)
+        fields[name] = int(value.split()[0]) * 1024
+    return fields["Rss"], fields["Pss"], fields["Private_Clean"] + fields["Private_Dirty"]
+
+
+def is_worker(pid: int) -> bool:
+    # uvicorn --workers also starts multiprocessing's resource tracker
+    cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
+    return b"resource_tracker" not in cmdline
+
+
+def wait_healthy(port: int, proc: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with {proc.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError("Server did not become healthy")
+
+
+def measure(mode: str, workers: int, env: dict):
+    port = free_port()
+    if mode == "prefork":
+        command = [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+                   "--workers", str(workers), "--log-level", "warning"]
+    proc = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_healthy(port, proc)
+        # Let every worker finish startup (and serve a request or two)
+        for _ in range(workers * 4):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=5).read()
+        time.sleep(1)
+        master = memory(proc.pid)
+        children = [memory(pid) for pid in descendants(proc.pid) if is_worker(pid)]
+        if not children:
+            # uvicorn with one worker serves from the main process
+            master, children = (0, 0, 0), [master]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    return master, children
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory per additional API worker")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--modes", default="prefork,uvicorn")
+    parser.add_argument("--model-mb", type=int, default=0, help="synthetic model size; 0 = mock inference")
+    args = parser.parse_args()
+
+    scratch = Path(tempfile.mkdtemp(prefix="bench-workers-"))
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{scratch / 'bench.db'}", UPLOAD_DIR=str(scratch / "uploads"),
+               ADMISSION_ENABLED="false", SERVE_THREADS_PER_WORKER="1")
+    if args.model_mb:
+        write_model(scratch, args.model_mb)
+        env.update(INFERENCE_BACKEND="onnxruntime", MODEL_DIR=str(scratch), WARMUP_ON_STARTUP="true")
+
+    counts = [int(n) for n in args.workers.split(",")]
+    print("=" * 78)
+    print(f"Serving memory ({'synthetic %d MB model' % args.model_mb if args.model_mb else 'mock inference'})")
+    print("=" * 78)
+    print(f"{'mode':<9} {'workers':>7} {'total PSS MB':>13} {'worker RSS':>11} {'worker PSS':>11} {'worker USS':>11}")
+    for mode in args.modes.split(","):
+        totals = {}
+        for workers in counts:
+            master, children = measure(mode, workers, env)
+            total_pss = master[1] + sum(child[1] for child in children)
+            totals[workers] = total_pss
+            average = [sum(child[i] for child in children) / max(1, len(children)) / 1e6 for i in range(3)]
+            print(f"{mode:<9} {workers:>7} {total_pss / 1e6:>13.1f} {average[0]:>11.1f} {average[1]:>11.1f} "
+                  f"{average[2]:>11.1f}")
+        if len(counts) > 1:
+            low, high = min(counts), max(counts)
+            per_worker = (totals[high] - totals[low]) / (high - low) / 1e6
+            print(f"{mode:<9} {'':>7} -> {per_worker:.1f} MB per additional worker")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Production server for AgriScan AI Backend
+
+Loads the app and models once in a master process, then forks
+SERVE_WORKERS uvicorn workers that share them copy-on-write (see
+app/prefork.py). Use run_dev.py for auto-reload during development.
+
+Usage:
+  python serve.py
+  python serve.py --workers 8 --port 8000
+"""
+import argparse
+import sys
+from pathlib import Path
+
+# Add app directory to Python path
+app_dir = Path(__file__).parent
+sys.path.insert(0, str(app_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the API with pre-forked workers")
+    parser.add_argument("--host", default=None, help="default SERVE_HOST")
+    parser.add_argument("--port", type=int, default=None, help="default SERVE_PORT")
+    parser.add_argument("--workers", type=int, default=None, help="default SERVE_WORKERS (0 = one per CPU)")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(app_dir / ".env")
+
+    # Before anything imports numpy: thread pools are sized from the environment
+    from app import prefork
+    sys.exit(prefork.serve(args.host, args.port, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Replication test script: an edge SQLite database pushing to a central server
+
+Starts the API as the central server (its own SQLite file, REPLICATION_ROLE=central)
+on a local port, writes fields/uploads/analyses into a separate edge database, and
+checks interrupted, resent and incremental pushes leave both databases identical.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+BACKEND_DIR = Path(__file__).parent
+WORK_DIR = Path(tempfile.mkdtemp(prefix="replication-test-"))
+EDGE_ID = "edge-test"
+TOKEN = "test-token"
+AUTH = {"Authorization": f"Bearer {TOKEN}"}
+
+os.environ.update(REPLICATION_EDGE_ID=EDGE_ID, REPLICATION_TOKEN=TOKEN, DATABASE_URL=f"sqlite:///{WORK_DIR / 'unused.db'}")
+sys.path.insert(0, str(BACKEND_DIR))
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from app import models, replication
+from app.database import Base
+
+edge_engine = create_engine(f"sqlite:///{WORK_DIR / 'edge.db'}")
+central_engine = create_engine(f"sqlite:///{WORK_DIR / 'central.db'}")
+EdgeSession = sessionmaker(bind=edge_engine)
+
+
+def start_central():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{WORK_DIR / 'central.db'}", REPLICATION_ROLE="central",
+               UPLOAD_DIR=str(WORK_DIR / "uploads"))
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=BACKEND_DIR, env=env)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/health", timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError("Central server did not start")
+
+
+def snapshot(engine):
+    with engine.connect() as conn:
+        return {table.name: sorted(tuple(row) for row in conn.execute(select(table)))
+                for table in replication.REPLICATED_TABLES}
+
+
+def seed_edge():
+    """Edge database with 2 fields, 20 uploads and 300 analyses carrying result blobs"""
+    Base.metadata.create_all(bind=edge_engine)
+    replication.install_triggers(edge_engine)
+    db = EdgeSession()
+    fields = [models.Field(field_name=f"North {i}", crop_type="corn") for i in range(2)]
+    db.add_all(fields)
+    db.flush()
+    for i in range(20):
+        db.add(models.Upload(filename=f"flight-{i}.jpg", field_id=fields[i % 2].id, size=1000 + i))
+    for i in range(300):
+        db.add(models.Analysis(field_id=fields[i % 2].id, analysis_type="pest_detection", status="completed",
+                               results_json={"pests": [{"pest_type": "Aphid", "confidence": 0.9}] * 20}))
+    db.commit()
+    db.close()
+
+
+def check_interrupted_push(url):
+    """One batch, then stop: central holds exactly what it acknowledged"""
+    print("Testing interrupted push...")
+    sent = replication.push(edge_engine, url, batch_size=100, max_batches=1)
+    state = requests.get(f"{url}/api/replication/peers/{EDGE_ID}", headers=AUTH).json()
+    unauthorized = requests.get(f"{url}/api/replication/peers/{EDGE_ID}").status_code
+    central_rows = sum(len(rows) for rows in snapshot(central_engine).values())
+    ok = sent == 100 and state["last_seq"] == 100 and central_rows == 100 and unauthorized == 401
+    print(f"  sent {sent}, central last_seq {state['last_seq']}, central rows {central_rows}, "
+          f"without token -> {unauthorized}")
+    print("✓ Partial push applied" if ok else "✗ Partial push mismatch")
+    return ok
+
+
+def check_resent_batch(url):
+    """A batch whose acknowledgement was lost is recognised when sent again"""
+    print("\nTesting resent batch...")
+    batch = replication.collect(edge_engine, 100, 50)
+    headers = dict(AUTH, **{"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    first = requests.post(f"{url}/api/replication/batches", data=replication.encode(batch), headers=headers).json()
+    again = requests.post(f"{url}/api/replication/batches", data=replication.encode(batch), headers=headers).json()
+    gap = dict(batch, from_seq=batch["to_seq"] + 10, to_seq=batch["to_seq"] + 20)
+    rejected = requests.post(f"{url}/api/replication/batches", data=replication.encode(gap), headers=headers)
+    ok = first["last_seq"] == again["last_seq"] == 150 and rejected.status_code == 409
+    print(f"  applied to {first['last_seq']}, resend acknowledged at {again['last_seq']}, gap -> {rejected.status_code}")
+    print("✓ Resends are idempotent" if ok else "✗ Resend handling failed")
+    return ok
+
+
+def check_resume_and_incremental(url):
+    """Resume from the central high-water mark, then ship updates and deletes"""
+    print("\nTesting resume and incremental changes...")
+    replication.push(edge_engine, url, batch_size=100)
+    db = EdgeSession()
+    # Bulk UPDATE bypasses ORM events; the triggers still see it
+    db.query(models.Analysis).filter(models.Analysis.analysis_type == "pest_detection").update(
+        {"confidence_score": 0.5}, synchronize_session=False)
+    upload = db.query(models.Upload).first()
+    db.delete(upload)
+    db.commit()
+    db.close()
+    sent = replication.push(edge_engine, url, batch_size=100)
+    with edge_engine.connect() as conn:
+        remaining = conn.execute(select(models.ReplicationLog.seq)).all()
+    ok = snapshot(edge_engine) == snapshot(central_engine) and not remaining
+    print(f"  incremental push sent {sent} rows, edge log entries left {len(remaining)}")
+    print("✓ Edge and central databases match" if ok else "✗ Databases differ")
+    return ok
+
+
+def main():
+    print("=" * 60)
+    print("AgriScan AI Backend - Replication Test")
+    print("=" * 60)
+    seed_edge()
+    proc, url = start_central()
+    try:
+        results = [check(url) for check in (check_interrupted_push, check_resent_batch, check_resume_and_incremental)]
+    finally:
+        proc.terminate()
+        proc.wait()
+    print("\n" + "=" * 60)
+    print("✓ All replication tests passed" if all(results) else "✗ Some replication tests failed")
+    print("=" * 60)
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -48,6 +48,12 @@ function DashboardPage() {
             [type]: { status: 'complete', progress: 100, result: data.data }
           }));
           ws.close();
+        } else if (data.status === 'cancelled') {
+          setAnalysisStatus(prev => ({
+            ...prev,
+            [type]: { status: 'idle', progress: 0, result: null }
+          }));
+          ws.close();
         } else if (data.status === 'error') {
           setAnalysisStatus(prev => ({
             ...prev,
@@ -3,14 +3,17 @@ AgriScan AI - FastAPI Backend
 Mock AI endpoints for pest detection, nutrient analysis, and yield prediction
 """
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-import random
-import uuid
 from datetime import datetime
+from pathlib import Path
+
+import pipeline
+from upload_registry import create_registry, save_upload, UploadTooLarge
+from mock_models import mock_yolov8_detection, mock_nutrient_analysis, mock_yield_prediction
 
 app = FastAPI(
     title="AgriScan AI API",
@@ -27,94 +30,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage for demo
-uploaded_images = {}
-
-# ========================
-# Mock AI Functions
-# ========================
-
-def mock_yolov8_detection():
-    """Simulate YOLOv8 pest detection output"""
-    pest_types = ["Aphid", "Caterpillar", "Whitefly", "Thrips", "Spider Mite", "Leaf Miner"]
-    num_pests = random.randint(0, 5)
-    
-    detections = []
-    for _ in range(num_pests):
-        detections.append({
-            "label": random.choice(pest_types),
-            "confidence": round(random.uniform(0.75, 0.98), 2),
-            "bbox": {
-                "x": random.randint(50, 400),
-                "y": random.randint(50, 300),
-                "width": random.randint(40, 100),
-                "height": random.randint(40, 100)
-            }
-        })
-    
-    alert_level = "Safe" if num_pests == 0 else ("Moderate" if num_pests <= 2 else "High Alert")
-    
-    recommendations = {
-        "Safe": "No immediate action required. Continue routine monitoring.",
-        "Moderate": "Apply targeted organic pesticide in affected zones within 48 hours.",
-        "High Alert": "Urgent: Apply broad-spectrum treatment immediately. Consider drone spraying."
-    }
-    
-    return {
-        "status": "completed",
-        "alert_level": alert_level,
-        "pests_detected": detections,
-        "total_pests": num_pests,
-        "recommendation": recommendations[alert_level],
-        "processing_time": round(random.uniform(1.2, 2.8), 2)
-    }
-
-def mock_nutrient_analysis():
-    """Simulate DeepLabV3+ NDVI nutrient deficiency analysis"""
-    nitrogen = random.randint(5, 45)
-    phosphorus = random.randint(3, 25)
-    potassium = random.randint(2, 20)
-    
-    max_def = max(nitrogen, phosphorus, potassium)
-    if max_def > 30:
-        health = "Low Nitrogen" if nitrogen == max_def else ("Low Phosphorus" if phosphorus == max_def else "Low Potassium")
-    elif max_def > 15:
-        health = "Moderate Deficiency"
-    else:
-        health = "Optimal"
-    
-    zones = ["A1", "A2", "A3", "B1", "B2", "B3", "C1", "C2", "C3"]
-    affected = random.sample(zones, random.randint(1, 3))
-    
-    return {
-        "status": "completed",
-        "overall_health": health,
-        "deficiencies": {
-            "nitrogen": nitrogen,
-            "phosphorus": phosphorus,
-            "potassium": potassium
-        },
-        "affected_zones": affected,
-        "recommendation": f"Apply balanced fertilizer in zones {', '.join(affected)}",
-        "processing_time": round(random.uniform(2.1, 3.5), 2)
-    }
+# Bounded upload bookkeeping (see upload_registry.py for backends and limits)
+upload_registry = create_registry()
 
-def mock_yield_prediction():
-    """Simulate CNN-Regressor yield prediction"""
-    base_yield = random.uniform(3.5, 5.5)
-    confidence = random.uniform(0.82, 0.95)
-    days = random.randint(21, 42)
-    change = random.uniform(-15, 20)
-    
-    return {
-        "status": "completed",
-        "predicted_yield": round(base_yield, 2),
-        "unit": "tons/ha",
-        "harvest_ready_in": days,
-        "confidence": round(confidence, 2),
-        "comparison": f"{'+' if change > 0 else ''}{change:.1f}% vs last season",
-        "processing_time": round(random.uniform(1.5, 2.2), 2)
-    }
+@app.on_event("shutdown")
+async def shutdown_pipeline():
+    pipeline.shutdown_executor()
 
 # ========================
 # API Endpoints
@@ -126,31 +47,37 @@ async def root():
         "name": "AgriScan AI API",
         "version": "1.0.0",
         "status": "running",
-        "endpoints": ["/api/upload-image", "/api/analyze/pests", "/api/analyze/nutrients", "/api/analyze/yield", "/api/analyze/full"]
+        "endpoints": ["/api/upload-image", "/api/analyze/pests", "/api/analyze/nutrients", "/api/analyze/yield", "/api/analyze/full", "/api/analyze/full/stream"]
     }
 
+async def _store_upload(file: UploadFile):
+    try:
+        record = await save_upload(file, file.content_type)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    upload_registry.put(record)
+    return record
+
 @app.post("/api/upload-image")
 async def upload_image(file: UploadFile = File(...)):
     """Upload drone imagery for analysis"""
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    image_id = str(uuid.uuid4())[:8]
-    contents = await file.read()
-    
-    uploaded_images[image_id] = {
-        "filename": file.filename,
-        "size": len(contents),
-        "uploaded_at": datetime.now().isoformat()
-    }
+    record = await _store_upload(file)
     
     return {
         "status": "success",
-        "image_id": image_id,
+        "image_id": record.image_id,
         "filename": file.filename,
         "message": "Image uploaded successfully. Ready for analysis."
     }
 
+@app.get("/api/uploads/stats")
+async def upload_stats():
+    """Upload registry size, hit/miss and eviction counters"""
+    return upload_registry.stats()
+
 @app.post("/api/analyze/pests")
 async def analyze_pests(image_id: Optional[str] = None):
     """Run YOLOv8 pest detection"""
@@ -166,32 +93,66 @@ async def analyze_yield(image_id: Optional[str] = None):
     """Run CNN-Regressor yield prediction"""
     return mock_yield_prediction()
 
+async def _load_image(image_id: Optional[str]):
+    """Decode a registered upload; no image_id runs the pipeline in demo mode"""
+    if not image_id:
+        return None
+    record = upload_registry.get(image_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Image not found or expired")
+    image = await pipeline.decode_file_in_pool(record.path)
+    if image is None:
+        # Corrupt, or its file was evicted after the lookup: never fall back to demo results
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    return image
+
 @app.get("/api/analyze/full")
 async def full_analysis(image_id: Optional[str] = None):
-    """Run complete analysis pipeline"""
+    """Run complete analysis pipeline (all stages concurrently)"""
+    results = await pipeline.run_all(await _load_image(image_id))
     return {
         "image_id": image_id or "demo",
         "timestamp": datetime.now().isoformat(),
-        "pest_analysis": mock_yolov8_detection(),
-        "nutrient_analysis": mock_nutrient_analysis(),
-        "yield_prediction": mock_yield_prediction()
+        **results
     }
 
+@app.get("/api/analyze/full/stream")
+async def full_analysis_stream(request: Request, image_id: Optional[str] = None):
+    """Stream each pipeline stage as it finishes (NDJSON, or SSE if requested via Accept)"""
+    use_sse = "text/event-stream" in request.headers.get("accept", "")
+    formatter = pipeline.format_sse if use_sse else pipeline.format_ndjson
+
+    image = await _load_image(image_id)
+
+    async def events():
+        async for stage in pipeline.iter_stages(image):
+            yield formatter({**stage, "image_id": image_id or "demo"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream" if use_sse else "application/x-ndjson"
+    )
+
 @app.post("/analyze")
 async def analyze_image(file: UploadFile = File(...)):
     """Legacy endpoint - analyze drone image"""
-    pests = mock_yolov8_detection()
-    nutrients = mock_nutrient_analysis()
-    yield_pred = mock_yield_prediction()
+    record = await _store_upload(file)
+    image = await pipeline.decode_file_in_pool(record.path)
+    if image is None:
+        upload_registry.remove(record.image_id)
+        # The registry may already have evicted the record and its file
+        Path(record.path).unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    results = await pipeline.run_all(image)
     
     return {
-        "image_id": str(uuid.uuid4()),
-        "pest_detection": pests,
-        "nutrient_analysis": nutrients,
-        "yield_prediction": yield_pred,
+        "image_id": record.image_id,
+        "pest_detection": results["pest_analysis"],
+        "nutrient_analysis": results["nutrient_analysis"],
+        "yield_prediction": results["yield_prediction"],
         "recommendations": [
-            "Apply targeted pesticide spray in high-alert zones",
-            "Increase nitrogen fertilizer application",
+            results["pest_analysis"]["recommendation"],
+            results["nutrient_analysis"]["recommendation"],
             "Monitor field for next 7 days"
         ]
     }
@@ -0,0 +1,148 @@
+"""
+AgriScan AI - Analysis pipeline
+Runs the pest, nutrient and yield stages concurrently in a process pool.
+
+The image is decoded once, in a pool worker, into a scratch file of raw
+pixels under PIPELINE_SCRATCH_DIR. Stages get a small handle (DecodedImage:
+mode, size, path) and memory-map the file read-only, so the pixels are never
+pickled between processes and every stage reads the same page-cache pages.
+Full-analysis latency is bounded by the slowest model rather than the sum of
+all three. Results can also be consumed one stage at a time as
+they finish (see iter_stages) for NDJSON / server-sent event streaming.
+"""
+
+import asyncio
+import io
+import json
+import mmap
+import os
+import random
+import tempfile
+import time
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from PIL import Image
+
+from mock_models import mock_yolov8_detection, mock_nutrient_analysis, mock_yield_prediction
+
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "3"))
+# Decoded pixels of in-flight requests; disk-backed, unlike /dev/shm (64MB in Docker by default)
+PIPELINE_SCRATCH_DIR = Path(os.getenv("PIPELINE_SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "agriscan-pixels")))
+
+# Stage name -> model. Names match the keys of the /api/analyze/full response.
+STAGES = {
+    "pest_analysis": mock_yolov8_detection,
+    "nutrient_analysis": mock_nutrient_analysis,
+    "yield_prediction": mock_yield_prediction,
+}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass(frozen=True)
+class DecodedImage:
+    """
+    Handle to a decoded raster in a scratch file; only these three fields are
+    pickled to the stage workers. The file is deleted when the API process
+    drops the handle (see decode_file_in_pool).
+    """
+    mode: str
+    size: Tuple[int, int]
+    path: str
+
+    def to_pil(self) -> Image.Image:
+        """Image backed by the memory-mapped pixels (no copy; unmapped when the image is collected)"""
+        with open(self.path, "rb") as f:
+            pixels = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Image.frombuffer(self.mode, self.size, pixels, "raw", self.mode, 0, 1)
+
+
+def decode_image(source) -> Optional[DecodedImage]:
+    """Decode an upload (path or bytes) once; returns None if it is not a readable image"""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    try:
+        image = Image.open(source)
+        image = image.convert("RGB")
+    except Exception as e:
+        print(f"Image decode failed: {e}")
+        return None
+    PIPELINE_SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+    path = PIPELINE_SCRATCH_DIR / f"{uuid.uuid4().hex}.raw"
+    with open(path, "wb") as f:
+        f.write(image.tobytes())
+    return DecodedImage(mode=image.mode, size=image.size, path=str(path))
+
+
+def _init_worker():
+    # Forked workers inherit the parent's random state; reseed so stages differ
+    random.seed()
+
+
+def _run_stage(name: str, image: Optional[DecodedImage]) -> Dict:
+    started = time.perf_counter()
+    result = STAGES[name](image)
+    return {"stage": name, "result": result, "elapsed": round(time.perf_counter() - started, 3)}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PIPELINE_WORKERS, initializer=_init_worker)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def decode_file_in_pool(path: str) -> Optional[DecodedImage]:
+    loop = asyncio.get_running_loop()
+    # Workers read the file themselves so the upload never sits in API memory
+    image = await loop.run_in_executor(get_executor(), decode_image, path)
+    if image is not None:
+        # The request's handle going away (response sent, client gone) removes the pixels;
+        # stages that still have the file mapped keep reading it until they unmap
+        weakref.finalize(image, Path(image.path).unlink, missing_ok=True)
+    return image
+
+
+async def iter_stages(image: Optional[DecodedImage] = None) -> AsyncIterator[Dict]:
+    """Start every stage at once and yield each one's result as soon as it finishes"""
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    pending = [
+        loop.run_in_executor(executor, _run_stage, name, image)
+        for name in STAGES
+    ]
+    try:
+        for next_done in asyncio.as_completed(pending):
+            yield await next_done
+    finally:
+        # Client went away mid-stream: drop stages that have not started yet
+        for future in pending:
+            future.cancel()
+
+
+async def run_all(image: Optional[DecodedImage] = None) -> Dict[str, Dict]:
+    """Run every stage concurrently and return {stage name: result}"""
+    results = {}
+    async for stage in iter_stages(image):
+        results[stage["stage"]] = stage["result"]
+    return results
+
+
+def format_ndjson(event: Dict) -> str:
+    return json.dumps(event) + "\n"
+
+
+def format_sse(event: Dict) -> str:
+    return f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,335 @@
+"""
+AgriScan AI - Upload registry
+Bounded bookkeeping for uploaded images in the standalone backend.
+
+Uploads are streamed to disk in chunks and only their metadata is kept here.
+Backends:
+  - MemoryUploadRegistry: LRU + TTL, capped by entry count and total bytes.
+    Evicted entries are handed to an optional spill registry, otherwise their
+    files are deleted.
+  - SQLiteUploadRegistry: the same caps, backed by a SQLite file, so it
+    survives restarts and does not hold metadata in process memory.
+
+Every backend counts hits, misses, evictions and expirations (see stats()).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "./uploads"))
+UPLOAD_REGISTRY_BACKEND = os.getenv("UPLOAD_REGISTRY_BACKEND", "memory")  # memory, sqlite, tiered
+UPLOAD_REGISTRY_DB = os.getenv("UPLOAD_REGISTRY_DB", str(UPLOAD_DIR / "registry.db"))
+UPLOAD_REGISTRY_MAX_ENTRIES = int(os.getenv("UPLOAD_REGISTRY_MAX_ENTRIES", "10000"))
+UPLOAD_REGISTRY_MAX_BYTES = int(os.getenv("UPLOAD_REGISTRY_MAX_BYTES", str(5 * 1024 ** 3)))  # 5GB
+UPLOAD_REGISTRY_TTL_SECONDS = int(os.getenv("UPLOAD_REGISTRY_TTL_SECONDS", str(7 * 24 * 3600)))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", "524288000"))  # 500MB
+# Tiered mode splits the caps: a tenth in memory, the rest in SQLite
+TIERED_MEMORY_MAX_ENTRIES = max(1, UPLOAD_REGISTRY_MAX_ENTRIES // 10)
+TIERED_MEMORY_MAX_BYTES = max(1, UPLOAD_REGISTRY_MAX_BYTES // 10)
+TIERED_SPILL_MAX_ENTRIES = max(0, UPLOAD_REGISTRY_MAX_ENTRIES - TIERED_MEMORY_MAX_ENTRIES)
+TIERED_SPILL_MAX_BYTES = max(0, UPLOAD_REGISTRY_MAX_BYTES - TIERED_MEMORY_MAX_BYTES)
+# An upload larger than the biggest tier's byte cap would be evicted as soon as it was stored
+if UPLOAD_REGISTRY_BACKEND == "tiered":
+    MAX_STORED_SIZE = min(MAX_UPLOAD_SIZE, max(TIERED_MEMORY_MAX_BYTES, TIERED_SPILL_MAX_BYTES))
+else:
+    MAX_STORED_SIZE = min(MAX_UPLOAD_SIZE, UPLOAD_REGISTRY_MAX_BYTES)
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+@dataclass
+class UploadRecord:
+    image_id: str
+    filename: str
+    path: str
+    size: int
+    content_type: str
+    uploaded_at: float
+
+    def to_dict(self) -> Dict:
+        data = asdict(self)
+        data.pop("path")
+        return data
+
+
+def _delete_file(record: UploadRecord):
+    try:
+        os.remove(record.path)
+    except FileNotFoundError:
+        pass
+
+
+class UploadRegistry:
+    """Base class: subclasses implement _get/_put/_pop/_evict_over_limits"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+    def get(self, image_id: str) -> Optional[UploadRecord]:
+        record = self._lookup(image_id)
+        self._count(record)
+        return record
+
+    def _lookup(self, image_id: str) -> Optional[UploadRecord]:
+        """Fetch a live record without touching the hit/miss counters"""
+        with self._lock:
+            record = self._get(image_id)
+            if record is not None and self._expired(record):
+                self._pop(image_id)
+                self.expirations += 1
+                self._discard(record)
+                record = None
+            return record
+
+    def _count(self, record: Optional[UploadRecord]):
+        with self._lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+    def put(self, record: UploadRecord):
+        with self._lock:
+            self._put(record)
+            self._evict_over_limits()
+
+    def remove(self, image_id: str) -> Optional[UploadRecord]:
+        with self._lock:
+            return self._pop(image_id)
+
+    def _expired(self, record: UploadRecord) -> bool:
+        return self.ttl_seconds > 0 and time.time() - record.uploaded_at > self.ttl_seconds
+
+    def _discard(self, record: UploadRecord):
+        """Called for every evicted or expired record"""
+        _delete_file(record)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "entries": self.entry_count(),
+            "bytes": self.total_bytes(),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class MemoryUploadRegistry(UploadRegistry):
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int,
+                 spill: Optional[UploadRegistry] = None):
+        super().__init__(max_entries, max_bytes, ttl_seconds)
+        self.spill = spill
+        self._records: "OrderedDict[str, UploadRecord]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, image_id: str) -> Optional[UploadRecord]:
+        record = self._lookup(image_id)
+        if record is None and self.spill is not None:
+            record = self.spill.get(image_id)
+            if record is not None:
+                # Promote back into memory
+                self.spill.remove(image_id)
+                self.put(record)
+        # A spill hit is a hit for the registry as a whole
+        self._count(record)
+        return record
+
+    def _get(self, image_id):
+        record = self._records.get(image_id)
+        if record is not None:
+            self._records.move_to_end(image_id)
+        return record
+
+    def _put(self, record):
+        self._pop(record.image_id)
+        self._records[record.image_id] = record
+        self._bytes += record.size
+
+    def _pop(self, image_id):
+        record = self._records.pop(image_id, None)
+        if record is not None:
+            self._bytes -= record.size
+        return record
+
+    def _evict_over_limits(self):
+        while self._records and (len(self._records) > self.max_entries or self._bytes > self.max_bytes):
+            _, record = self._records.popitem(last=False)
+            self._bytes -= record.size
+            self.evictions += 1
+            self._discard(record)
+
+    def _discard(self, record):
+        if self.spill is not None and not self._expired(record):
+            self.spill.put(record)
+        else:
+            _delete_file(record)
+
+    def entry_count(self):
+        return len(self._records)
+
+    def total_bytes(self):
+        return self._bytes
+
+    def stats(self):
+        data = super().stats()
+        if self.spill is not None:
+            data["spill"] = self.spill.stats()
+        return data
+
+
+class SQLiteUploadRegistry(UploadRegistry):
+    def __init__(self, db_path: str, max_entries: int, max_bytes: int, ttl_seconds: int):
+        super().__init__(max_entries, max_bytes, ttl_seconds)
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " image_id TEXT PRIMARY KEY, filename TEXT, path TEXT, size INTEGER,"
+            " content_type TEXT, uploaded_at REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_uploads_last_access ON uploads (last_access)")
+        self._conn.commit()
+
+    def _get(self, image_id):
+        row = self._conn.execute(
+            "SELECT image_id, filename, path, size, content_type, uploaded_at FROM uploads WHERE image_id = ?",
+            (image_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute("UPDATE uploads SET last_access = ? WHERE image_id = ?", (time.time(), image_id))
+        self._conn.commit()
+        return UploadRecord(*row)
+
+    def _put(self, record):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (record.image_id, record.filename, record.path, record.size,
+             record.content_type, record.uploaded_at, time.time())
+        )
+        self._conn.commit()
+
+    def _pop(self, image_id):
+        record = self._get(image_id)
+        if record is not None:
+            self._conn.execute("DELETE FROM uploads WHERE image_id = ?", (image_id,))
+            self._conn.commit()
+        return record
+
+    def _evict_over_limits(self):
+        if self.ttl_seconds > 0:
+            cutoff = time.time() - self.ttl_seconds
+            expired = self._conn.execute(
+                "SELECT image_id, filename, path, size, content_type, uploaded_at FROM uploads WHERE uploaded_at < ?",
+                (cutoff,)
+            ).fetchall()
+            for row in expired:
+                self._conn.execute("DELETE FROM uploads WHERE image_id = ?", (row[0],))
+                self.expirations += 1
+                self._discard(UploadRecord(*row))
+        while self.entry_count() > self.max_entries or self.total_bytes() > self.max_bytes:
+            row = self._conn.execute(
+                "SELECT image_id, filename, path, size, content_type, uploaded_at FROM uploads"
+                " ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM uploads WHERE image_id = ?", (row[0],))
+            self.evictions += 1
+            self._discard(UploadRecord(*row))
+        self._conn.commit()
+
+    def entry_count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def total_bytes(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+
+
+def create_registry() -> UploadRegistry:
+    """Build the registry selected by UPLOAD_REGISTRY_BACKEND"""
+    limits = (UPLOAD_REGISTRY_MAX_ENTRIES, UPLOAD_REGISTRY_MAX_BYTES, UPLOAD_REGISTRY_TTL_SECONDS)
+    if UPLOAD_REGISTRY_BACKEND == "sqlite":
+        return SQLiteUploadRegistry(UPLOAD_REGISTRY_DB, *limits)
+    if UPLOAD_REGISTRY_BACKEND == "tiered":
+        # Small hot set in memory, everything else spilled to SQLite; the two
+        # tiers hold disjoint records, so their caps add up to the configured ones
+        spill = SQLiteUploadRegistry(
+            UPLOAD_REGISTRY_DB,
+            TIERED_SPILL_MAX_ENTRIES,
+            TIERED_SPILL_MAX_BYTES,
+            UPLOAD_REGISTRY_TTL_SECONDS
+        )
+        return MemoryUploadRegistry(
+            TIERED_MEMORY_MAX_ENTRIES,
+            TIERED_MEMORY_MAX_BYTES,
+            UPLOAD_REGISTRY_TTL_SECONDS,
+            spill=spill
+        )
+    return MemoryUploadRegistry(*limits)
+
+
+async def save_upload(file, content_type: str) -> UploadRecord:
+    """Stream an UploadFile to disk in chunks; raises UploadTooLarge past MAX_STORED_SIZE
+
+    File I/O runs in the threadpool so large uploads don't block the event loop.
+    """
+    await run_in_threadpool(UPLOAD_DIR.mkdir, parents=True, exist_ok=True)
+    image_id = uuid.uuid4().hex
+    extension = Path(file.filename or "").suffix.lower() or ".jpg"
+    path = UPLOAD_DIR / f"{image_id}{extension}"
+    partial = path.with_suffix(path.suffix + ".part")
+
+    size = 0
+    try:
+        buffer = await run_in_threadpool(open, partial, "wb")
+        try:
+            while True:
+                chunk = await file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_STORED_SIZE:
+                    raise UploadTooLarge(f"Upload exceeds {MAX_STORED_SIZE} bytes")
+                await run_in_threadpool(buffer.write, chunk)
+        finally:
+            await run_in_threadpool(buffer.close)
+        await run_in_threadpool(os.replace, partial, path)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+    return UploadRecord(
+        image_id=image_id,
+        filename=file.filename,
+        path=str(path),
+        size=size,
+        content_type=content_type,
+        uploaded_at=time.time()
+    )